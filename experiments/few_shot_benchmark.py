@@ -0,0 +1,67 @@
+"""
+Benchmark: LLM steps per question with and without past successful SQL retrieved as
+few-shot examples, see `SqlExampleIndex`.
+
+The index is warmed by answering each question in QUESTIONS once, then each paraphrase
+in PARAPHRASES is answered by a fresh agent with retrieval on and off. The answer cache
+is disabled so every paraphrase goes to the LLM. Needs OPENAI_API_KEY.
+
+    python -m experiments.few_shot_benchmark --file data/titanic.csv
+"""
+import argparse
+import statistics
+
+from qabot import Agent, Settings, create_duckdb, import_into_duckdb_from_files
+
+QUESTIONS = [
+    "How many passengers survived in each class?",
+    "What was the average fare paid by women who survived?",
+    "Which port of embarkation had the highest survival rate?",
+    "How many children under 12 were on board, and how many survived?",
+    "What is the survival rate by sex and class?",
+]
+PARAPHRASES = [
+    "Count the survivors per passenger class",
+    "Average ticket fare of female survivors?",
+    "Survival rate for each embarkation port, highest first",
+    "Number of passengers younger than 12 and how many of them survived",
+    "Break down the survival rate by class and sex",
+]
+
+
+def run(conn, models, question: str, few_shot_examples: int) -> int:
+    agent = Agent(
+        database_engine=conn,
+        models=models,
+        few_shot_examples=few_shot_examples,
+        answer_cache_threshold=None,
+    )
+    agent(question)
+    return agent.last_iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", default="data/titanic.csv")
+    parser.add_argument("--examples", type=int, default=3)
+    args = parser.parse_args()
+
+    models = Settings().agent_model
+    conn = create_duckdb()
+    import_into_duckdb_from_files(conn, [args.file])
+
+    for question in QUESTIONS:
+        run(conn, models, question, args.examples)
+
+    iterations = {"without": [], "with": []}
+    for question in PARAPHRASES:
+        iterations["without"].append(run(conn, models, question, 0))
+        iterations["with"].append(run(conn, models, question, args.examples))
+
+    for label, counts in iterations.items():
+        print(f"{label} retrieval: {statistics.mean(counts):.2f} steps per question (median {statistics.median(counts)})")
+    print(f"{conn.sql('select count(*) from qabot_sql_examples').fetchone()[0]} examples indexed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Load test: a high cardinality aggregation far larger than the memory limit should
+spill to disk and complete, rather than fail with an out of memory error.
+
+    python -m experiments.spill_load_test --memory-limit 200MB --rows 40000000
+"""
+import argparse
+import tempfile
+import time
+
+from qabot.functions.data_loader import create_duckdb
+from qabot.functions.duckdb_query import run_sql_catch_error
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--memory-limit", default="200MB")
+    parser.add_argument("--rows", type=int, default=40_000_000)
+    parser.add_argument("--threads", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        conn = create_duckdb(
+            memory_limit=args.memory_limit,
+            threads=args.threads,
+            temp_directory=temp_directory,
+            preserve_insertion_order=False,
+        )
+        sql = (
+            f"select count(*) as groups, sum(total) as total from ("
+            f"select i % {args.rows // 2} as k, sum(i) as total, list(i) as members "
+            f"from range({args.rows}) t(i) group by k)"
+        )
+        start = time.perf_counter()
+        output = run_sql_catch_error(conn, sql)
+        seconds = time.perf_counter() - start
+        peak_memory, spill_bytes = conn.sql(
+            "select peak_memory_bytes, spill_bytes from qabot_queries order by timestamp desc limit 1"
+        ).fetchone()
+
+    print(output)
+    print(f"{seconds:.1f}s, peak memory {peak_memory / 1_000_000:,.1f} MB, spilled {spill_bytes / 1_000_000:,.1f} MB")
+    assert "Error" not in output, "The aggregation failed instead of spilling"
+    assert spill_bytes > 0, "The aggregation didn't spill, try more rows or a lower memory limit"
+
+
+if __name__ == "__main__":
+    main()
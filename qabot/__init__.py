@@ -1,6 +1,7 @@
 from typing import Optional
 
 from qabot.agent import Agent, AgentModelConfig
+from qabot.answer_store import SavedAnswer, llm_repair, load_answer, rerun_answer, save_answer
 from qabot.config import Settings
 from qabot.functions.data_loader import create_duckdb, import_into_duckdb_from_files
 
@@ -35,3 +36,18 @@ def ask_database(query: str, uri: str, model_name=None, context=None, verbose=Fa
     agent = Agent(database_engine=database_engine, models=model_config, prompt_context=context, verbose=verbose)
     result = agent(query)
     return result["summary"]
+
+
+def rerun(name: str, model_name=None) -> str:
+    """
+    Re-run an answer saved with `save_answer` (or /save) against the latest data, and
+    return its filled in result template. The LLM is only used if the saved SQL fails.
+    """
+    settings = Settings()
+    answer = load_answer(name, settings.QABOT_ANSWER_STORE_DIR)
+    engine = create_duckdb(answer.database_uri or ":memory:")
+    model_config = settings.agent_model
+    if model_name is not None:
+        model_config.default_model_name = model_name
+    result = rerun_answer(name, engine, repair=llm_repair(model_config), directory=settings.QABOT_ANSWER_STORE_DIR)
+    return result.output
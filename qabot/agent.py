@@ -1,25 +1,28 @@
 import json
-import textwrap
-from typing import Callable, List
+import time
+from datetime import timedelta
+from typing import Callable
 from pydantic import BaseModel
 from openai.types.chat import (
     ChatCompletionSystemMessageParam,
     ChatCompletionToolMessageParam,
-    ChatCompletionMessageParam, ChatCompletionMessageToolCallParam, ChatCompletionAssistantMessageParam,
 )
-from openai.types.chat.chat_completion_message_tool_call import Function
 from openai import RateLimitError, OpenAI
 from rich import print
 
+from qabot.answer_cache import AnswerCache
 from qabot.config import AgentModelConfig
 from qabot.formatting import format_robot, format_duck, format_user
-from qabot.functions import get_function_specifications
-from qabot.functions.data_loader import import_into_duckdb_from_files
+from qabot.functions.data_loader import load_sources
 from qabot.functions.describe_duckdb_table import describe_table_or_view
-from qabot.functions.duckdb_query import run_sql_catch_error
+from qabot.functions.duckdb_query import export_result, run_exploratory_sql, run_sql_catch_error
 from qabot.functions.wikidata import WikiDataQueryTool
 from qabot.llm import chat_completion_request
-from qabot.prompts.system import system_prompt, research_prompt
+from qabot.model_router import ModelRouter, RoutedStep, is_error_output
+from qabot.prefetch import SpeculativeExecutor
+from qabot.session_template import SHOW_TABLES_SQL, SessionTemplate
+from qabot.sql_examples import SqlExampleIndex
+from qabot.prompts.system import research_prompt
 
 
 class Agent:
@@ -39,113 +42,95 @@ class Agent:
             verbose=False,
             max_iterations: int = 20,
             openai_client: OpenAI = None,
+            exploration_sample_rows: int | None = None,
+            wikidata_cache_ttl: timedelta = timedelta(days=1),
+            prefetch_per_question: int = 6,
+            answer_cache_threshold: float | None = None,
+            answer_cache_max_entries: int = 1000,
+            few_shot_examples: int = 0,
     ):
         """
         Create a new Agent.
+
+        With `exploration_sample_rows`, exploratory SQL reads samples of that many rows from
+        large sources (see `load_sources`) and only the final answer's query is run against
+        the full data.
+
+        Wikidata results are cached for `wikidata_cache_ttl` and landed in tables of the
+        database, see `WikiDataQueryTool`.
+
+        While waiting for the LLM, up to `prefetch_per_question` tables it is likely to
+        describe next are described in the background, see `SpeculativeExecutor`. 0 disables this.
+
+        With an `answer_cache_threshold`, questions at least that similar to one answered
+        before are answered from the cache while the data is unchanged, see `AnswerCache`.
+
+        With `few_shot_examples`, up to that many past questions similar to each new one are
+        shown to the LLM with the SQL that answered them, see `SqlExampleIndex`.
         """
         self.max_iterations = max_iterations
+        self.exploration_sample_rows = exploration_sample_rows
+        self.exploration_sampling = exploration_sample_rows is not None
         self.model_name = models.default_model_name
         self.planning_model_name = models.planning_model_name
         self.db = database_engine
         self.verbose = verbose
+        # Routes each step to a model tier, and records latency and success per tier
+        self.router = ModelRouter(models, database_engine, max_iterations)
         if verbose:
             print(
                 format_robot(
-                    f"Default model: {models.default_model_name}, Thinking model: {models.planning_model_name}. Max LLM/function iterations before answer {max_iterations}"
+                    f"Fast model: {self.router.tier_models['fast']}, Default model: {models.default_model_name}, "
+                    f"Thinking model: {models.planning_model_name}, Escalation model: {self.router.tier_models['strong']}. "
+                    f"Max LLM/function iterations before answer {max_iterations}"
                 )
             )
+        wikidata = WikiDataQueryTool(database_engine, cache_ttl=wikidata_cache_ttl)
+        self.answer_cache = None
+        if database_engine is not None and answer_cache_threshold is not None:
+            self.answer_cache = AnswerCache(
+                database_engine, threshold=answer_cache_threshold, max_entries=answer_cache_max_entries
+            )
+        self.sql_examples = None
+        if database_engine is not None and few_shot_examples > 0:
+            self.sql_examples = SqlExampleIndex(database_engine, k=few_shot_examples)
+        self.prefetcher = None
+        if database_engine is not None and prefetch_per_question > 0:
+            self.prefetcher = SpeculativeExecutor(database_engine, max_per_question=prefetch_per_question)
         self.functions = {
             "terminate_session": terminate_session_callback,
             "clarify": clarification_callback,
-            "wikidata": lambda query: WikiDataQueryTool()._run(query),
-            "execute_sql": lambda query: run_sql_catch_error(database_engine, query),
-            "show_tables": lambda: run_sql_catch_error(database_engine,
-                                                       "select table_catalog, table_schema, table_name from system.information_schema.tables where table_schema != 'information_schema';"),
-            "describe_table": lambda table, **kwargs: describe_table_or_view(
-                database_engine, table, **kwargs
-            ),
+            "wikidata": lambda query: wikidata._run(query),
+            "execute_sql": lambda query: (run_exploratory_sql if self.exploration_sampling else run_sql_catch_error)(database_engine, query),
+            "show_tables": lambda: run_sql_catch_error(database_engine, SHOW_TABLES_SQL),
+            "describe_table": lambda table, **kwargs: (
+                self.prefetcher is not None and self.prefetcher.describe_table(table, **kwargs)
+            ) or describe_table_or_view(database_engine, table, **kwargs),
+            "export_result": lambda query, path: export_result(database_engine, query, path),
             "research": self.research_call,
-            "load_data": lambda files: "Imported with SQL:\n"
-                                       + str(import_into_duckdb_from_files(database_engine, files)[1]),
-        }
-        self.function_specifications = get_function_specifications(allow_wikidata, allow_research=True)
-
-        if clarification_callback is not None:
-            self.function_specifications.append(
-                {
-                    "name": "clarify",
-                    "description": textwrap.dedent(
-                        """Useful for when you need to ask the user a question to clarify their request.
-                        Input to this tool is a single question for the user. Output is the user's response.
-                        """
-                    ),
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "clarification": {
-                                "type": "string",
-                                "description": "A question or prompt for the user",
-                            },
-                        },
-                    },
-                }
-            )
-
-        if terminate_session_callback is not None:
-            self.function_specifications.append(
-                {
-                    "name": "terminate_session",
-                    "description": textwrap.dedent(
-                        """Indicate that the user has requested the session to be terminated.
-                        Prefer to clarify unclear requests or requests you cannot address rather than terminating a session immediately.
-                        """
-                    ),
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "message": {
-                                "type": "string",
-                                "description": "The final short message - usually saying goodbye",
-                            },
-                        },
-                    },
-                }
-            )
-
-        messages: List[ChatCompletionMessageParam] = [
-            ChatCompletionSystemMessageParam(
-                **{"role": "system", "content": system_prompt}
+            "load_data": lambda files: format_load_results(
+                load_sources(database_engine, files, sample_rows=exploration_sample_rows)
             ),
-
-            # Force the assistant to get the current tables
-            ChatCompletionAssistantMessageParam(
-                role="assistant",
-                content='',
-                tool_calls=[
-                    ChatCompletionMessageToolCallParam(
-                        type="function",
-                        id="show_tables",
-                        function=Function(name="show_tables", arguments="{}"),
-                    )
-                ],
-            ),
-        ]
-
-        messages.append(
-            ChatCompletionToolMessageParam(
-                **{
-                    "role": "tool",
-                    "tool_call_id": "show_tables",
-                    "content": execute_function_call(messages[-1]['tool_calls'][0]['function'], self.functions),
-                }
-            )
+        }
+        # The system prompt, tools and initial show_tables exchange are shared by agents of
+        # the same database state, and sent to the LLM as a byte-stable prefix
+        template = SessionTemplate.get(
+            database_engine,
+            allow_wikidata=allow_wikidata,
+            allow_clarify=clarification_callback is not None,
+            allow_terminate=terminate_session_callback is not None,
+            prompt_context=prompt_context,
+            exploration_sampling=self.exploration_sampling,
         )
-        if prompt_context is not None:
-            messages.append({"role": "user", "content": prompt_context})
-
-        self.messages = messages
+        self.function_specifications = list(template.function_specifications)
+        self.messages = list(template.messages)
 
         self.openai_client = openai_client or OpenAI()
+        # The last question and its answer, e.g. to save for re-running, see `save_answer`
+        self.last_question = None
+        self.last_answer = None
+        # LLM steps the last answer took
+        self.last_iterations = None
 
     def __call__(self, user_input):
         """
@@ -157,13 +142,40 @@ class Agent:
         """
         Run the LLM/function execution loop and return the final response.
         """
+        if self.prefetcher is not None:
+            # The data may have changed since the last question, e.g. refreshed or modified with /db
+            self.prefetcher.invalidate()
         self.messages.append({"role": "user", "content": user_input})
 
-        for _ in range(self.max_iterations):
-            is_final_answer, result = self.llm_step()
+        if self.answer_cache is not None:
+            cached = self.answer_cache.lookup(user_input)
+            if cached is not None:
+                # Keep the conversation consistent for follow up questions
+                self.messages.append({"role": "assistant", "content": json.dumps(cached.answer)})
+                answer = {**cached.answer, "note": cached.note()}
+                self.last_question, self.last_answer, self.last_iterations = user_input, answer, 0
+                return answer
+
+        if self.sql_examples is not None:
+            examples = self.sql_examples.retrieve(user_input)
+            if examples:
+                # Before the question, so the first step is still routed and prefetched as a reply to it
+                self.messages.insert(len(self.messages) - 1, {"role": "system", "content": SqlExampleIndex.prompt(examples)})
+
+        for iteration in range(self.max_iterations):
+            is_final_answer, result = self.llm_step(iteration=iteration)
 
             if is_final_answer:
-                return json.loads(result)
+                answer = json.loads(result)
+                if self.exploration_sampling and answer.get("query"):
+                    # Exploration used samples, so compute the actual result from the full data
+                    answer["query_result"] = run_sql_catch_error(self.db, answer["query"])
+                self.last_question, self.last_answer, self.last_iterations = user_input, answer, iteration + 1
+                if self.answer_cache is not None:
+                    self.answer_cache.store(user_input, answer)
+                if self.sql_examples is not None and answer.get("query"):
+                    self.sql_examples.add(user_input, answer["query"])
+                return answer
 
         # If we get here, we've hit the max number of iterations
         # Let's ask the LLM to summarize the errors/answer as best it can
@@ -176,20 +188,34 @@ class Agent:
             ]
         )
 
-        _, result = self.llm_step(forced_function_call={"name": "answer"})
+        _, result = self.llm_step(forced_function_call={"name": "answer"}, iteration=self.max_iterations)
+        self.last_iterations = self.max_iterations + 1
         return result
 
-    def llm_step(self, forced_function_call=None):
+    def llm_step(self, forced_function_call=None, iteration: int = 0):
         is_final_answer = False
         function_call_results = None
-
-        chat_response = chat_completion_request(
-            self.openai_client,
-            self.messages,
-            functions=self.function_specifications,
-            model=self.model_name,
-            function_call=forced_function_call,
-        )
+        step_failed = False
+
+        routed = self.router.route(self.messages, iteration, forced_function_call)
+        if self.prefetcher is not None:
+            # Runs in the background while the LLM request is in flight
+            self.prefetcher.speculate(self.messages)
+        if self.verbose:
+            print(format_robot(f"{routed.step} step using {routed.model}"))
+        start = time.perf_counter()
+        try:
+            chat_response = chat_completion_request(
+                self.openai_client,
+                self.messages,
+                functions=self.function_specifications,
+                model=routed.model,
+                function_call=forced_function_call,
+            )
+        except Exception:
+            self.router.record(routed, time.perf_counter() - start, success=False)
+            raise
+        latency = time.perf_counter() - start
 
         choice = chat_response.choices[0]
         message = choice.message
@@ -202,6 +228,7 @@ class Agent:
                 function_call_results = execute_function_call(
                     tool_call.function, self.functions, self.verbose
                 )
+                step_failed = step_failed or is_error_output(function_call_results)
 
                 # Inject a response message for the function call
                 self.messages.append(
@@ -219,11 +246,15 @@ class Agent:
                     print(format_response(function_call_results))
         if message.content is not None and self.verbose:
             print(format_robot(message.content))
+        # A step succeeds if the calls it made did, so escalations can be judged by whether they fix errors
+        self.router.record(routed, latency, success=not step_failed, usage=chat_response.usage)
         return is_final_answer, function_call_results
 
     def research_call(self, query):
         print("Research Time")
         # Now we use the planning LLM model
+        routed = RoutedStep(step="research", tier="planning", model=self.planning_model_name, iteration=0)
+        start = time.perf_counter()
         chat_response = chat_completion_request(
             self.openai_client,
             messages=[
@@ -241,6 +272,7 @@ class Agent:
                      ],
             model=self.planning_model_name
         )
+        self.router.record(routed, time.perf_counter() - start, success=True, usage=chat_response.usage)
 
         choice = chat_response.choices[0]
         message = choice.message
@@ -255,6 +287,15 @@ def create_agent_executor(**kwargs):
     return Agent(**kwargs)
 
 
+def format_load_results(results):
+    executed_sql = [sql for result in results for sql in result.executed_sql]
+    errors = [result.summary() for result in results if result.error is not None]
+    output = "Imported with SQL:\n" + str(executed_sql)
+    if errors:
+        output += "\n\n" + "\n".join(errors)
+    return output
+
+
 def execute_function_call(function, functions, verbose=False):
     function_name = function.name
     try:
@@ -0,0 +1,279 @@
+import hashlib
+import json
+import re
+from dataclasses import dataclass
+from datetime import datetime
+
+import duckdb
+
+from qabot.functions.data_loader import CACHE_DATABASE, source_fingerprint
+
+# Words that don't change what a question asks for
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "for", "to", "by", "per", "each", "every", "is", "are", "was", "were",
+    "be", "do", "does", "did", "there", "what", "which", "show", "me", "give", "list", "tell", "please", "i",
+    "we", "our", "my", "and", "with", "from", "have", "has", "can", "you", "it", "its", "that", "this",
+}
+# Common phrasings of the same request, replaced before tokenising
+PHRASES = [
+    (re.compile(r"\b(how many|number of|count of)\b"), "count"),
+    (re.compile(r"\b(average|mean)\b"), "avg"),
+    (re.compile(r"\b(total|sum of)\b"), "sum"),
+    (re.compile(r"\b(largest|biggest|highest|most)\b"), "max"),
+    (re.compile(r"\b(smallest|lowest|least|fewest)\b"), "min"),
+]
+# Words that change the answer however similar the rest of the question is
+NEGATIONS = {"not", "no", "without", "excluding", "except", "never", "none", "non", "neither", "nor"}
+NUMBER_WORDS = {
+    "zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten",
+    "eleven", "twelve", "twenty", "hundred", "thousand", "million", "billion", "first", "second",
+    "third", "last", "top", "bottom",
+}
+# Mersenne prime modulus of the MinHash permutations
+_PRIME = (1 << 61) - 1
+
+
+def normalise_question(question: str) -> list[str]:
+    """
+    Lower case, drop punctuation and stopwords, unify common phrasings and strip plurals.
+    """
+    text = question.lower()
+    for pattern, replacement in PHRASES:
+        text = pattern.sub(replacement, text)
+    tokens = []
+    for word in re.findall(r"[a-z0-9_]+", text):
+        if word in STOPWORDS:
+            continue
+        tokens.append(_singular(word))
+    return tokens
+
+
+def _singular(word: str) -> str:
+    if len(word) <= 3 or not word.endswith("s") or word.endswith(("ss", "us", "is")):
+        return word
+    if word.endswith("ies") and len(word) > 4:
+        # countries -> country
+        return word[:-3] + "y"
+    if word.endswith(("sses", "xes", "ches", "shes", "zes")):
+        # classes -> class, boxes -> box
+        return word[:-2]
+    return word[:-1]
+
+
+def must_match(tokens: list[str]) -> set[str]:
+    """
+    The negations and numbers in a question, which a similar question must share exactly.
+    """
+    return {token for token in tokens if token in NEGATIONS or token in NUMBER_WORDS or token.isdigit()}
+
+
+def jaccard(first: set[str], second: set[str]) -> float:
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+class MinHash:
+    """
+    MinHash signatures of word shingles, whose agreement estimates the Jaccard similarity
+    of the shingle sets.
+    """
+
+    def __init__(self, num_permutations: int = 64, shingle_size: int = 1, seed: int = 1):
+        digest = hashlib.blake2b(f"qabot-minhash-{seed}".encode(), digest_size=64).digest()
+        # Deterministic permutation parameters, so signatures stored in one session match in the next
+        self._permutations = []
+        for i in range(num_permutations):
+            a = int.from_bytes(hashlib.blake2b(digest + bytes([i, 0]), digest_size=8).digest()) % _PRIME or 1
+            b = int.from_bytes(hashlib.blake2b(digest + bytes([i, 1]), digest_size=8).digest()) % _PRIME
+            self._permutations.append((a, b))
+        self.shingle_size = shingle_size
+
+    def shingles(self, tokens: list[str]) -> set[str]:
+        if len(tokens) < self.shingle_size:
+            return {" ".join(tokens)}
+        return {" ".join(tokens[i:i + self.shingle_size]) for i in range(len(tokens) - self.shingle_size + 1)}
+
+    def signature(self, tokens: list[str]) -> list[int]:
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest())
+            for shingle in self.shingles(tokens)
+        ]
+        return [min((a * h + b) % _PRIME for h in hashes) for a, b in self._permutations]
+
+    @staticmethod
+    def similarity(first: list[int], second: list[int]) -> float:
+        return sum(x == y for x, y in zip(first, second)) / len(first)
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: dict
+    similarity: float
+
+    def note(self) -> str:
+        return (
+            f"Answered from the answer cache: \"{self.question}\" was asked before "
+            f"({self.similarity:.0%} similar) and the data it used hasn't changed."
+        )
+
+
+class AnswerCache:
+    """
+    Serves answers to questions similar to ones answered before, while the data they were
+    computed from is unchanged.
+
+    Questions are normalised (see `normalise_question`) and compared by the exact Jaccard
+    similarity of their words; an answer is reused when the similarity is at
+    least `threshold` and both questions have the same negations and numbers (see
+    `must_match`), so "customers not in each country" never gets the answer to "customers
+    per country". Only answers with a query are cached, and they are invalid once any table the query
+    reads changes, see `data_fingerprint`. The least recently used answers beyond
+    `max_entries` are evicted. Answers are kept in the cache database if it is attached.
+    """
+
+    def __init__(
+            self,
+            duckdb_connection: duckdb.DuckDBPyConnection,
+            threshold: float = 0.85,
+            max_entries: int = 1000,
+    ):
+        self.db = duckdb_connection
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "stored": 0, "evicted": 0}
+
+        attached = duckdb_connection.execute(
+            "select count(*) from duckdb_databases() where database_name = ?", [CACHE_DATABASE]
+        ).fetchone()[0] > 0
+        self.table = f"{CACHE_DATABASE}.main.qabot_answer_cache" if attached else "qabot_answer_cache"
+        duckdb_connection.execute(
+            f"""create table if not exists {self.table}(
+                question_hash VARCHAR PRIMARY KEY,
+                question VARCHAR,
+                tokens VARCHAR[],
+                data_fingerprint VARCHAR,
+                answer VARCHAR,
+                created_at TIMESTAMP,
+                last_used_at TIMESTAMP,
+                hits INTEGER DEFAULT 0
+            );"""
+        )
+        # Cache databases from before questions were compared by their tokens
+        duckdb_connection.execute(f"alter table {self.table} add column if not exists tokens VARCHAR[]")
+
+    def lookup(self, question: str) -> CachedAnswer | None:
+        tokens = normalise_question(question)
+        words, required = set(tokens), must_match(tokens)
+        best = None
+        for question_hash, cached_question, cached_tokens, fingerprint, answer in self.db.execute(
+                f"select question_hash, question, tokens, data_fingerprint, answer from {self.table} where tokens is not null"
+        ).fetchall():
+            if must_match(cached_tokens) != required:
+                continue
+            similarity = jaccard(words, set(cached_tokens))
+            if similarity >= self.threshold and (best is None or similarity > best[0]):
+                best = (similarity, question_hash, cached_question, fingerprint, answer)
+
+        if best is None:
+            self.stats["misses"] += 1
+            return None
+        similarity, question_hash, cached_question, fingerprint, answer = best
+        answer = json.loads(answer)
+        if data_fingerprint(self.db, answer["query"]) != fingerprint:
+            # The data changed, so the answer is wrong from now on
+            self.db.execute(f"delete from {self.table} where question_hash = ?", [question_hash])
+            self.stats["stale"] += 1
+            self.stats["misses"] += 1
+            return None
+
+        self.db.execute(
+            f"update {self.table} set hits = hits + 1, last_used_at = ? where question_hash = ?",
+            [datetime.now(), question_hash],
+        )
+        self.stats["hits"] += 1
+        return CachedAnswer(cached_question, answer, similarity)
+
+    def store(self, question: str, answer: dict):
+        if not isinstance(answer, dict) or not answer.get("query"):
+            return
+        try:
+            fingerprint = data_fingerprint(self.db, answer["query"])
+        except duckdb.Error:
+            # Unparseable queries can't be tied to the data they read
+            return
+        tokens = normalise_question(question)
+        now = datetime.now()
+        self.db.execute(
+            f"""insert or replace into {self.table}
+            (question_hash, question, tokens, data_fingerprint, answer, created_at, last_used_at, hits)
+            values (?, ?, ?, ?, ?, ?, ?, 0)""",
+            [
+                hashlib.blake2b(" ".join(tokens).encode(), digest_size=16).hexdigest(),
+                question, tokens, fingerprint, json.dumps(answer), now, now,
+            ],
+        )
+        self.stats["stored"] += 1
+        self._evict()
+
+    def _evict(self):
+        evicted = self.db.execute(
+            f"""delete from {self.table} where question_hash in (
+                select question_hash from {self.table} order by last_used_at desc offset ?
+            ) returning question_hash""",
+            [self.max_entries],
+        ).fetchall()
+        self.stats["evicted"] += len(evicted)
+
+    def summary(self) -> str:
+        stats = self.stats
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups if lookups else 0.0
+        return (
+            f"Answer cache: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.0%} hit rate), "
+            f"{stats['stale']} invalidated by changed data, {stats['stored']} stored, {stats['evicted']} evicted"
+        )
+
+
+def data_fingerprint(duckdb_connection: duckdb.DuckDBPyConnection, query: str) -> str:
+    """
+    A digest of the data a query reads: the row count of each table, the definition of
+    each view (and the tables it reads, recursively) and the fingerprint of each loaded
+    file source.
+
+    Row counts are DuckDB's estimates, which are exact for its own tables, so in-place
+    updates that don't change the number of rows aren't detected.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    pending = sorted(duckdb.get_table_names(query, qualified=True))
+    seen = set()
+    while pending:
+        name = pending.pop(0)
+        if name in seen:
+            continue
+        seen.add(name)
+        *qualifiers, table_name = name.split(".")
+        table = duckdb_connection.execute(
+            "select database_name, schema_name, estimated_size from duckdb_tables() where table_name = ? "
+            "and (? is null or schema_name = ?) order by database_name = current_database() desc limit 1",
+            [table_name, qualifiers[-1] if qualifiers else None, qualifiers[-1] if qualifiers else None],
+        ).fetchone()
+        view = duckdb_connection.execute(
+            "select sql from duckdb_views() where view_name = ? and not internal limit 1", [table_name]
+        ).fetchone()
+        source = duckdb_connection.execute(
+            "select uri from qabot_sources where table_name = ?", [table_name]
+        ).fetchone() if _has_sources(duckdb_connection) else None
+        digest.update(f"{name}:{table}:{view}\n".encode())
+        if source is not None:
+            digest.update(f"{source[0]}={source_fingerprint(source[0])[0]}\n".encode())
+        if view is not None:
+            pending.extend(sorted(duckdb.get_table_names(view[0], qualified=True)))
+    return digest.hexdigest()
+
+
+def _has_sources(duckdb_connection: duckdb.DuckDBPyConnection) -> bool:
+    return duckdb_connection.execute(
+        "select count(*) from duckdb_tables() where table_name = 'qabot_sources'"
+    ).fetchone()[0] > 0
@@ -0,0 +1,223 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import string
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Callable
+
+import duckdb
+
+from qabot.agent import Agent
+from qabot.download_utils import get_cache_dir, write_json_atomic
+from qabot.functions.data_loader import CACHE_DATABASE, import_into_duckdb_from_files, source_fingerprint
+
+ANSWER_NAME = re.compile(r"^[\w.-]+$")
+# The fields a result template can use, see `SavedAnswer`
+TEMPLATE_FIELDS = ("value", "rows", "columns", "row_count", "result", "question", "name")
+
+
+@dataclass
+class SavedAnswer:
+    """
+    A question, the SQL that answered it and the sources it read, so the answer can be
+    recomputed against fresh data without the LLM.
+
+    `result_template` is a `str.format` template for the rerun result, with the fields
+    `{value}` (the first column of the first row), `{rows}`, `{columns}`, `{row_count}`,
+    `{result}` (the rendered result), `{question}` and `{name}`.
+    """
+    name: str
+    question: str
+    query: str
+    sources: list[str] = field(default_factory=list)
+    database_uri: str | None = None
+    result_template: str | None = None
+    summary: str | None = None
+    # Fingerprint of the sources when the answer was last computed, see `data_fingerprint`
+    data_fingerprint: str | None = None
+    saved_at: str | None = None
+    last_run_at: str | None = None
+
+
+@dataclass
+class RerunResult:
+    answer: SavedAnswer
+    columns: list[str]
+    rows: list[tuple]
+    output: str
+    # True if the sources changed since the answer was last computed
+    data_changed: bool
+    # True if the stored SQL failed and was replaced by a query from the LLM
+    repaired: bool = False
+
+
+def answer_store_dir(directory: str | None = None) -> str:
+    directory = directory or os.path.join(get_cache_dir("qabot"), "answers")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def data_fingerprint(sources: list[str]) -> str:
+    """
+    A digest of the fingerprints of all the sources, see `source_fingerprint`.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for source in sorted(sources):
+        digest.update(f"{source}={source_fingerprint(source)[0]}\n".encode())
+    return digest.hexdigest()
+
+
+def session_sources(duckdb_connection: duckdb.DuckDBPyConnection, query: str) -> tuple[list[str], str | None]:
+    """
+    The loaded sources a query reads from, and the path of the database if it's persistent.
+
+    Attached SQLite and Postgres databases are sources too, if the query reads any of their
+    tables (which the search path lets it do without naming the database).
+    """
+    try:
+        loaded = duckdb_connection.execute("select uri, table_name, attached from qabot_sources").fetchall()
+    except duckdb.Error:
+        loaded = []
+    try:
+        tables = {name.split(".")[-1].lower() for name in duckdb_connection.get_table_names(query)}
+    except duckdb.Error:
+        tables = set()
+    sources = []
+    for uri, table_name, attached in loaded:
+        if not table_name:
+            continue
+        if re.search(rf'(?<![\w"]){re.escape(table_name)}(?![\w"])', query, re.IGNORECASE):
+            sources.append(uri)
+        elif attached and duckdb_connection.execute(
+                "select count(*) from duckdb_tables() where database_name = ? and list_contains(?, lower(table_name))",
+                [table_name, list(tables)],
+        ).fetchone()[0]:
+            sources.append(uri)
+    # The search path puts attached databases first, so current_database() may be one of them
+    attached_databases = [table_name for _, table_name, attached in loaded if attached]
+    database_path = duckdb_connection.execute(
+        "select path from duckdb_databases() where not internal and database_name != ? "
+        "and not list_contains(?, database_name) order by database_oid limit 1",
+        [CACHE_DATABASE, attached_databases],
+    ).fetchone()
+    return sources, (database_path[0] if database_path else None) or None
+
+
+def validate_template(template: str):
+    """
+    Raise a ValueError naming the problem if `template` isn't a valid result template.
+    """
+    try:
+        fields = [field_name for _, field_name, _, _ in string.Formatter().parse(template) if field_name is not None]
+    except ValueError as e:
+        raise ValueError(f"Invalid result template {template!r}: {e}")
+    for field_name in fields:
+        if re.split(r"[.\[]", field_name, maxsplit=1)[0] not in TEMPLATE_FIELDS:
+            raise ValueError(
+                f"Unknown placeholder {{{field_name}}} in result template, use {', '.join(f'{{{f}}}' for f in TEMPLATE_FIELDS)}"
+            )
+
+
+def save_answer(answer: SavedAnswer, directory: str | None = None) -> SavedAnswer:
+    if not ANSWER_NAME.match(answer.name):
+        raise ValueError(f"Invalid answer name {answer.name!r}, use letters, digits, '.', '_' and '-'")
+    if answer.result_template is not None:
+        validate_template(answer.result_template)
+    answer.saved_at = answer.saved_at or datetime.now().isoformat(timespec="seconds")
+    if answer.data_fingerprint is None:
+        answer.data_fingerprint = data_fingerprint(answer.sources)
+    write_json_atomic(os.path.join(answer_store_dir(directory), f"{answer.name}.json"), asdict(answer))
+    return answer
+
+
+def load_answer(name: str, directory: str | None = None) -> SavedAnswer:
+    path = os.path.join(answer_store_dir(directory), f"{name}.json")
+    if not ANSWER_NAME.match(name) or not os.path.exists(path):
+        raise ValueError(f"No saved answer named {name!r}")
+    with open(path) as f:
+        return SavedAnswer(**json.load(f))
+
+
+def list_answers(directory: str | None = None) -> list[SavedAnswer]:
+    answers = []
+    for path in sorted(glob.glob(os.path.join(answer_store_dir(directory), "*.json"))):
+        with open(path) as f:
+            answers.append(SavedAnswer(**json.load(f)))
+    return answers
+
+
+def rerun_answer(
+        name: str,
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        repair: Callable[[SavedAnswer, str, duckdb.DuckDBPyConnection], str | None] | None = None,
+        directory: str | None = None,
+        **load_options,
+) -> RerunResult:
+    """
+    Re-execute a saved answer's SQL against the current data of its sources.
+
+    The sources are (re)loaded into `duckdb_connection` with `load_options` (see
+    `load_sources`). Only if the SQL fails, e.g. because a source's schema changed, is
+    `repair` called with the error to get a new query (see `llm_repair`), which replaces
+    the stored one.
+    """
+    answer = load_answer(name, directory)
+    if answer.sources:
+        import_into_duckdb_from_files(duckdb_connection, answer.sources, **load_options)
+    fingerprint = data_fingerprint(answer.sources)
+
+    repaired = False
+    try:
+        relation = duckdb_connection.sql(answer.query)
+    except duckdb.Error as e:
+        if repair is None:
+            raise
+        query = repair(answer, str(e), duckdb_connection)
+        if not query:
+            raise
+        relation = duckdb_connection.sql(query)
+        answer.query = query
+        repaired = True
+    columns = list(relation.columns) if relation is not None else []
+    rows = relation.fetchall() if relation is not None else []
+
+    result = ",".join(columns) + "\n" + "\n".join(",".join(str(value) for value in row) for row in rows)
+    template = answer.result_template or "{result}"
+    try:
+        output = template.format(
+            value=rows[0][0] if rows and rows[0] else None,
+            rows=rows,
+            columns=columns,
+            row_count=len(rows),
+            result=result,
+            question=answer.question,
+            name=answer.name,
+        )
+    except (KeyError, IndexError, AttributeError, TypeError, ValueError) as e:
+        # e.g. a format spec that doesn't suit the value, or an answer saved before templates were validated
+        raise ValueError(f"Couldn't render the result template {template!r}: {e!r}")
+
+    data_changed = fingerprint != answer.data_fingerprint
+    answer.data_fingerprint = fingerprint
+    answer.last_run_at = datetime.now().isoformat(timespec="seconds")
+    save_answer(answer, directory)
+    return RerunResult(answer, columns, rows, output, data_changed, repaired)
+
+
+def llm_repair(models, openai_client=None) -> Callable[[SavedAnswer, str, duckdb.DuckDBPyConnection], str | None]:
+    """
+    A `repair` for `rerun_answer` that asks the agent to answer the question again given the error.
+    """
+    def repair(answer: SavedAnswer, error: str, duckdb_connection: duckdb.DuckDBPyConnection) -> str | None:
+        agent = Agent(database_engine=duckdb_connection, models=models, openai_client=openai_client)
+        result = agent(
+            f"{answer.question}\n\nThis was previously answered with the SQL below, which now fails with "
+            f"\"{error}\", probably because the schema of the data changed. Answer again, including the "
+            f"corrected SQL in the answer's `query`.\n\n{answer.query}"
+        )
+        return result.get("query") if isinstance(result, dict) else None
+
+    return repair
@@ -0,0 +1,329 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass
+from datetime import datetime
+
+import duckdb
+
+from qabot.download_utils import get_cache_dir, write_json_atomic
+from qabot.functions.data_loader import refresh_sources
+from qabot.model_router import message_field
+
+# Statements that write to an existing table, and the table they write to
+WRITE_STATEMENT = re.compile(
+    r"^\s*(?:insert\s+(?:or\s+\w+\s+)?into|update|delete\s+from|truncate(?:\s+table)?|alter\s+table|copy|"
+    r"create\s+(?:or\s+replace\s+)?table(?:\s+if\s+not\s+exists)?)\s+\"?([\w.]+?)\"?(?:\s|\(|;|$)",
+    re.IGNORECASE,
+)
+SESSION_NAME = re.compile(r"^[\w.-]+$")
+
+
+@dataclass
+class CheckpointStats:
+    messages_written: int
+    tables_written: int
+    tables_unchanged: int
+    bytes_written: int
+    seconds: float
+
+
+def checkpoint_dir(directory: str | None = None) -> str:
+    directory = directory or os.path.join(get_cache_dir("qabot"), "sessions")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def list_sessions(directory: str | None = None) -> list[tuple[str, dict]]:
+    """
+    The saved sessions and their manifests, most recently checkpointed first.
+    """
+    sessions = []
+    for name in os.listdir(checkpoint_dir(directory)):
+        manifest_path = os.path.join(checkpoint_dir(directory), name, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                sessions.append((name, json.load(f)))
+    return sorted(sessions, key=lambda session: session[1].get("checkpointed_at") or "", reverse=True)
+
+
+def prune_sessions(
+        max_sessions: int | None,
+        max_bytes: int | None,
+        keep: tuple[str, ...] = (),
+        directory: str | None = None,
+        grace_seconds: float = 24 * 60 * 60,
+) -> list[str]:
+    """
+    Delete the least recently checkpointed sessions beyond `max_sessions` or `max_bytes` in
+    total, along with any session that was never checkpointed and hasn't been touched for
+    `grace_seconds` (a newer one may belong to a qabot that is still running). Sessions in
+    `keep` are never deleted. Returns the names of the deleted sessions.
+    """
+    root = checkpoint_dir(directory)
+    sessions = [name for name, _ in list_sessions(directory)]
+    cutoff = time.time() - grace_seconds
+    deleted = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name in sessions or name in keep or not os.path.isdir(path):
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                deleted.append(name)
+        except FileNotFoundError:
+            pass
+    total_bytes = 0
+    kept = 0
+    for name in sessions:
+        path = os.path.join(root, name)
+        size = sum(
+            os.path.getsize(os.path.join(directory_path, file_name))
+            for directory_path, _, file_names in os.walk(path) for file_name in file_names
+        )
+        if name in keep or (
+                (max_sessions is None or kept < max_sessions)
+                and (max_bytes is None or total_bytes + size <= max_bytes)
+        ):
+            kept += 1
+            total_bytes += size
+        else:
+            deleted.append(name)
+    for name in deleted:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    return deleted
+
+
+class SessionCheckpoint:
+    """
+    Checkpoints an agent's conversation, its last answer and the scratch tables of an
+    in-memory database, so a session survives a crash or Ctrl-C and resumes without
+    replaying any LLM calls.
+
+    Each checkpoint only writes what changed since the last one: new messages are appended
+    to `messages.jsonl`, and a table is rewritten as Parquet only if its definition or row
+    count changed or a logged statement wrote to it (see `WRITE_STATEMENT`). Views are kept
+    as their SQL. `manifest.json` is replaced last, so a checkpoint interrupted part way
+    leaves the previous one intact. Tables of persistent databases aren't copied; resuming
+    reopens the database. Nor are unmodified tables loaded from sources, resuming loads them
+    from their source again (see `refresh_sources`).
+    """
+
+    def __init__(self, session: str, directory: str | None = None):
+        if not SESSION_NAME.match(session):
+            raise ValueError(f"Invalid session name {session!r}, use letters, digits, '.', '_' and '-'")
+        self.session = session
+        self.path = os.path.join(checkpoint_dir(directory), session)
+        os.makedirs(os.path.join(self.path, "tables"), exist_ok=True)
+        self._dropped_files = []
+        self.manifest = {
+            "session": session,
+            "database_uri": None,
+            "messages": 0,
+            "messages_bytes": 0,
+            "queries": 0,
+            "tables": {},
+            "sources": [],
+            "views": [],
+            "state": {},
+            "checkpointed_at": None,
+        }
+        manifest_path = os.path.join(self.path, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest.update(json.load(f))
+
+    @property
+    def exists(self) -> bool:
+        return self.manifest["checkpointed_at"] is not None
+
+    def save(self, agent) -> CheckpointStats:
+        start = time.perf_counter()
+        # In case it was pruned, e.g. by another qabot while this session sat idle
+        os.makedirs(os.path.join(self.path, "tables"), exist_ok=True)
+        messages_written, bytes_written = self._save_messages(agent.messages)
+        tables_written = tables_unchanged = 0
+        if agent.db is not None:
+            database_uri = agent.db.execute(
+                "select path from duckdb_databases() where database_name = current_database()"
+            ).fetchone()[0]
+            self.manifest["database_uri"] = database_uri
+            if not database_uri:
+                tables_written, tables_unchanged, table_bytes = self._save_tables(agent.db)
+                bytes_written += table_bytes
+        self.manifest["state"] = {
+            "last_question": agent.last_question,
+            "last_answer": agent.last_answer,
+            "last_iterations": agent.last_iterations,
+        }
+        self.manifest["checkpointed_at"] = datetime.now().isoformat(timespec="seconds")
+        write_json_atomic(os.path.join(self.path, "manifest.json"), self.manifest)
+        for file in self._dropped_files:
+            try:
+                os.remove(os.path.join(self.path, "tables", file))
+            except FileNotFoundError:
+                pass
+        self._dropped_files = []
+        return CheckpointStats(messages_written, tables_written, tables_unchanged, bytes_written, time.perf_counter() - start)
+
+    def restore(self, agent):
+        """
+        Restore the checkpointed tables and views into the agent's database, then its
+        conversation and last answer.
+        """
+        if agent.db is not None and not self.manifest["database_uri"]:
+            self._restore_tables(agent.db)
+            if self.manifest["sources"]:
+                refresh_sources(agent.db, tables=self.manifest["sources"], sample_rows=agent.exploration_sample_rows)
+
+        if self.manifest["messages"]:
+            with open(os.path.join(self.path, "messages.jsonl"), "rb") as f:
+                data = f.read(self.manifest["messages_bytes"])
+            agent.messages = [json.loads(line) for line in data.splitlines()]
+        state = self.manifest["state"]
+        agent.last_question = state.get("last_question")
+        agent.last_answer = state.get("last_answer")
+        agent.last_iterations = state.get("last_iterations")
+
+    def _save_messages(self, messages) -> tuple[int, int]:
+        messages = messages[:_complete_turns(messages)]
+        if len(messages) < self.manifest["messages"]:
+            # A different conversation, start over
+            self.manifest["messages"] = self.manifest["messages_bytes"] = 0
+        new_messages = messages[self.manifest["messages"]:]
+        data = b"".join(
+            json.dumps(message, default=_to_json, separators=(",", ":")).encode() + b"\n" for message in new_messages
+        )
+        path = os.path.join(self.path, "messages.jsonl")
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            # Drop anything a previous interrupted checkpoint wrote after the last complete one
+            f.seek(self.manifest["messages_bytes"])
+            f.truncate()
+            f.write(data)
+        self.manifest["messages"] = len(messages)
+        self.manifest["messages_bytes"] += len(data)
+        return len(new_messages), len(data)
+
+    def _save_tables(self, duckdb_connection: duckdb.DuckDBPyConnection) -> tuple[int, int, int]:
+        written_to = self._tables_written_to(duckdb_connection)
+        sources = self._source_tables(duckdb_connection)
+        previous = self.manifest["tables"]
+        tables = {}
+        source_tables = []
+        tables_written = tables_unchanged = bytes_written = 0
+        for schema, table, estimated_size, sql in duckdb_connection.execute(
+                "select schema_name, table_name, estimated_size, sql from duckdb_tables() "
+                "where database_name = current_database() and not temporary order by table_oid"
+        ).fetchall():
+            key = f"{schema}.{table}"
+            # Unless they were modified, which makes them scratch tables from then on
+            if schema == "main" and table.lower() in sources and table.lower() not in written_to and key not in previous:
+                source_tables.append(table)
+                continue
+            entry = {"schema": schema, "table": table, "sql": sql, "estimated_size": estimated_size}
+            entry["file"] = hashlib.blake2b(key.encode(), digest_size=8).hexdigest() + ".parquet"
+            path = os.path.join(self.path, "tables", entry["file"])
+            unchanged = (
+                previous.get(key, {}).get("sql") == sql
+                and previous[key]["estimated_size"] == estimated_size
+                and table.lower() not in written_to
+                and os.path.exists(path)
+            )
+            if unchanged:
+                tables_unchanged += 1
+            else:
+                tmp_path = f"{path}.tmp"
+                duckdb_connection.execute(f'copy "{schema}"."{table}" to \'{tmp_path}\' (format parquet)')
+                os.replace(tmp_path, path)
+                tables_written += 1
+                bytes_written += os.path.getsize(path)
+            tables[key] = entry
+
+        # Files of dropped tables are removed once the manifest no longer refers to them
+        self._dropped_files = [entry["file"] for key, entry in previous.items() if key not in tables]
+        self.manifest["tables"] = tables
+        self.manifest["sources"] = source_tables
+        self.manifest["views"] = [
+            {"schema": schema, "view": view, "sql": sql}
+            for schema, view, sql in duckdb_connection.execute(
+                "select schema_name, view_name, sql from duckdb_views() "
+                "where database_name = current_database() and not internal and not temporary order by view_oid"
+            ).fetchall()
+        ]
+        return tables_written, tables_unchanged, bytes_written
+
+    @staticmethod
+    def _source_tables(duckdb_connection: duckdb.DuckDBPyConnection) -> set[str]:
+        try:
+            return {
+                table_name.lower() for (table_name,) in duckdb_connection.execute(
+                    "select table_name from qabot_sources where not attached"
+                ).fetchall()
+            }
+        except duckdb.Error:
+            return set()
+
+    def _tables_written_to(self, duckdb_connection: duckdb.DuckDBPyConnection) -> set[str]:
+        """
+        The tables logged statements wrote to since the last checkpoint.
+        """
+        try:
+            queries = duckdb_connection.execute("select query from qabot_queries order by rowid").fetchall()
+        except duckdb.Error:
+            return set()
+        if len(queries) < self.manifest["queries"]:
+            self.manifest["queries"] = 0
+        written_to = set()
+        for (query,) in queries[self.manifest["queries"]:]:
+            match = WRITE_STATEMENT.match(query)
+            if match:
+                written_to.add(match.group(1).split(".")[-1].lower())
+        self.manifest["queries"] = len(queries)
+        return written_to
+
+    def _restore_tables(self, duckdb_connection: duckdb.DuckDBPyConnection):
+        for entry in self.manifest["tables"].values():
+            path = os.path.join(self.path, "tables", entry["file"])
+            duckdb_connection.execute(f'create schema if not exists "{entry["schema"]}"')
+            _drop_relation(duckdb_connection, entry["schema"], entry["table"])
+            duckdb_connection.execute(entry["sql"])
+            duckdb_connection.execute(
+                f'insert into "{entry["schema"]}"."{entry["table"]}" select * from read_parquet(?)', [path]
+            )
+        for entry in self.manifest["views"]:
+            _drop_relation(duckdb_connection, entry["schema"], entry["view"])
+            duckdb_connection.execute(entry["sql"])
+
+
+def _drop_relation(duckdb_connection: duckdb.DuckDBPyConnection, schema: str, name: str):
+    try:
+        duckdb_connection.execute(f'drop view if exists "{schema}"."{name}";')
+    except duckdb.CatalogException:
+        duckdb_connection.execute(f'drop table if exists "{schema}"."{name}";')
+
+
+def _complete_turns(messages) -> int:
+    """
+    The number of leading messages in which every tool call has its result, so a
+    conversation interrupted mid-step resumes at the last consistent point.
+    """
+    pending = set()
+    complete = 0
+    for i, message in enumerate(messages):
+        if message_field(message, "role") == "tool":
+            pending.discard(message_field(message, "tool_call_id"))
+        for tool_call in message_field(message, "tool_calls") or []:
+            pending.add(message_field(tool_call, "id"))
+        if not pending:
+            complete = i + 1
+    return complete
+
+
+def _to_json(value):
+    # OpenAI response messages and their tool calls are pydantic models
+    if hasattr(value, "model_dump"):
+        return value.model_dump(exclude_none=True)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
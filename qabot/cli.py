@@ -1,14 +1,24 @@
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
 from typing import List, Optional
 import warnings
 from openai import OpenAI
+import duckdb
 import typer
 from rich import print
 from rich.progress import Progress, SpinnerColumn, TextColumn
 from rich.prompt import Confirm, Prompt
-import httpx
-
+from qabot.answer_store import SavedAnswer, llm_repair, load_answer, rerun_answer, save_answer, session_sources
+from qabot.checkpoint import SessionCheckpoint, prune_sessions
 from qabot.config import Settings
-from qabot.functions.data_loader import import_into_duckdb_from_files, create_duckdb
+from qabot.functions.data_loader import attach_cache_database, import_into_duckdb_from_files, create_duckdb, refresh_sources
+from qabot.extensions import extension_timings
+from qabot.http_client import configure_http_client, get_client
+from qabot.ingest_cache import IngestCache
+from qabot.postgres_cache import configure_postgres_cache
+from qabot.remote_cache import configure_remote_caching, remote_cache_stats
 from qabot.agent import Agent
 from qabot.formatting import (
     format_duck,
@@ -23,15 +33,54 @@ from qabot.prompts import INITIAL_NON_INTERACTIVE_PROMPT, FOLLOW_UP_PROMPT
 warnings.filterwarnings("ignore")
 
 app = typer.Typer(pretty_exceptions_show_locals=False, pretty_exceptions_enable=False)
+rerun_app = typer.Typer(pretty_exceptions_show_locals=False, pretty_exceptions_enable=False)
+SESSION_START = datetime.now()
 
 
 def handle_db(agent, arg: str):
+    if agent.prefetcher is not None:
+        agent.prefetcher.invalidate()
     try:
         result = agent.functions["execute_sql"](query=arg)
         print(result)
     except Exception as e:
         print(f"[red]Error executing SQL: {e}[/red]")
 
+def handle_export(agent, arg: str):
+    # The path is the last word, everything before it is the query
+    sql, _, path = arg.strip().rpartition(" ")
+    if not sql or not path:
+        print("[red]Usage: /export <SQL> <path>[/red]")
+        return
+    print(format_duck(agent.functions["export_result"](query=sql, path=path.strip("'\""))))
+
+def handle_save(agent, arg: str):
+    name, _, template = arg.strip().partition(" ")
+    if not name:
+        print("[red]Usage: /save <name> [result template][/red]")
+        return
+    if not agent.last_answer or not agent.last_answer.get("query"):
+        print("[red]There is no answer with a query to save yet[/red]")
+        return
+    sources, database_uri = session_sources(agent.db, agent.last_answer["query"])
+    try:
+        save_answer(
+            SavedAnswer(
+                name=name,
+                question=agent.last_question,
+                query=agent.last_answer["query"],
+                sources=sources,
+                database_uri=database_uri,
+                result_template=template.strip() or None,
+                summary=agent.last_answer.get("summary"),
+            ),
+            Settings().QABOT_ANSWER_STORE_DIR,
+        )
+    except ValueError as e:
+        print(f"[red]{e}[/red]")
+        return
+    print(format_duck(f"Saved the answer as {name}, re-run it with `qabot rerun {name}`"))
+
 def handle_describe(agent, arg: str):
     try:
         result = agent.functions["describe_table"](table=arg)
@@ -39,9 +88,46 @@ def handle_describe(agent, arg: str):
     except Exception as e:
         print(f"[red]Error describing table: {e}[/red]")
 
+def handle_stats(agent, arg: str):
+    stats = remote_cache_stats(agent.db, since=SESSION_START)
+    print(format_duck(
+        f"Remote data this session: {stats['http_requests']:,} HTTP requests, "
+        f"{stats['bytes_fetched'] / 1_000_000:,.1f} MB fetched, "
+        f"{stats['bytes_scanned'] / 1_000_000:,.1f} MB scanned, "
+        f"{stats['bytes_from_cache'] / 1_000_000:,.1f} MB served from cache"
+    ))
+    peak_memory, spill_bytes = agent.db.execute(
+        "select coalesce(max(peak_memory_bytes), 0), coalesce(max(spill_bytes), 0) from qabot_queries where timestamp >= ?",
+        [SESSION_START],
+    ).fetchone()
+    print(format_duck(
+        f"Queries this session peaked at {peak_memory / 1_000_000:,.1f} MB of memory "
+        f"and {spill_bytes / 1_000_000:,.1f} MB spilled to disk"
+    ))
+    if agent.answer_cache is not None:
+        print(format_duck(agent.answer_cache.summary()))
+    if agent.prefetcher is not None:
+        print(format_duck(agent.prefetcher.summary()))
+    for tier, tier_stats in agent.router.summary().items():
+        print(format_duck(
+            f"{tier.capitalize()} model ({tier_stats['model']}): {tier_stats['steps']} steps, "
+            f"{tier_stats['success_rate']:.0%} succeeded, {tier_stats['mean_latency_ms'] / 1000:,.1f}s on average"
+        ))
+
+def handle_refresh(agent, arg: str):
+    results = refresh_sources(agent.db, tables=arg.split() or None, sample_rows=agent.exploration_sample_rows)
+    if results and agent.prefetcher is not None:
+        agent.prefetcher.invalidate()
+    if not results:
+        print(format_duck("All sources are up to date"))
+
 def handle_help(agent, arg: str):
     print("Available commands:")
     print("  /db <SQL>         Execute SQL directly on DuckDB")
+    print("  /export <SQL> <path> Write query results to a Parquet, CSV or JSON file")
+    print("  /stats            Show remote data fetched vs served from cache, peak memory use and model tier performance")
+    print("  /refresh [tables] Load data appended to file sources since they were loaded")
+    print("  /save <name> [template] Save the last answer to re-run with `qabot rerun <name>`")
     print("  /help             Show this help message")
     print("  /exit             Exit the CLI")
     print("Anything else is sent to the LLM")
@@ -50,10 +136,47 @@ def handle_help(agent, arg: str):
 # Create a command registry
 COMMAND_HANDLERS = {
     "db": handle_db,
+    "export": handle_export,
+    "stats": handle_stats,
+    "refresh": handle_refresh,
+    "save": handle_save,
     "help": handle_help,
     "exit": lambda agent, arg: exit(0),
 }
 
+def _create_database(settings: Settings, database_uri: str):
+    # Shared by questions and `qabot rerun`
+    database_engine = create_duckdb(
+        database_uri,
+        extension_directory=settings.QABOT_EXTENSION_DIRECTORY,
+        extension_repository=settings.QABOT_EXTENSION_REPOSITORY,
+        memory_limit=settings.QABOT_MEMORY_LIMIT,
+        threads=settings.QABOT_THREADS,
+        temp_directory=settings.QABOT_TEMP_DIRECTORY,
+        max_temp_directory_size=settings.QABOT_MAX_TEMP_DIRECTORY_SIZE,
+        preserve_insertion_order=settings.QABOT_PRESERVE_INSERTION_ORDER,
+    )
+    attach_cache_database(database_engine, settings.QABOT_CACHE_DATABASE_URI)
+    configure_remote_caching(
+        database_engine,
+        http_metadata_cache=settings.QABOT_HTTP_METADATA_CACHE,
+        object_cache=settings.QABOT_OBJECT_CACHE,
+        external_file_cache=settings.QABOT_EXTERNAL_FILE_CACHE,
+        block_cache=settings.QABOT_REMOTE_BLOCK_CACHE,
+        block_cache_dir=settings.QABOT_REMOTE_BLOCK_CACHE_DIR,
+        block_cache_max_bytes=settings.QABOT_REMOTE_BLOCK_CACHE_MAX_BYTES,
+    )
+
+    if settings.QABOT_POSTGRES_CACHE:
+        configure_postgres_cache(
+            database_engine,
+            tables=settings.QABOT_POSTGRES_CACHE_TABLES,
+            cache_after_scans=settings.QABOT_POSTGRES_CACHE_AFTER_SCANS,
+            max_staleness=timedelta(seconds=settings.QABOT_POSTGRES_CACHE_MAX_STALENESS),
+        )
+    return database_engine
+
+
 @app.command()
 def main(
     query: str = typer.Option(
@@ -77,6 +200,34 @@ def main(
     verbose: bool = typer.Option(
         False, "-v", "--verbose", help="Essentially debug output"
     ),
+    load_parallelism: Optional[int] = typer.Option(
+        None, "--load-parallelism", help="Maximum number of files to load concurrently"
+    ),
+    no_cache: bool = typer.Option(
+        False, "--no-cache", help="Don't use the Parquet ingest cache for CSV/JSON/Excel files"
+    ),
+    refresh: bool = typer.Option(
+        False, "--refresh", help="Re-ingest files even if they are in the ingest cache"
+    ),
+    explore_sample: Optional[int] = typer.Option(
+        None, "--explore-sample",
+        help="Explore files with more rows than this using a random sample of this many rows, "
+             "re-running only the final answer's query against the full data",
+    ),
+    schema: Optional[List[str]] = typer.Option(
+        None, "--schema",
+        help="Schema hints for a CSV/JSON source as SOURCE=HINTS.json, so its schema doesn't have to be detected. "
+             "Defaults to a <source>.schema.json file next to the source",
+    ),
+    sample_size: Optional[int] = typer.Option(
+        None, "--sample-size", help="Rows of CSV/JSON sources sampled to detect their schema (-1 for all)"
+    ),
+    auto_refresh: bool = typer.Option(
+        False, "--auto-refresh", help="Load data appended to file sources before each question"
+    ),
+    resume: Optional[str] = typer.Option(
+        None, "--resume", help="Resume a saved session, restoring its conversation and scratch tables"
+    ),
 ):
     """
     Query a database or Wikidata using a simple natural language query.
@@ -86,24 +237,67 @@ def main(
     """
 
     settings = Settings()
+    startup_start = time.perf_counter()
+    configure_http_client(
+        max_connections=settings.QABOT_HTTP_MAX_CONNECTIONS,
+        timeout=settings.QABOT_HTTP_TIMEOUT,
+        host_limits=settings.QABOT_HTTP_HOST_LIMITS,
+    )
+    checkpoint = None
+    if resume:
+        try:
+            checkpoint = SessionCheckpoint(resume, settings.QABOT_CHECKPOINT_DIR)
+        except ValueError as e:
+            raise typer.BadParameter(str(e), param_hint="--resume")
+        if not checkpoint.exists:
+            raise typer.BadParameter(f"No saved session named {resume!r}", param_hint="--resume")
+        if database_uri == ":memory:" and checkpoint.manifest["database_uri"]:
+            database_uri = checkpoint.manifest["database_uri"]
+    elif settings.QABOT_CHECKPOINT:
+        # The suffix keeps sessions started in the same second apart
+        session = f"{SESSION_START.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        checkpoint = SessionCheckpoint(session, settings.QABOT_CHECKPOINT_DIR)
+    if checkpoint is not None:
+        prune_sessions(
+            settings.QABOT_CHECKPOINT_MAX_SESSIONS,
+            settings.QABOT_CHECKPOINT_MAX_BYTES,
+            keep=(checkpoint.session,),
+            directory=settings.QABOT_CHECKPOINT_DIR,
+        )
     executed_sql = ""
     # If files are given load data into local DuckDB
     print(format_duck("Creating local DuckDB database..."))
     if enable_wikidata:
         print(format_duck("Enabling Wikidata..."))
-    database_engine = create_duckdb(database_uri)
+    database_engine = _create_database(settings, database_uri)
 
     openai_client = OpenAI(
         api_key=settings.OPENAI_API_KEY,
         base_url=settings.OPENAI_BASE_URL,
     )
 
+    sample_rows = explore_sample or settings.QABOT_EXPLORATION_SAMPLE_ROWS
     if file and len(file) > 0:
         if isinstance(file, str):
             file = [file]
         print(format_duck("Loading data..."))
+        ingest_cache = None
+        if settings.QABOT_INGEST_CACHE and not no_cache:
+            ingest_cache = IngestCache(max_size_bytes=settings.QABOT_INGEST_CACHE_MAX_BYTES, refresh=refresh)
+        schema_hints = {}
+        for hint in schema or []:
+            source, separator, hints_path = hint.rpartition("=")
+            if not separator:
+                raise typer.BadParameter(f"Expected SOURCE=HINTS.json, got {hint}", param_hint="--schema")
+            schema_hints[source] = hints_path
         database_engine, executed_sql = import_into_duckdb_from_files(
-            database_engine, file
+            database_engine, file,
+            max_workers=load_parallelism or settings.QABOT_LOAD_PARALLELISM,
+            ingest_cache=ingest_cache,
+            promote_after_scans=settings.QABOT_PROMOTE_AFTER_SCANS,
+            sample_rows=sample_rows,
+            schema_hints=schema_hints,
+            sample_size=sample_size or settings.QABOT_SCHEMA_SAMPLE_SIZE,
         )
         executed_sql = "\n".join(executed_sql)
         print(format_query(executed_sql))
@@ -113,7 +307,7 @@ def main(
     if prompt_context is not None:
         try:
             if prompt_context.startswith("http://") or prompt_context.startswith("https://"):
-                response = httpx.get(prompt_context)
+                response = get_client().get(prompt_context)
                 response.raise_for_status()  # Raises an HTTPStatusError if the response status code is 4XX/5XX
                 context_data = response.text
             else:
@@ -122,6 +316,13 @@ def main(
         except Exception as e:
             raise RuntimeError(f"Failed to load context data from {prompt_context}: {e}")
 
+    if verbose:
+        timings = extension_timings()
+        rendered_timings = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+        print(format_duck(
+            f"Startup took {time.perf_counter() - startup_start:.2f}s "
+            f"({sum(timings.values()):.2f}s on extensions{': ' + rendered_timings if timings else ''})"
+        ))
     
     with Progress(
         SpinnerColumn(),
@@ -155,75 +356,180 @@ def main(
             else None,
             prompt_context=context_data,
             openai_client=openai_client,
+            exploration_sample_rows=sample_rows,
+            wikidata_cache_ttl=timedelta(seconds=settings.QABOT_WIKIDATA_CACHE_TTL),
+            prefetch_per_question=settings.QABOT_PREFETCH_PER_QUESTION,
+            answer_cache_threshold=settings.QABOT_ANSWER_CACHE_THRESHOLD if settings.QABOT_ANSWER_CACHE else None,
+            answer_cache_max_entries=settings.QABOT_ANSWER_CACHE_MAX_ENTRIES,
+            few_shot_examples=settings.QABOT_FEW_SHOT_EXAMPLES,
         )
 
+        if resume:
+            checkpoint.restore(agent)
+            print(format_duck(
+                f"Resumed session {resume}: {len(agent.messages)} messages, "
+                f"{len(checkpoint.manifest['tables'])} tables restored"
+            ))
+
         progress.remove_task(t2)
 
-        while True:
-            # Check if the input is a command (starts with "/")
-            if query.startswith('/'):
-                # Split command and arguments
-                parts = query.strip().split(maxsplit=1)
-                cmd = parts[0][1:]  # remove the leading '/'
-                arg = parts[1] if len(parts) > 1 else ''
+        def checkpoint_session():
+            if checkpoint is None:
+                return
+            stats = checkpoint.save(agent)
+            if verbose:
+                print(format_duck(
+                    f"Checkpointed {stats.messages_written} messages and {stats.tables_written} tables "
+                    f"({stats.tables_unchanged} unchanged, {stats.bytes_written / 1_000_000:,.1f} MB) in {stats.seconds:.2f}s"
+                ))
 
-                handler = COMMAND_HANDLERS.get(cmd)
-                # Stop progress to ensure output displays correctly
+        try:
+            while True:
+                # Check if the input is a command (starts with "/")
+                if query.startswith('/'):
+                    # Split command and arguments
+                    parts = query.strip().split(maxsplit=1)
+                    cmd = parts[0][1:]  # remove the leading '/'
+                    arg = parts[1] if len(parts) > 1 else ''
+
+                    handler = COMMAND_HANDLERS.get(cmd)
+                    # Stop progress to ensure output displays correctly
+                    progress.stop()
+                    print()
+                    if handler:
+                        handler(agent, arg)
+                    else:
+                        print(f"[red]Unknown command: {cmd}[/red]")
+
+                    print()
+                    checkpoint_session()
+                    # Prompt for next input after a command and continue to next loop iteration
+                    query = Prompt.ask(FOLLOW_UP_PROMPT)
+                    if query.lower() in {'n', 'no', 'q', 'exit', 'quit'}:
+                        break
+                    #progress.start()
+                    continue
+
+                if auto_refresh or settings.QABOT_AUTO_REFRESH:
+                    refresh_sources(database_engine, sample_rows=sample_rows)
+
+                print(format_rocket(f"Sending query to LLM ({settings.agent_model.default_model_name})"))
+                print(format_user(query))
+
+                t = progress.add_task(description="Processing query...", total=None)
+                result = agent(query)
+
+                # Stop the progress before outputting result and prompting for any more input
+                progress.remove_task(t)
                 progress.stop()
                 print()
-                if handler:
-                    handler(agent, arg)
-                else:
-                    print(f"[red]Unknown command: {cmd}[/red]")
 
-                print()
-                # Prompt for next input after a command and continue to next loop iteration
-                query = Prompt.ask(FOLLOW_UP_PROMPT)
-                if query.lower() in {'n', 'no', 'q', 'exit', 'quit'}:
-                    break
-                #progress.start()
-                continue
 
-            print(format_rocket(f"Sending query to LLM ({settings.agent_model.default_model_name})"))
-            print(format_user(query))
+                if verbose:
+                    # Likely the users query was quite a ways back in the console history
+                    print(format_rocket("Question:"))
+                    print(format_user(query))
 
-            t = progress.add_task(description="Processing query...", total=None)
-            result = agent(query)
+                if result:
+                    if "note" in result:
+                        print(format_duck(result["note"]))
+                    print(format_robot(result["summary"]))
+                    print()
+                    if "detail" in result:
+                        print(f"[{ROBOT_COLOR}]\n{result['detail']}\n")
 
-            # Stop the progress before outputting result and prompting for any more input
-            progress.remove_task(t)
-            progress.stop()
-            print()
+                    if "query" in result:
+                        print(format_query(result["query"]))
 
+                    if "query_result" in result:
+                        print(format_duck("Result against the full data:"))
+                        print(result["query_result"])
 
-            if verbose:
-                # Likely the users query was quite a ways back in the console history
-                print(format_rocket("Question:"))
-                print(format_user(query))
+                checkpoint_session()
 
-            if result:
-                print(format_robot(result["summary"]))
                 print()
-                if "detail" in result:
-                    print(f"[{ROBOT_COLOR}]\n{result['detail']}\n")
+                query = Prompt.ask(FOLLOW_UP_PROMPT)
 
-                if "query" in result:
-                    print(format_query(result["query"]))
+                if query.lower() in {'n', 'no', "q", "exit", "quit"}:
+                    #  and Confirm.ask(
+                    #                 "Are you sure you want to Quit?"
+                    #             )
+                    break
 
-            print()
-            query = Prompt.ask(FOLLOW_UP_PROMPT)
+                progress.start()
+        except KeyboardInterrupt:
+            progress.stop()
+        finally:
+            # Also on Ctrl-C, /exit and errors, so the session can be resumed
+            if checkpoint is not None:
+                checkpoint.save(agent)
+                print(format_duck(f"Session saved, resume it with `qabot --resume {checkpoint.session}`"))
+
+
+@rerun_app.command()
+def rerun(
+    name: str = typer.Argument(..., help="Name the answer was saved as with /save"),
+    template: Optional[str] = typer.Option(
+        None, "--template", help="Result template, e.g. 'There were {value} orders'. Defaults to the saved one"
+    ),
+    no_repair: bool = typer.Option(
+        False, "--no-repair", help="Fail instead of asking the LLM to fix SQL that no longer works"
+    ),
+):
+    """
+    Re-run a saved answer's SQL against the latest data, without the LLM.
 
-            if query.lower() in {'n', 'no', "q", "exit", "quit"}:
-                #  and Confirm.ask(
-                #                 "Are you sure you want to Quit?"
-                #             )
-                break
+    The LLM is only asked for a new query if the saved SQL fails, e.g. because the schema changed.
+    """
+    settings = Settings()
+    configure_http_client(
+        max_connections=settings.QABOT_HTTP_MAX_CONNECTIONS,
+        timeout=settings.QABOT_HTTP_TIMEOUT,
+        host_limits=settings.QABOT_HTTP_HOST_LIMITS,
+    )
+    try:
+        answer = load_answer(name, settings.QABOT_ANSWER_STORE_DIR)
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="NAME")
+    if template is not None:
+        answer.result_template = template
+        try:
+            save_answer(answer, settings.QABOT_ANSWER_STORE_DIR)
+        except ValueError as e:
+            raise typer.BadParameter(str(e), param_hint="--template")
+
+    database_engine = _create_database(settings, answer.database_uri or ":memory:")
+    repair = None
+    if not no_repair:
+        repair = llm_repair(
+            settings.agent_model, OpenAI(api_key=settings.OPENAI_API_KEY, base_url=settings.OPENAI_BASE_URL)
+        )
+    ingest_cache = IngestCache(max_size_bytes=settings.QABOT_INGEST_CACHE_MAX_BYTES) if settings.QABOT_INGEST_CACHE else None
+    try:
+        result = rerun_answer(
+            name, database_engine, repair=repair, directory=settings.QABOT_ANSWER_STORE_DIR, ingest_cache=ingest_cache,
+        )
+    except duckdb.Error as e:
+        print(f"[red]The saved query failed: {e}[/red]")
+        raise typer.Exit(1)
+    except ValueError as e:
+        print(f"[red]{e}[/red]")
+        raise typer.Exit(1)
 
-            progress.start()
+    if result.repaired:
+        print(format_duck("The saved query no longer worked, it was replaced by:"))
+        print(format_query(result.answer.query))
+    if not result.data_changed:
+        print(format_duck(f"The data hasn't changed since {name} was last run"))
+    print(result.output)
 
 
 def run():
-    app()
+    # `qabot rerun <name>` re-runs a saved answer, anything else is a question for the agent
+    if sys.argv[1:2] == ["rerun"]:
+        rerun_app(args=sys.argv[2:], prog_name="qabot rerun")
+    else:
+        app()
 
 
 if __name__ == "__main__":
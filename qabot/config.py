@@ -6,6 +6,12 @@ from pydantic_settings import BaseSettings
 class AgentModelConfig(BaseModel):
     default_model_name: str = "gpt-4o-mini"
     planning_model_name: str = 'o3-mini'
+    # Model for routine steps, and the model steps recovering from errors escalate to.
+    # Default to the default and planning models respectively, see `ModelRouter`.
+    fast_model_name: str | None = None
+    escalation_model_name: str | None = None
+    # Overrides of the tier ("fast", "default" or "strong") each kind of step uses
+    step_tiers: dict[str, str] = {}
 
 
 class Settings(BaseSettings):
@@ -14,11 +20,85 @@ class Settings(BaseSettings):
 
     QABOT_DATABASE_URI: str | None = None
     QABOT_CACHE_DATABASE_URI: AnyUrl = "duckdb:///:memory:"
+    # Shared HTTP client: pooled connections, timeout in seconds, and per host limits, e.g.
+    # {"query.wikidata.org": {"max_concurrent": 2, "requests_per_second": 0.5}}
+    QABOT_HTTP_MAX_CONNECTIONS: int = 20
+    QABOT_HTTP_TIMEOUT: float = 60.0
+    QABOT_HTTP_HOST_LIMITS: dict[str, dict[str, float]] = {}
+    # Seconds a cached Wikidata response is reused for
+    QABOT_WIKIDATA_CACHE_TTL: int = 24 * 60 * 60
     QABOT_MODEL_NAME: str = "gpt-4o-mini"
     QABOT_PLANNING_MODEL_NAME: str = "o3-mini"
+    # Cheap model for routine agent steps, and the model to escalate to after failed queries
+    QABOT_FAST_MODEL_NAME: str | None = None
+    QABOT_ESCALATION_MODEL_NAME: str | None = None
+    # Tier per kind of step, e.g. {"summarise": "default", "recover": "strong"}
+    QABOT_MODEL_TIERS: dict[str, str] = {}
+    # Tables the agent is likely to describe next that are described in the background
+    # while waiting for the LLM, per question. 0 disables this.
+    QABOT_PREFETCH_PER_QUESTION: int = 6
     QABOT_TABLES: List[str] | None = None
     QABOT_ENABLE_WIKIDATA: bool = True
     QABOT_ENABLE_HUMAN_CLARIFICATION: bool = True
+    # Number of sources loaded concurrently, defaults to the number of CPUs
+    QABOT_LOAD_PARALLELISM: int | None = None
+    # Cache text and Excel sources as Parquet between runs
+    QABOT_INGEST_CACHE: bool = True
+    QABOT_INGEST_CACHE_MAX_BYTES: int = 10 * 1024 ** 3
+    # File sources start as views and are materialised into tables after this many scans.
+    # 0 loads them straight into tables.
+    QABOT_PROMOTE_AFTER_SCANS: int = 3
+    # In-memory caches of remote (httpfs/S3) metadata, Parquet footers and byte ranges
+    QABOT_HTTP_METADATA_CACHE: bool = True
+    QABOT_OBJECT_CACHE: bool = True
+    QABOT_EXTERNAL_FILE_CACHE: bool = True
+    # Persist remote byte ranges on disk between sessions (uses the cache_httpfs community extension)
+    QABOT_REMOTE_BLOCK_CACHE: bool = False
+    QABOT_REMOTE_BLOCK_CACHE_DIR: str | None = None
+    QABOT_REMOTE_BLOCK_CACHE_MAX_BYTES: int = 10 * 1024 ** 3
+    # Explore sources with more rows than this using a random sample, re-running only the
+    # final answer's query against the full data. Disabled when unset.
+    QABOT_EXPLORATION_SAMPLE_ROWS: int | None = None
+    # Rows of CSV/JSON sources DuckDB samples to detect their schema, -1 samples the whole
+    # file. Unused for sources with schema hints.
+    QABOT_SCHEMA_SAMPLE_SIZE: int | None = None
+    # Pick up rows appended to file sources before each question
+    QABOT_AUTO_REFRESH: bool = False
+    # Copy hot tables of an attached postgres database into local storage and read them
+    # from there while they are no more than QABOT_POSTGRES_CACHE_MAX_STALENESS seconds old
+    QABOT_POSTGRES_CACHE: bool = False
+    QABOT_POSTGRES_CACHE_AFTER_SCANS: int = 3
+    QABOT_POSTGRES_CACHE_MAX_STALENESS: int = 300
+    # Tables to cache as soon as they're queried, with how to refresh them incrementally, e.g.
+    # {"public.orders": {"watermark": "updated_at", "primary_key": "id", "filter": "region = 'EU'"}}
+    QABOT_POSTGRES_CACHE_TABLES: dict[str, dict[str, str]] = {}
+    # DuckDB resource limits. Memory and threads default to the container's cgroup limits,
+    # spilled data goes to qabot's cache directory.
+    QABOT_MEMORY_LIMIT: str | None = None
+    QABOT_THREADS: int | None = None
+    QABOT_TEMP_DIRECTORY: str | None = None
+    QABOT_MAX_TEMP_DIRECTORY_SIZE: str | None = None
+    QABOT_PRESERVE_INSERTION_ORDER: bool | None = None
+    # Answer questions at least this similar to one answered before from a cache, while the
+    # data the answer read is unchanged. Off by default, similar questions can still differ.
+    QABOT_ANSWER_CACHE: bool = False
+    QABOT_ANSWER_CACHE_THRESHOLD: float = 0.85
+    QABOT_ANSWER_CACHE_MAX_ENTRIES: int = 1000
+    # Past questions similar to a new one shown to the LLM with the SQL that answered them
+    QABOT_FEW_SHOT_EXAMPLES: int = 3
+    # Checkpoint each session after every turn so it can be resumed with --resume
+    QABOT_CHECKPOINT: bool = True
+    # Where session checkpoints are kept, defaults to qabot's cache directory
+    QABOT_CHECKPOINT_DIR: str | None = None
+    # Older sessions beyond this many, or this many bytes of checkpoints, are deleted
+    QABOT_CHECKPOINT_MAX_SESSIONS: int | None = 10
+    QABOT_CHECKPOINT_MAX_BYTES: int | None = 2_000_000_000
+    # Where answers saved with /save are kept for `qabot rerun`, defaults to qabot's cache directory
+    QABOT_ANSWER_STORE_DIR: str | None = None
+    # Local directory DuckDB extensions are installed into and loaded from
+    QABOT_EXTENSION_DIRECTORY: str | None = None
+    # A preseeded (e.g. offline) extension repository, used instead of extensions.duckdb.org
+    QABOT_EXTENSION_REPOSITORY: str | None = None
 
     agent_model: AgentModelConfig = AgentModelConfig()
 
@@ -28,6 +108,9 @@ class Settings(BaseSettings):
         values["agent_model"] = {
             "default_model_name": values.get("QABOT_MODEL_NAME", "gpt-4o-mini"),
             "planning_model_name": values.get("QABOT_PLANNING_MODEL_NAME", "o3-mini"),
+            "fast_model_name": values.get("QABOT_FAST_MODEL_NAME"),
+            "escalation_model_name": values.get("QABOT_ESCALATION_MODEL_NAME"),
+            "step_tiers": values.get("QABOT_MODEL_TIERS") or {},
         }
         return values
 
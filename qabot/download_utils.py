@@ -1,36 +1,373 @@
+import contextlib
+import gzip
+import hashlib
+import json
 import os
+import tempfile
+import threading
+import time
+import uuid
 import httpx
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 import appdirs
 
+from qabot.http_client import get_client
+
+CHUNK_SIZE = 1024 * 1024
+# Files smaller than this are downloaded over a single connection
+MIN_PARALLEL_SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Magic bytes at the start of a file for the formats DuckDB can read
+MAGIC_BYTES = [
+    (b"PAR1", "parquet"),
+    (b"SQLite format 3\x00", "sqlite"),
+    (b"PK\x03\x04", "xlsx"),
+    (b"%PDF", "pdf"),
+]
+
+CONTENT_TYPES = {
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+    "application/vnd.sqlite3": "sqlite",
+    "application/x-sqlite3": "sqlite",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+    "application/pdf": "pdf",
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "text/csv": "csv",
+    "text/tab-separated-values": "tsv",
+}
+
 
 def get_cache_dir(app_name: str) -> str:
     return appdirs.user_cache_dir(app_name)
 
 
-def download_and_cache(url: str, cache_duration: timedelta = timedelta(days=30)):
-    filename = url.split('/')[-1]
-    cache_dir = get_cache_dir("qabot")
-    file_path = os.path.join(cache_dir, filename)
+def detect_format(file_path: str, content_type: str | None = None) -> tuple[str, bool]:
+    """
+    Detect the format of a downloaded file from its magic bytes, falling back to the
+    HTTP Content-Type header and finally assuming CSV.
+
+    Returns the format and whether the file is gzip compressed.
+    """
+    with open(file_path, "rb") as f:
+        head = f.read(4096)
+
+    compressed = head.startswith(b"\x1f\x8b")
+    if compressed:
+        with gzip.open(file_path, "rb") as f:
+            head = f.read(4096)
+
+    for magic, file_format in MAGIC_BYTES:
+        if head.startswith(magic):
+            return file_format, compressed
+
+    stripped = head.lstrip()
+    if stripped.startswith(b"["):
+        return "json", compressed
+    if stripped.startswith(b"{"):
+        lines = [line for line in stripped.splitlines() if line.strip()]
+        is_ndjson = len(lines) > 1 and all(line.lstrip().startswith(b"{") for line in lines[:2])
+        return ("ndjson" if is_ndjson else "json"), compressed
+
+    if content_type is not None:
+        file_format = CONTENT_TYPES.get(content_type.split(";")[0].strip().lower())
+        if file_format is not None:
+            return file_format, compressed
+    return "csv", compressed
+
+
+def download(
+        url: str,
+        file_path: str,
+        client: httpx.Client | None = None,
+        max_connections: int = 4,
+) -> httpx.Headers:
+    """
+    Stream `url` to `file_path` using constant memory and return the response headers.
 
-    # Check if file exists and is within the cache duration
-    if os.path.exists(file_path):
-        file_mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-        if datetime.now() - file_mod_time < cache_duration:
-            return file_path
+    Data is written to a `.part` file next to `file_path` which is only renamed into
+    place once complete. If the server supports range requests large files are fetched
+    over several connections, and an interrupted download is resumed from the progress
+    recorded in a `.part.json` sidecar rather than started again.
+    """
+    client = client or get_client()
+    part_path = f"{file_path}.part"
+    state_path = f"{part_path}.json"
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    head = client.head(url)
+    size = int(head.headers["content-length"]) if head.is_success and "content-length" in head.headers else None
+    supports_ranges = head.is_success and head.headers.get("accept-ranges", "").lower() == "bytes"
 
-    # Download and save the file
-    response = httpx.get(url)
-    if response.status_code == 200:
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'wb') as file:
-            file.write(response.content)
+    if supports_ranges and size:
+        headers = _download_ranges(client, url, part_path, state_path, size, head.headers, max_connections)
     else:
-        raise Exception("Failed to download the file.") from response.raise_for_status()
+        headers = _download_stream(client, url, part_path)
+
+    os.replace(part_path, file_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return headers
+
+
+def _download_stream(client: httpx.Client, url: str, part_path: str) -> httpx.Headers:
+    with client.stream("GET", url) as response:
+        response.raise_for_status()
+        with open(part_path, "wb") as f:
+            for chunk in response.iter_bytes(CHUNK_SIZE):
+                f.write(chunk)
+        return response.headers
+
+
+def _download_ranges(
+        client: httpx.Client,
+        url: str,
+        part_path: str,
+        state_path: str,
+        size: int,
+        headers: httpx.Headers,
+        max_connections: int,
+) -> httpx.Headers:
+    validator = headers.get("etag") or headers.get("last-modified")
+    state = _read_json(state_path)
+    if (
+            state is None
+            or not os.path.exists(part_path)
+            or state["url"] != url
+            or state["size"] != size
+            or state["validator"] != validator
+    ):
+        # Start a fresh download, splitting the file into one segment per connection
+        segment_count = max(1, min(max_connections, size // MIN_PARALLEL_SEGMENT_SIZE))
+        segment_size = -(-size // segment_count)
+        state = {
+            "url": url,
+            "size": size,
+            "validator": validator,
+            "segments": [
+                {"start": start, "end": min(start + segment_size, size) - 1, "done": 0}
+                for start in range(0, size, segment_size)
+            ],
+        }
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+        write_json_atomic(state_path, state)
+
+    lock = threading.Lock()
+    errors = []
+
+    def fetch_segment(segment):
+        try:
+            with open(part_path, "r+b") as f:
+                while segment["start"] + segment["done"] <= segment["end"]:
+                    offset = segment["start"] + segment["done"]
+                    range_headers = {"Range": f"bytes={offset}-{segment['end']}"}
+                    if validator is not None:
+                        range_headers["If-Range"] = validator
+                    with client.stream("GET", url, headers=range_headers) as response:
+                        if response.status_code != 206:
+                            raise httpx.HTTPStatusError(
+                                f"Expected partial content for {url}, got {response.status_code}",
+                                request=response.request,
+                                response=response,
+                            )
+                        f.seek(offset)
+                        for chunk in response.iter_bytes(CHUNK_SIZE):
+                            f.write(chunk)
+                            with lock:
+                                segment["done"] += len(chunk)
+                                write_json_atomic(state_path, state)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=fetch_segment, args=(segment,), daemon=True)
+        for segment in state["segments"]
+        if segment["start"] + segment["done"] <= segment["end"]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return headers
+
+
+def _read_json(path: str) -> dict | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
+
+@contextlib.contextmanager
+def temporary_download(url: str, client: httpx.Client | None = None):
+    """
+    Download `url` to a temporary file which is removed on exit.
+
+    Yields the file path (with an extension matching the detected format, so DuckDB
+    picks the right reader) and the detected format.
+    """
+    with tempfile.TemporaryDirectory(prefix="qabot-") as tmp_dir:
+        download_path = os.path.join(tmp_dir, "download")
+        headers = download(url, download_path, client=client)
+        file_format, compressed = detect_format(download_path, headers.get("content-type"))
+        file_path = f"{download_path}.{file_format}{'.gz' if compressed else ''}"
+        os.replace(download_path, file_path)
+        yield file_path, file_format
+
+
+def write_json_atomic(path: str, data: dict):
+    """
+    Write `data` as JSON such that concurrent readers never see a partial file.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def evict_lru(cache_dir: str, max_size_bytes: int, keep: tuple[str, ...] = ()):
+    """
+    Remove the least recently used cache entries until `cache_dir` fits within `max_size_bytes`.
+
+    An entry is every file sharing a name up to the first "." (e.g. a data file and its
+    metadata sidecar) and its last use is the newest mtime of those files. Entries that are
+    locked or named in `keep` are never removed, nor is the most recently used entry.
+    """
+    entries: dict[str, list] = {}
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entry = entries.setdefault(name.split(".")[0], [0.0, 0, [], False])
+        entry[0] = max(entry[0], stat.st_mtime)
+        entry[1] += stat.st_size
+        entry[2].append(path)
+        entry[3] = entry[3] or name.endswith(".lock")
+
+    total = sum(entry[1] for entry in entries.values())
+    by_age = sorted(entries.items(), key=lambda item: item[1][0])
+    for stem, (_, size, paths, locked) in by_age[:-1]:
+        if total <= max_size_bytes:
+            break
+        if locked or stem in keep:
+            continue
+        for path in paths:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        total -= size
+
+
+@contextlib.contextmanager
+def file_lock(lock_path: str, timeout: float = 600, stale_after: float = 3600):
+    """
+    A cross process lock based on exclusively creating `lock_path`.
+
+    Locks older than `stale_after` seconds are assumed to belong to a crashed process.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            break
+        except FileExistsError:
+            with contextlib.suppress(FileNotFoundError):
+                if time.time() - os.path.getmtime(lock_path) > stale_after:
+                    os.remove(lock_path)
+                    continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for lock {lock_path}")
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(lock_path)
+
+
+def download_and_cache(
+        url: str,
+        cache_duration: timedelta = timedelta(0),
+        max_size_bytes: int = 5 * 1024 ** 3,
+        client: httpx.Client | None = None,
+) -> str:
+    """
+    Return the path of a locally cached copy of `url`.
+
+    Entries are keyed by a hash of the URL and stored alongside a metadata sidecar
+    recording the ETag and Last-Modified headers. Entries younger than `cache_duration`
+    are used as is, older entries are revalidated with a conditional request so an
+    unchanged file only costs a 304 round trip. The cache is shared safely between
+    processes and trimmed back to `max_size_bytes` by evicting the least recently used
+    entries.
+    """
+    cache_dir = os.path.join(get_cache_dir("qabot"), "http")
+    os.makedirs(cache_dir, exist_ok=True)
+    key = hashlib.sha256(url.encode()).hexdigest()
+    _, extension = os.path.splitext(url.split("?")[0].split("/")[-1])
+    file_path = os.path.join(cache_dir, f"{key}{extension}")
+    metadata_path = os.path.join(cache_dir, f"{key}.meta.json")
+
+    with file_lock(os.path.join(cache_dir, f"{key}.lock")):
+        metadata = _read_json(metadata_path) if os.path.exists(file_path) else None
+        if metadata is not None:
+            validated = datetime.fromisoformat(metadata["validated"])
+            if datetime.now() - validated < cache_duration:
+                os.utime(file_path)
+                return file_path
+
+            conditional_headers = {}
+            if metadata.get("etag"):
+                conditional_headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last_modified"):
+                conditional_headers["If-Modified-Since"] = metadata["last_modified"]
+
+            if conditional_headers:
+                response = (client or get_client()).head(url, headers=conditional_headers)
+                if response.status_code == 304 or (
+                        response.is_success and _matches_validators(response.headers, metadata)
+                ):
+                    metadata["validated"] = datetime.now().isoformat()
+                    write_json_atomic(metadata_path, metadata)
+                    os.utime(file_path)
+                    return file_path
+
+        headers = download(url, file_path, client=client)
+        write_json_atomic(
+            metadata_path,
+            {
+                "url": url,
+                "etag": headers.get("etag"),
+                "last_modified": headers.get("last-modified"),
+                "validated": datetime.now().isoformat(),
+            },
+        )
+
+    evict_lru(cache_dir, max_size_bytes)
     return file_path
 
 
+def _matches_validators(headers: httpx.Headers, metadata: dict) -> bool:
+    """
+    Check a full response against cached validators, for servers ignoring conditional headers.
+    """
+    if metadata.get("etag") and headers.get("etag"):
+        return headers["etag"] == metadata["etag"]
+    if metadata.get("last_modified") and headers.get("last-modified"):
+        try:
+            return parsedate_to_datetime(headers["last-modified"]) <= parsedate_to_datetime(metadata["last_modified"])
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
 if __name__ == '__main__':
     doc_url = "https://duckdb.org/duckdb-docs.pdf"
     download_and_cache(doc_url)
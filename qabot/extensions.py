@@ -0,0 +1,116 @@
+import re
+import threading
+import time
+from typing import Callable
+
+import duckdb
+
+# Extensions are loaded lazily, when a source or query looks like it needs them
+EXTENSION_TRIGGERS = {
+    "httpfs": re.compile(r"\b(https?|s3|s3a|s3n|gcs|gs|r2|hf)://", re.IGNORECASE),
+    "spatial": re.compile(r"\bst_\w+\s*\(", re.IGNORECASE),
+    "excel": re.compile(r"\bread_xlsx\s*\(", re.IGNORECASE),
+    "sqlite_scanner": re.compile(r"\bsqlite_(scan|attach)\b|\bTYPE\s+SQLITE\b", re.IGNORECASE),
+    "postgres_scanner": re.compile(r"\bpostgres_(scan|attach)\b|\bTYPE\s+POSTGRES\b", re.IGNORECASE),
+}
+
+REPOSITORY_ALIASES = {"core", "core_nightly", "community"}
+
+# Extension installs are shared by every cursor of a database, so we only
+# attempt each one once per process - a failed INSTALL can cost a network timeout.
+_extension_lock = threading.Lock()
+_failed_extensions: set[str] = set()
+_extension_timings: dict[str, float] = {}
+_extension_repository: str | None = None
+_load_callbacks: dict[str, list[Callable[[duckdb.DuckDBPyConnection], None]]] = {}
+
+
+def configure_extensions(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        extension_directory: str | None = None,
+        extension_repository: str | None = None,
+):
+    """
+    Point DuckDB at a local extension directory and/or a preseeded (offline) extension repository.
+
+    When a repository is given, extensions are only ever installed from it - DuckDB's own
+    automatic installs are disabled so a locked down host never waits on the network.
+    """
+    global _extension_repository
+    if extension_directory is not None:
+        duckdb_connection.execute(f"SET extension_directory = '{extension_directory}';")
+    if extension_repository is not None:
+        _extension_repository = extension_repository
+        duckdb_connection.execute(f"SET custom_extension_repository = '{extension_repository}';")
+        duckdb_connection.execute("SET autoinstall_known_extensions = false;")
+
+
+def on_extension_loaded(name: str, callback: Callable[[duckdb.DuckDBPyConnection], None]):
+    """
+    Register a callback to configure an extension (or load its companions) once it is loaded.
+    """
+    _load_callbacks.setdefault(name, []).append(callback)
+
+
+def ensure_extension(duckdb_connection: duckdb.DuckDBPyConnection, name: str, repository: str | None = None) -> bool:
+    """
+    Install (if required) and load a DuckDB extension, returning False if it isn't available.
+
+    Extensions already present in the local extension directory are loaded without
+    contacting any repository. `repository` overrides the configured repository, e.g.
+    "community" for community extensions.
+    """
+    if _load_extension(duckdb_connection, name, repository):
+        for callback in _load_callbacks.pop(name, []):
+            callback(duckdb_connection)
+        return True
+    return False
+
+
+def _load_extension(duckdb_connection: duckdb.DuckDBPyConnection, name: str, repository: str | None) -> bool:
+    with _extension_lock:
+        if name in _failed_extensions:
+            return False
+        row = duckdb_connection.execute(
+            "select installed, loaded from duckdb_extensions() where extension_name = ?", [name]
+        ).fetchone()
+        installed, loaded = row if row is not None else (False, False)
+        if loaded:
+            return True
+
+        start = time.perf_counter()
+        try:
+            if not installed:
+                repository = repository or _extension_repository
+                if repository is None:
+                    duckdb_connection.sql(f"INSTALL {name};")
+                elif repository in REPOSITORY_ALIASES:
+                    duckdb_connection.sql(f"INSTALL {name} FROM {repository};")
+                else:
+                    duckdb_connection.sql(f"INSTALL {name} FROM '{repository}';")
+            duckdb_connection.sql(f"LOAD {name};")
+        except Exception:
+            _failed_extensions.add(name)
+            # Don't let DuckDB retry the install (and wait on the network) for every query
+            duckdb_connection.execute("SET autoinstall_known_extensions = false;")
+            print(f"Failed to install the {name} extension")
+            return False
+        finally:
+            _extension_timings[name] = _extension_timings.get(name, 0.0) + time.perf_counter() - start
+        return True
+
+
+def ensure_extensions_for(duckdb_connection: duckdb.DuckDBPyConnection, sql_or_path: str):
+    """
+    Load any extensions that a query or source path looks like it needs.
+    """
+    for name, trigger in EXTENSION_TRIGGERS.items():
+        if name not in _failed_extensions and trigger.search(sql_or_path):
+            ensure_extension(duckdb_connection, name)
+
+
+def extension_timings() -> dict[str, float]:
+    """
+    Seconds spent installing and loading each extension in this process.
+    """
+    return dict(_extension_timings)
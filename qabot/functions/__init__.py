@@ -1,7 +1,12 @@
 import textwrap
 
 
-def get_function_specifications(allow_wikidata: bool = True, allow_research: bool = True):
+def get_function_specifications(
+        allow_wikidata: bool = True,
+        allow_research: bool = True,
+        allow_clarify: bool = False,
+        allow_terminate: bool = False,
+):
     function_specifications = [
         {
             "name": "execute_sql",
@@ -53,7 +58,9 @@ def get_function_specifications(allow_wikidata: bool = True, allow_research: boo
         },
         {
             "name": "load_data",
-            "description": "Load data from one or more local or remote files into the local DuckDB database",
+            "description": "Load data from one or more local or remote files into the local DuckDB database. "
+                           "A glob or directory (e.g. a Hive partitioned dataset) is loaded as a single view. "
+                           "Each sheet of an Excel workbook is loaded as its own table, append #Sheet1,Sheet2 to load only some sheets.",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -65,6 +72,8 @@ def get_function_specifications(allow_wikidata: bool = True, allow_research: boo
                             "examples": [
                                 "data/chinook.sqlite",
                                 "https://duckdb.org/data/prices.csv",
+                                "logs/year=*/month=*/*.parquet",
+                                "reports/budget.xlsx#Summary",
                             ],
                         },
                     },
@@ -72,6 +81,26 @@ def get_function_specifications(allow_wikidata: bool = True, allow_research: boo
                 "required": ["file"],
             },
         },
+        {
+            "name": "export_result",
+            "description": "Write the full results of a query to a Parquet, CSV or JSON file (chosen by the path's "
+                           "extension). Use this instead of execute_sql when the user wants the data itself, e.g. a "
+                           "CSV of all matching rows; only the row count and file size are returned.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "DuckDB dialect SQL query whose results are exported",
+                    },
+                    "path": {
+                        "type": "string",
+                        "description": "The file to write e.g. 'rock_listeners.csv' or 'sales.parquet'",
+                    },
+                },
+                "required": ["query", "path"],
+            },
+        },
         # A special function to call to summarize the answer
         {
             "name": "answer",
@@ -110,9 +139,11 @@ def get_function_specifications(allow_wikidata: bool = True, allow_research: boo
                     """Source data from Wikidata if not available locally.
                     Input to this tool is a single SPARQL statement for Wikidata. Limit all requests to 50 or fewer rows. 
 
-                    Output is the raw response in json. If the query is not correct, an error message will be returned. 
-                    If an error is returned, you may rewrite the query and try again. If you are unsure about the response
-                    you can try rewrite the query and try again. Prefer local data before using this tool.
+                    Output is the name of a table the results were stored in, and a preview of them. Query the table
+                    with SQL to aggregate the results or join them with local data. If the query is not correct, an
+                    error message will be returned. If an error is returned, you may rewrite the query and try again.
+                    If you are unsure about the response you can try rewrite the query and try again. Prefer local data
+                    before using this tool.
                     """
                 ),
                 "parameters": {
@@ -151,4 +182,46 @@ def get_function_specifications(allow_wikidata: bool = True, allow_research: boo
             }
         )
 
+    if allow_clarify:
+        function_specifications.append(
+            {
+                "name": "clarify",
+                "description": textwrap.dedent(
+                    """Useful for when you need to ask the user a question to clarify their request.
+                    Input to this tool is a single question for the user. Output is the user's response.
+                    """
+                ),
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "clarification": {
+                            "type": "string",
+                            "description": "A question or prompt for the user",
+                        },
+                    },
+                },
+            }
+        )
+
+    if allow_terminate:
+        function_specifications.append(
+            {
+                "name": "terminate_session",
+                "description": textwrap.dedent(
+                    """Indicate that the user has requested the session to be terminated.
+                    Prefer to clarify unclear requests or requests you cannot address rather than terminating a session immediately.
+                    """
+                ),
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "message": {
+                            "type": "string",
+                            "description": "The final short message - usually saying goodbye",
+                        },
+                    },
+                },
+            }
+        )
+
     return function_specifications
\ No newline at end of file
@@ -1,12 +1,66 @@
+import glob
+import hashlib
+import json
 import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from typing import Tuple
 from urllib.parse import urlparse
-import tempfile
+from xml.etree import ElementTree
 
 import duckdb
 from duckdb import ParserException, ProgrammingError
 import httpx
 
+from qabot.download_utils import detect_format, download_and_cache
+from qabot.http_client import get_client
+from qabot.extensions import configure_extensions, ensure_extension, ensure_extensions_for
+from qabot.ingest_cache import IngestCache
+from qabot.resource_limits import configure_resources
+
+
+# DuckDB table functions able to read each file type of a multi-file dataset
+DATASET_READERS = {
+    ".parquet": "read_parquet",
+    ".csv": "read_csv",
+    ".tsv": "read_csv",
+    ".json": "read_json",
+    ".jsonl": "read_json",
+    ".ndjson": "read_json",
+}
+
+# DuckDB table functions able to read each downloadable format
+DOWNLOAD_READERS = {
+    "csv": "read_csv_auto",
+    "tsv": "read_csv_auto",
+    "json": "read_json_auto",
+    "ndjson": "read_json_auto",
+    "parquet": "read_parquet",
+}
+
+# The name the cache database is attached as, see `attach_cache_database`
+CACHE_DATABASE = "qabot_cache"
+
+# Text formats whose reader can be given schema hints instead of sniffing the file
+HINTABLE_EXTENSIONS = {
+    ".csv": "read_csv",
+    ".tsv": "read_csv",
+    ".txt": "read_csv",
+    ".json": "read_json",
+    ".jsonl": "read_json",
+    ".ndjson": "read_json",
+}
+
+SPREADSHEETML_NAMESPACE = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+
+# Text formats that are commonly appended to, so new lines can be ingested on their own
+APPENDABLE_EXTENSIONS = (".csv", ".tsv", ".jsonl", ".ndjson")
+
 
 def uri_validator(x):
     try:
@@ -16,88 +70,977 @@ def uri_validator(x):
         return False
 
 
-def create_duckdb(duckdb_path: str = ":memory:") -> duckdb.DuckDBPyConnection:
+def create_duckdb(
+        duckdb_path: str = ":memory:",
+        extension_directory: str | None = None,
+        extension_repository: str | None = None,
+        memory_limit: str | None = None,
+        threads: int | None = None,
+        temp_directory: str | None = None,
+        max_temp_directory_size: str | None = None,
+        preserve_insertion_order: bool | None = None,
+) -> duckdb.DuckDBPyConnection:
     # By default, duckdb is fully in-memory - we can provide a path to get
     # persistent storage
 
     duckdb_connection = duckdb.connect(duckdb_path)
-    try:
-        duckdb_connection.sql("INSTALL httpfs;")
-        duckdb_connection.sql("LOAD httpfs;")
-    except Exception:
-        print(
-            "Failed to install httpfs extension. Loading remote files will not be supported"
-        )
+    # Unset limits default to the container's limits, see `configure_resources`
+    configure_resources(
+        duckdb_connection, memory_limit, threads, temp_directory, max_temp_directory_size, preserve_insertion_order
+    )
+    # Extensions (e.g. httpfs) are loaded lazily once a source or query needs them
+    configure_extensions(duckdb_connection, extension_directory, extension_repository)
 
     duckdb_connection.sql(
         "create table if not exists qabot_queries(query VARCHAR, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP);"
     )
+    for column in ["bytes_read BIGINT", "reads_remote BOOLEAN", "peak_memory_bytes BIGINT", "spill_bytes BIGINT"]:
+        duckdb_connection.sql(f"alter table qabot_queries add column if not exists {column};")
+    _enable_query_profiling(duckdb_connection)
+    # Records which table each source was loaded into, so a persistent database
+    # only re-imports sources that have changed since they were loaded.
+    duckdb_connection.sql(
+        "create table if not exists qabot_sources(uri VARCHAR PRIMARY KEY, fingerprint VARCHAR, table_name VARCHAR, loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);"
+    )
+    # Access statistics used to decide when a lazily loaded view is worth materialising
+    for column in [
+        "size_bytes BIGINT",
+        "materialized BOOLEAN DEFAULT false",
+        "promote_after_scans INTEGER",
+        "scan_count INTEGER DEFAULT 0",
+        "bytes_read BIGINT DEFAULT 0",
+        "partition_keys VARCHAR[]",
+        "sample_table VARCHAR",
+        # Hash of the bytes just before size_bytes, to tell an appended file from a rewritten one
+        "tail_digest VARCHAR",
+        # Schema hints and other options the source's reader was given, as JSON
+        "reader_options VARCHAR",
+        # SQLite and Postgres databases are attached rather than loaded, table_name is the catalog
+        "attached BOOLEAN DEFAULT false",
+    ]:
+        duckdb_connection.sql(f"alter table qabot_sources add column if not exists {column};")
 
     return duckdb_connection
 
 
+def attach_cache_database(duckdb_connection: duckdb.DuckDBPyConnection, cache_database_uri: str):
+    """
+    Attach the database that caches responses from remote services (e.g. Wikidata) as `qabot_cache`.
+
+    URIs are of the form `duckdb:///relative/path.duckdb` or `duckdb:////absolute/path.duckdb`.
+    An in-memory cache database is the session's own database, so nothing is attached.
+    """
+    cache_path = str(cache_database_uri).removeprefix("duckdb:///")
+    if cache_path in ("", ":memory:"):
+        return
+    duckdb_connection.execute(f"ATTACH IF NOT EXISTS '{cache_path}' AS {CACHE_DATABASE};")
+
+
+def _enable_query_profiling(duckdb_connection: duckdb.DuckDBPyConnection):
+    """
+    Collect per query metrics (read back by `run_sql_catch_error`) without printing them.
+    """
+    try:
+        duckdb_connection.execute("PRAGMA enable_profiling = 'no_output';")
+        duckdb_connection.execute(
+            """SET custom_profiling_settings = '{"TOTAL_BYTES_READ": "true", "LATENCY": "true", "SYSTEM_PEAK_BUFFER_MEMORY": "true", "SYSTEM_PEAK_TEMP_DIR_SIZE": "true"}';"""
+        )
+    except duckdb.Error:
+        # Older versions of DuckDB don't support custom profiling metrics
+        pass
+
+
+def last_query_profile(duckdb_connection: duckdb.DuckDBPyConnection) -> dict:
+    """
+    Top level metrics DuckDB collected for the last query run on a connection, if profiling is enabled.
+    """
+    try:
+        profile = json.loads(duckdb_connection.get_profiling_information(format="json"))
+    except (AttributeError, TypeError, ValueError, duckdb.Error):
+        return {}
+    return {key: value for key, value in profile.items() if not isinstance(value, (dict, list))}
+
+
+def read_schema_hints(file_path: str, hints_path: str | None = None) -> dict:
+    """
+    Load the schema hints for a source from `hints_path`, or from a `<source>.schema.json` sidecar.
+
+    Hints are a JSON object of reader options, e.g.
+    `{"columns": {"id": "BIGINT", "ts": "TIMESTAMP"}, "timestampformat": "%d/%m/%Y %H:%M"}`.
+    Giving the columns means DuckDB doesn't have to sample the file to detect them.
+    """
+    if hints_path is None:
+        hints_path = f"{file_path}.schema.json"
+        if uri_validator(file_path) or not os.path.isfile(hints_path):
+            return {}
+    with open(hints_path) as f:
+        hints = json.load(f)
+    if not isinstance(hints, dict):
+        raise ValueError(f"Schema hints in {hints_path} must be a JSON object")
+    return hints
+
+
+def _reader_sql(file_path: str, reader_options: dict | None) -> str | None:
+    """
+    The table function call reading a CSV or JSON source with the given options, or None if
+    the source isn't a CSV or JSON file.
+    """
+    lowered = file_path.lower().removesuffix(".gz")
+    extension = next((e for e in HINTABLE_EXTENSIONS if lowered.endswith(e)), None)
+    if extension is None:
+        return None
+    options = {name: value for name, value in (reader_options or {}).items() if value is not None}
+    columns = options.pop("columns", None)
+    if extension in (".jsonl", ".ndjson"):
+        # Newline delimited JSON is parsed in parallel, in fixed size buffers
+        options.setdefault("format", "newline_delimited")
+    if columns is not None and HINTABLE_EXTENSIONS[extension] == "read_csv":
+        # With the columns known there is nothing left to sniff
+        options.setdefault("auto_detect", False)
+        options.setdefault("header", True)
+        options.setdefault("delim", "\t" if extension == ".tsv" else ",")
+
+    arguments = [f"'{file_path}'"]
+    arguments += [f"{name} = {_sql_literal(value)}" for name, value in options.items()]
+    if columns is not None:
+        arguments.append("columns = {" + ", ".join(f"{_sql_literal(name)}: {_sql_literal(data_type)}" for name, data_type in columns.items()) + "}")
+    return f"{HINTABLE_EXTENSIONS[extension]}({', '.join(arguments)})"
+
+
+def _sql_literal(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, list):
+        return "[" + ", ".join(_sql_literal(item) for item in value) + "]"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def source_fingerprint(file_path: str) -> tuple[str | None, int | None]:
+    """
+    A cheap fingerprint that changes whenever a source changes, and the size of the source.
+
+    Local files use their size and modification time, remote files their ETag or Last-Modified
+    header. Either value is None if it can't be determined.
+    """
+    file_path, _ = split_sheet(file_path)
+    if file_path.startswith(("http://", "https://")):
+        try:
+            response = get_client().head(file_path, timeout=10)
+            response.raise_for_status()
+        except httpx.HTTPError:
+            return None, None
+        validator = response.headers.get("etag") or response.headers.get("last-modified")
+        size = response.headers.get("content-length")
+        size = int(size) if size is not None and size.isdigit() else None
+        return (f"{validator}:{size}" if validator else None), size
+    if not uri_validator(file_path) and os.path.isfile(file_path):
+        stat = os.stat(file_path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}", stat.st_size
+    if not uri_validator(file_path) and is_dataset(file_path):
+        # Any added, removed or modified file changes the fingerprint
+        digest = hashlib.blake2b(digest_size=16)
+        size = 0
+        for path in sorted(glob.glob(_dataset_pattern(file_path), recursive=True)):
+            stat = os.stat(path)
+            size += stat.st_size
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest(), size
+    return None, None
+
+
+def split_sheet(file_path: str) -> Tuple[str, str | None]:
+    """
+    Split a `workbook.xlsx#Sheet` source into the workbook path and sheet name.
+    """
+    workbook, separator, sheet = file_path.rpartition("#")
+    if separator and workbook.lower().endswith(".xlsx") and not os.path.isfile(file_path):
+        return workbook, sheet
+    return file_path, None
+
+
+def list_sheets(workbook_path: str) -> list[str]:
+    """
+    The names of the sheets in an Excel workbook, in workbook order, read without parsing any cells.
+    """
+    with zipfile.ZipFile(workbook_path) as workbook:
+        root = ElementTree.fromstring(workbook.read("xl/workbook.xml"))
+    return [sheet.get("name") for sheet in root.iter(f"{{{SPREADSHEETML_NAMESPACE}}}sheet")]
+
+
+def expand_workbooks(files: list[str]) -> list[str]:
+    """
+    Replace each local Excel workbook with one `workbook.xlsx#Sheet` source per sheet.
+
+    A workbook can be limited to a subset of its sheets with `workbook.xlsx#Sheet1,Sheet2`.
+    Workbooks with a single sheet (and remote workbooks) are loaded as a whole, as before.
+    """
+    expanded = []
+    for file_path in files:
+        workbook_path, sheets = split_sheet(file_path)
+        if not workbook_path.lower().endswith(".xlsx") or uri_validator(workbook_path) or not os.path.isfile(workbook_path):
+            expanded.append(file_path)
+            continue
+        try:
+            available = list_sheets(workbook_path)
+        except (zipfile.BadZipFile, KeyError, ElementTree.ParseError):
+            # Leave it to the reader to report the problem
+            expanded.append(file_path)
+            continue
+        selected = sheets.split(",") if sheets else available
+        if len(available) <= 1 and not sheets:
+            expanded.append(workbook_path)
+            continue
+        expanded.extend(f"{workbook_path}#{sheet}" for sheet in selected)
+    # Two loads of the same sheet would race to create the same table
+    return list(dict.fromkeys(expanded))
+
+
+def is_dataset(file_path: str) -> bool:
+    """
+    Whether a source is a glob or directory of files to be loaded as a single dataset.
+    """
+    return bool(re.search(r"[*?[]", file_path)) or (not uri_validator(file_path) and os.path.isdir(file_path))
+
+
+def _dataset_pattern(file_path: str) -> str:
+    """
+    Turn a dataset directory into a recursive glob over the data files it contains.
+    """
+    if not os.path.isdir(file_path):
+        return file_path
+    for _, _, file_names in os.walk(file_path):
+        for file_name in file_names:
+            _, extension = os.path.splitext(file_name)
+            if extension.lower() in DATASET_READERS:
+                return os.path.join(file_path, "**", f"*{extension}")
+    raise ValueError(f"No data files found in directory {file_path}")
+
+
+def _partition_keys(paths: list[str]) -> list[str]:
+    """
+    Hive partition keys (e.g. year, month from .../year=2024/month=1/data.parquet) in path order.
+    """
+    keys = []
+    for path in paths:
+        for segment in path.replace("\\", "/").split("/")[:-1]:
+            key, separator, _ = segment.partition("=")
+            if separator and key and key not in keys:
+                keys.append(key)
+    return keys
+
+
+@dataclass
+class SourceLoadResult:
+    """
+    The outcome of loading a single `--file` source.
+    """
+    source: str
+    executed_sql: list[str] = field(default_factory=list)
+    table_name: str | None = None
+    rows: int | None = None
+    bytes: int | None = None
+    seconds: float = 0.0
+    error: str | None = None
+    # True if the source was unchanged and its previously loaded table was reused
+    reused: bool = False
+    # True if the source was loaded as a (lazy) view rather than a table
+    is_view: bool = False
+    # Hive partition columns of a multi-file dataset
+    partition_keys: list[str] | None = None
+    # True if a changed source was brought up to date without re-importing it
+    refreshed: bool = False
+
+    def summary(self) -> str:
+        if self.error is not None:
+            return f"Failed to load {self.source}: {self.error}"
+        if self.reused:
+            return f"Reused {self.table_name} for unchanged source {self.source}"
+        if self.refreshed and self.is_view:
+            return f"View {self.table_name} already reads the latest {self.source}"
+        if self.refreshed:
+            return (
+                f"Appended {self.rows:,} new rows ({self.bytes:,} bytes) from {self.source} "
+                f"to {self.table_name} in {self.seconds:.2f}s"
+            )
+        target = f" into {self.table_name}" if self.table_name else ""
+        stats = []
+        if self.rows is not None:
+            stats.append(f"{self.rows:,} rows")
+            if self.seconds > 0:
+                stats.append(f"{self.rows / self.seconds:,.0f} rows/s")
+        # A view doesn't read its source while loading, so it has no throughput
+        if self.bytes is not None and self.seconds > 0 and not self.is_view:
+            stats.append(f"{self.bytes / self.seconds / 1_000_000:,.1f} MB/s")
+        rendered_stats = f" ({', '.join(stats)})" if stats else ""
+        return f"Loaded {self.source}{target} in {self.seconds:.2f}s{rendered_stats}"
+
+
 def import_into_duckdb_from_files(
         duckdb_connection: duckdb.DuckDBPyConnection,
         files: list[str],
-        dangerously_allow_write_access=False
+        dangerously_allow_write_access=False,
+        max_workers: int | None = None,
+        ingest_cache: IngestCache | None = None,
+        promote_after_scans: int | None = 3,
+        sample_rows: int | None = None,
+        schema_hints: dict[str, str] | None = None,
+        sample_size: int | None = None,
 ) -> Tuple[duckdb.DuckDBPyConnection, list[str]]:
-    executed_sql = []
-    for i, file_path in enumerate(files, 1):
-        if file_path.startswith("postgresql://"):
-            try:
-                duckdb_connection.sql("INSTALL postgres_scanner;")
-            except Exception:
-                print(
-                    "Failed to install postgres_scanner extension. Loading directly from postgresql will not be supported"
-                )
-                continue
-            db_type = "(TYPE postgres, READ_ONLY)" if not dangerously_allow_write_access else "(TYPE postgres)"
-            duckdb_connection.execute(f"ATTACH '{file_path}' as postgres_db {db_type};")
-
-            _set_search_path(duckdb_connection)
-        elif file_path.endswith('.json'):
-            # use the filename as the table name
-            table_name, _ = os.path.splitext(os.path.basename(file_path))
-            # remove any non-alphanumeric characters
-            new_table_name = "".join([c for c in table_name if c.isalnum()])
-            duckdb_connection.execute(f"CREATE TABLE {new_table_name} AS select * from read_json('{file_path}');")
-            _set_search_path(duckdb_connection)
-        elif file_path.endswith('.xlsx'):
-            try:
-                duckdb_connection.sql("INSTALL spatial;")
-                duckdb_connection.sql("LOAD spatial;")
-            except Exception:
-                print(
-                    "Failed to install spatial extension. Loading directly from Excel files will not be supported"
+    results = load_sources(
+        duckdb_connection,
+        files,
+        dangerously_allow_write_access,
+        max_workers=max_workers,
+        ingest_cache=ingest_cache,
+        promote_after_scans=promote_after_scans,
+        sample_rows=sample_rows,
+        schema_hints=schema_hints,
+        sample_size=sample_size,
+    )
+    executed_sql = [sql for result in results for sql in result.executed_sql]
+    return duckdb_connection, executed_sql
+
+
+def load_sources(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        files: list[str],
+        dangerously_allow_write_access=False,
+        max_workers: int | None = None,
+        ingest_cache: IngestCache | None = None,
+        promote_after_scans: int | None = 3,
+        sample_rows: int | None = None,
+        schema_hints: dict[str, str] | None = None,
+        sample_size: int | None = None,
+) -> list[SourceLoadResult]:
+    """
+    Load each source on its own cursor, running up to `max_workers` loads concurrently.
+
+    A failure loading one source is reported in its result rather than aborting the others.
+    Results are returned in the same order as `files`.
+
+    If an `ingest_cache` is given, text and Excel sources are converted to Parquet once
+    and later loads create a view over the cached Parquet.
+
+    File sources start out as views, and are materialised into a table by `track_source_scans`
+    once they have been scanned `promote_after_scans` times. Pass 0 to load them straight
+    into tables, or None to always leave them as views.
+
+    With `sample_rows`, any file source with more rows than that also gets a
+    `<table>__sample` table holding a uniform random sample of `sample_rows` rows, for
+    cheap exploratory queries (see `run_exploratory_sql`).
+
+    CSV and JSON sources are read with the schema hints in `schema_hints` (a map of source to
+    hints file) or their `<source>.schema.json` sidecar, see `read_schema_hints`. Otherwise
+    DuckDB detects their schema from the first `sample_size` rows (-1 for the whole file).
+    """
+    # Each sheet of a workbook is loaded (concurrently) as a source of its own
+    files = expand_workbooks(files)
+    if not files:
+        return []
+    if max_workers is None:
+        max_workers = min(len(files), os.cpu_count() or 1)
+    concurrent = max_workers > 1 and len(files) > 1
+    # Summaries of concurrent loads are printed whole, one at a time
+    print_lock = threading.Lock()
+
+    def load(file_path: str) -> SourceLoadResult:
+        cursor = duckdb_connection.cursor()
+        start = time.perf_counter()
+        try:
+            reader_options = {"sample_size": sample_size, **read_schema_hints(file_path, (schema_hints or {}).get(file_path))}
+            result = _load_source(
+                cursor,
+                file_path,
+                dangerously_allow_write_access,
+                ingest_cache=ingest_cache,
+                promote_after_scans=promote_after_scans,
+                sample_rows=sample_rows,
+                reader_options=reader_options,
+            )
+        except Exception as e:
+            result = SourceLoadResult(source=file_path, error=str(e))
+        finally:
+            cursor.close()
+        result.seconds = time.perf_counter() - start
+        with print_lock:
+            print(result.summary())
+        return result
+
+    if not concurrent:
+        results = [load(file_path) for file_path in files]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="qabot-loader") as executor:
+            results = list(executor.map(load, files))
+
+    # Attached databases are shared between cursors but the search path is per connection
+    _set_search_path(duckdb_connection)
+    return results
+
+
+def _load_source(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        file_path: str,
+        dangerously_allow_write_access=False,
+        ingest_cache: IngestCache | None = None,
+        promote_after_scans: int | None = 3,
+        sample_rows: int | None = None,
+        reader_options: dict | None = None,
+) -> SourceLoadResult:
+    # Attached databases aren't persisted, so they are always attached again. They are
+    # recorded so saved answers that read them know to attach them, see `session_sources`.
+    if file_path.startswith("postgresql://") or file_path.endswith(".sqlite"):
+        result = _import_source(duckdb_connection, file_path, dangerously_allow_write_access)
+        if result.error is None and result.table_name is not None:
+            fingerprint, size_bytes = source_fingerprint(file_path)
+            duckdb_connection.execute(
+                """insert or replace into qabot_sources (uri, fingerprint, table_name, loaded_at, size_bytes, materialized, attached)
+                values (?, ?, ?, current_timestamp, ?, true, true)""",
+                [file_path, fingerprint, result.table_name, size_bytes],
+            )
+        return result
+
+    reader_options = {name: value for name, value in (reader_options or {}).items() if value is not None}
+    serialized_options = json.dumps(reader_options, sort_keys=True) if reader_options else None
+    fingerprint, size_bytes = source_fingerprint(file_path)
+    previous = duckdb_connection.execute(
+        """select table_name, fingerprint, sample_table, materialized, size_bytes, tail_digest, reader_options
+        from qabot_sources where uri = ?""",
+        [file_path],
+    ).fetchone()
+    result = None
+    if previous is not None:
+        previous_table_name, previous_fingerprint, previous_sample_table, materialized, ingested_bytes, tail_digest, previous_options = previous
+        # A source read with different options has to be read again
+        if fingerprint is not None and previous_options == serialized_options and _relation_is_usable(duckdb_connection, previous_table_name):
+            if fingerprint == previous_fingerprint:
+                result = SourceLoadResult(source=file_path, table_name=previous_table_name, reused=True)
+            else:
+                result = _refresh_in_place(
+                    duckdb_connection, file_path, previous_table_name, materialized,
+                    ingested_bytes, tail_digest, fingerprint, size_bytes, reader_options,
                 )
-                continue
-            # use the filename as the table name
-            table_name, _ = os.path.splitext(os.path.basename(file_path))
-            # remove any non-alphanumeric characters
-            new_table_name = "".join([c for c in table_name if c.isalnum()])
-            duckdb_connection.execute(f"CREATE TABLE {new_table_name} AS select * from st_read('{file_path}');")
-            _set_search_path(duckdb_connection)
-        elif file_path.endswith(".sqlite"):
-            try:
-                duckdb_connection.sql("INSTALL sqlite;")
-                duckdb_connection.sql("LOAD sqlite;")
-            except Exception:
-                print(
-                    "Failed to install sqlite extension. Loading directly from sqlite will not be supported"
+        if result is None:
+            _drop_relation(duckdb_connection, previous_table_name)
+            if previous_sample_table is not None:
+                _drop_relation(duckdb_connection, previous_sample_table)
+
+    if result is None:
+        result = _import_source(
+            duckdb_connection, file_path, dangerously_allow_write_access, ingest_cache,
+            allow_view=promote_after_scans != 0, reader_options=reader_options,
+        )
+        if result.error is not None or result.table_name is None:
+            return result
+        if result.partition_keys:
+            # Copying a partitioned dataset into a table would lose partition pruning
+            promote_after_scans = None
+        duckdb_connection.execute(
+            """insert or replace into qabot_sources
+            (uri, fingerprint, table_name, loaded_at, size_bytes, materialized, promote_after_scans, scan_count, bytes_read, partition_keys, sample_table, tail_digest, reader_options)
+            values (?, ?, ?, current_timestamp, ?, ?, ?, 0, 0, ?, NULL, ?, ?)""",
+            [
+                file_path, fingerprint, result.table_name, size_bytes, not result.is_view, promote_after_scans,
+                result.partition_keys, _tail_digest(file_path, size_bytes) if _is_appendable(file_path) else None,
+                serialized_options,
+            ],
+        )
+
+    if sample_rows:
+        _ensure_sample(duckdb_connection, file_path, result.table_name, sample_rows)
+    return result
+
+
+def refresh_sources(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        tables: list[str] | None = None,
+        sample_rows: int | None = None,
+) -> list[SourceLoadResult]:
+    """
+    Bring loaded file sources (all of them, or those loaded into `tables`) up to date.
+
+    Lines appended to a CSV or NDJSON file that has been loaded into a table are inserted
+    into it, so a refresh costs time in proportion to the new data. Views read their source
+    directly, so new lines - and new files matching a glob - are already visible to them.
+    Sources that were rewritten rather than appended to are re-imported. Attached SQLite
+    and Postgres databases are always read live, so they are skipped.
+
+    The ingest cache isn't used: a source that keeps changing would only ever miss it.
+    Existing samples are kept as they are, they are only an approximation anyway.
+
+    Returns results for the sources that had changed.
+    """
+    sources = duckdb_connection.execute(
+        "select uri, table_name, promote_after_scans, reader_options from qabot_sources where not attached"
+    ).fetchall()
+    results = []
+    for uri, table_name, promote_after_scans, reader_options in sources:
+        if tables and table_name not in tables:
+            continue
+        cursor = duckdb_connection.cursor()
+        start = time.perf_counter()
+        try:
+            result = _load_source(
+                cursor, uri, promote_after_scans=promote_after_scans, sample_rows=sample_rows,
+                reader_options=json.loads(reader_options) if reader_options else None,
+            )
+        except Exception as e:
+            result = SourceLoadResult(source=uri, error=str(e))
+        finally:
+            cursor.close()
+        if result.reused:
+            continue
+        result.seconds = time.perf_counter() - start
+        print(result.summary())
+        results.append(result)
+    return results
+
+
+def _is_appendable(file_path: str) -> bool:
+    return not uri_validator(file_path) and os.path.isfile(file_path) and file_path.lower().endswith(APPENDABLE_EXTENSIONS)
+
+
+def _tail_digest(file_path: str, offset: int, length: int = 4096) -> str:
+    """
+    Hash the `length` bytes before `offset`, which only change if the file is rewritten.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(max(0, offset - length))
+        return hashlib.blake2b(f.read(min(offset, length)), digest_size=16).hexdigest()
+
+
+def _refresh_in_place(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        file_path: str,
+        table_name: str,
+        materialized: bool,
+        ingested_bytes: int | None,
+        tail_digest: str | None,
+        fingerprint: str,
+        size_bytes: int | None,
+        reader_options: dict | None = None,
+) -> SourceLoadResult | None:
+    """
+    Bring a changed source up to date without re-importing it, or return None if it can't be.
+    """
+    if not materialized:
+        # Views over the cached Parquet snapshot of a source would need to be re-imported
+        view_sql = duckdb_connection.execute(
+            "select sql from duckdb_views() where view_name = ? and not internal", [table_name]
+        ).fetchone()
+        if view_sql is None or _dataset_pattern(file_path) not in view_sql[0]:
+            return None
+        duckdb_connection.execute(
+            "update qabot_sources set fingerprint = ?, size_bytes = ?, tail_digest = ? where uri = ?",
+            [fingerprint, size_bytes, _tail_digest(file_path, size_bytes) if _is_appendable(file_path) else None, file_path],
+        )
+        return SourceLoadResult(source=file_path, table_name=table_name, is_view=True, refreshed=True)
+
+    if (
+            not _is_appendable(file_path)
+            or ingested_bytes is None
+            or size_bytes is None
+            or size_bytes < ingested_bytes
+            or _tail_digest(file_path, ingested_bytes) != tail_digest
+    ):
+        return None
+
+    try:
+        duckdb_connection.begin()
+        rows, consumed = _append_new_lines(duckdb_connection, file_path, table_name, ingested_bytes, size_bytes, reader_options)
+        ingested_bytes += consumed
+        duckdb_connection.execute(
+            "update qabot_sources set fingerprint = ?, size_bytes = ?, tail_digest = ? where uri = ?",
+            [fingerprint, ingested_bytes, _tail_digest(file_path, ingested_bytes), file_path],
+        )
+        duckdb_connection.commit()
+    except duckdb.Error:
+        # e.g. the new lines don't match the table's columns
+        duckdb_connection.rollback()
+        return None
+    return SourceLoadResult(source=file_path, table_name=table_name, rows=rows, bytes=consumed, refreshed=True)
+
+
+def _append_new_lines(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        file_path: str,
+        table_name: str,
+        offset: int,
+        size_bytes: int,
+        reader_options: dict | None = None,
+        chunk_size: int = 1024 * 1024,
+) -> tuple[int, int]:
+    """
+    Insert the complete lines between `offset` and `size_bytes` of a file into `table_name`.
+
+    A trailing line that is still being written is left for the next refresh. Returns the
+    number of rows inserted and bytes consumed.
+    """
+    _, extension = os.path.splitext(file_path.lower())
+    with tempfile.NamedTemporaryFile(suffix=extension, delete=False) as new_lines:
+        try:
+            consumed = 0
+            with open(file_path, "rb") as f:
+                f.seek(offset)
+                remaining = size_bytes - offset
+                while remaining > 0 and (chunk := f.read(min(chunk_size, remaining))):
+                    remaining -= len(chunk)
+                    new_lines.write(chunk)
+                    last_newline = chunk.rfind(b"\n")
+                    if last_newline != -1:
+                        consumed = new_lines.tell() - len(chunk) + last_newline + 1
+            new_lines.truncate(consumed)
+            new_lines.close()
+            if consumed == 0:
+                return 0, 0
+
+            if extension in (".jsonl", ".ndjson"):
+                statement = f'insert into "{table_name}" by name select * from {_reader_sql(new_lines.name, reader_options)};'
+            elif reader_options and "columns" in reader_options:
+                statement = f'insert into "{table_name}" select * from {_reader_sql(new_lines.name, {**reader_options, "header": False})};'
+            else:
+                # The new lines have no header row, so use the original file's dialect and
+                # let the insert cast each column to the table's type
+                delimiter = duckdb_connection.execute("select Delimiter from sniff_csv(?)", [file_path]).fetchone()[0]
+                statement = (
+                    f'insert into "{table_name}" select * from '
+                    f"read_csv('{new_lines.name}', delim = '{delimiter}', header = false, all_varchar = true);"
                 )
-                continue
-            #duckdb_connection.execute(f"CALL sqlite_attach('{file_path}')")
-            query = f"ATTACH '{file_path}' as sqlite_db (TYPE SQLITE);"
-            duckdb_connection.execute(query)
-            _set_search_path(duckdb_connection)
+            rows = duckdb_connection.execute(statement).fetchone()[0]
+        finally:
+            os.remove(new_lines.name)
+    return rows, consumed
+
 
-            executed_sql.append(query)
+def _ensure_sample(duckdb_connection: duckdb.DuckDBPyConnection, uri: str, table_name: str, sample_rows: int):
+    """
+    Create a reservoir sample of a source for exploratory queries, unless the source is small.
+    """
+    sample_table = duckdb_connection.execute("select sample_table from qabot_sources where uri = ?", [uri]).fetchone()[0]
+    if sample_table is not None and _relation_is_usable(duckdb_connection, sample_table):
+        return
+
+    sample_table = f"{table_name}__sample"
+    duckdb_connection.execute(
+        f'create or replace table "{sample_table}" as select * from "{table_name}" '
+        f"using sample reservoir({int(sample_rows)} rows) repeatable (42);"
+    )
+    # A reservoir smaller than requested holds the entire source, so it isn't worth sampling
+    if duckdb_connection.sql(f'select count(*) from "{sample_table}";').fetchone()[0] < sample_rows:
+        duckdb_connection.execute(f'drop table "{sample_table}";')
+        sample_table = None
+    duckdb_connection.execute("update qabot_sources set sample_table = ? where uri = ?", [sample_table, uri])
+
+
+def _relation_is_usable(duckdb_connection: duckdb.DuckDBPyConnection, table_name: str) -> bool:
+    try:
+        # Binding also checks that any files behind a view still exist
+        duckdb_connection.sql(f'describe "{table_name}";').fetchall()
+        return True
+    except duckdb.Error:
+        return False
+
+
+def _drop_relation(duckdb_connection: duckdb.DuckDBPyConnection, table_name: str):
+    try:
+        duckdb_connection.execute(f'drop view if exists "{table_name}";')
+    except duckdb.CatalogException:
+        duckdb_connection.execute(f'drop table if exists "{table_name}";')
+
+
+def _import_source(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        file_path: str,
+        dangerously_allow_write_access=False,
+        ingest_cache: IngestCache | None = None,
+        allow_view: bool = True,
+        reader_options: dict | None = None,
+) -> SourceLoadResult:
+    result = SourceLoadResult(source=file_path)
+    # Only count rows of tables we created - counting a view or attached
+    # database would force another (possibly remote) scan
+    created_table = False
+    if not uri_validator(file_path) and os.path.isfile(file_path):
+        result.bytes = os.path.getsize(file_path)
+    ensure_extensions_for(duckdb_connection, file_path)
+
+    if file_path.startswith("postgresql://"):
+        if not ensure_extension(duckdb_connection, "postgres_scanner"):
+            result.error = "Failed to install postgres_scanner extension. Loading directly from postgresql will not be supported"
+            return result
+        db_type = "(TYPE postgres, READ_ONLY)" if not dangerously_allow_write_access else "(TYPE postgres)"
+        duckdb_connection.execute(f"ATTACH '{file_path}' as postgres_db {db_type};")
+        result.table_name = "postgres_db"
+    elif is_dataset(file_path):
+        create_statement, table_name, partition_keys = _load_dataset(duckdb_connection, file_path)
+        result.executed_sql.append(create_statement)
+        result.table_name = table_name
+        result.is_view = True
+        result.partition_keys = partition_keys
+    elif file_path.endswith('.json'):
+        # use the filename as the table name
+        table_name, _ = os.path.splitext(os.path.basename(file_path))
+        # remove any non-alphanumeric characters
+        new_table_name = "".join([c for c in table_name if c.isalnum()])
+        reader_sql = _reader_sql(file_path, reader_options)
+        cached_statement = _create_cached_view(
+            duckdb_connection, new_table_name, reader_sql, file_path, ingest_cache, reader_options
+        )
+        if cached_statement is not None:
+            result.executed_sql.append(cached_statement)
+            result.is_view = True
+        elif allow_view:
+            create_statement = f"CREATE VIEW {new_table_name} AS select * from {reader_sql};"
+            duckdb_connection.execute(create_statement)
+            result.executed_sql.append(create_statement)
+            result.is_view = True
         else:
-            executed_sql.append(
-                load_external_data_into_db(duckdb_connection, file_path)
-            )
+            duckdb_connection.execute(f"CREATE TABLE {new_table_name} AS select * from {reader_sql};")
+            created_table = True
+        result.table_name = new_table_name
+    elif split_sheet(file_path)[0].endswith('.xlsx'):
+        workbook_path, sheet = split_sheet(file_path)
+        if sheet is not None and not uri_validator(workbook_path) and sheet not in (sheets := list_sheets(workbook_path)):
+            result.error = f"Sheet {sheet} not found, the workbook has sheets: {', '.join(sheets)}"
+            return result
+        reader_sql = _excel_reader_sql(duckdb_connection, workbook_path, sheet)
+        if reader_sql is None:
+            result.error = "Failed to install the excel and spatial extensions. Loading directly from Excel files will not be supported"
+            return result
+        # use the filename (and sheet name) as the table name
+        table_name, _ = os.path.splitext(os.path.basename(workbook_path))
+        # remove any non-alphanumeric characters
+        new_table_name = "".join([c for c in table_name if c.isalnum()])
+        if sheet is not None:
+            new_table_name += "_" + "".join([c for c in sheet if c.isalnum()])
+        cached_statement = _create_cached_view(
+            duckdb_connection, new_table_name, reader_sql, workbook_path, ingest_cache,
+            {"sheet": sheet} if sheet is not None else None,
+        )
+        if cached_statement is not None:
+            result.executed_sql.append(cached_statement)
+            result.is_view = True
+        else:
+            # Excel files are slow to read so they are always materialised
+            duckdb_connection.execute(f"CREATE TABLE {new_table_name} AS select * from {reader_sql};")
+            created_table = True
+        result.table_name = new_table_name
+    elif file_path.endswith(".sqlite"):
+        if not ensure_extension(duckdb_connection, "sqlite_scanner"):
+            result.error = "Failed to install sqlite extension. Loading directly from sqlite will not be supported"
+            return result
+        #duckdb_connection.execute(f"CALL sqlite_attach('{file_path}')")
+        query = f"ATTACH '{file_path}' as sqlite_db (TYPE SQLITE);"
+        duckdb_connection.execute(query)
+        result.table_name = "sqlite_db"
+        result.executed_sql.append(query)
+    else:
+        create_statement, table_name, is_view = _load_external_data(
+            duckdb_connection, file_path, allow_view=allow_view, ingest_cache=ingest_cache,
+            reader_options=reader_options,
+        )
+        result.executed_sql.append(create_statement)
+        result.table_name = table_name
+        result.is_view = is_view
+        created_table = not is_view
 
-    return duckdb_connection, executed_sql
+    if created_table:
+        result.rows = duckdb_connection.sql(f'select count(*) from "{result.table_name}";').fetchone()[0]
+
+    return result
+
+
+def _excel_reader_sql(duckdb_connection: duckdb.DuckDBPyConnection, workbook_path: str, sheet: str | None) -> str | None:
+    """
+    Read a sheet with the lightweight excel extension, falling back to the spatial extension's GDAL reader.
+    """
+    if ensure_extension(duckdb_connection, "excel"):
+        return f"read_xlsx('{workbook_path}'" + (f", sheet = {_sql_literal(sheet)})" if sheet is not None else ")")
+    if ensure_extension(duckdb_connection, "spatial"):
+        return f"st_read('{workbook_path}'" + (f", layer = {_sql_literal(sheet)})" if sheet is not None else ")")
+    return None
+
+
+def _load_dataset(duckdb_connection: duckdb.DuckDBPyConnection, file_path: str) -> Tuple[str, str, list[str]]:
+    """
+    Create a single view over a glob or directory of files, e.g. a Hive partitioned dataset.
+
+    The view exposes the partition keys and source filename as columns, so filters on the
+    partition keys let DuckDB skip reading whole partitions.
+    """
+    pattern = _dataset_pattern(file_path)
+    extension = next((e for e in DATASET_READERS if pattern.lower().removesuffix(".gz").endswith(e)), None)
+    if extension is None:
+        raise ValueError(f"Unsupported file type for dataset {file_path}")
+
+    # The glob starts at the first path segment with a wildcard. The table is named after the
+    # last directory before it that isn't a partition (e.g. logs for logs/year=*/month=*/*.parquet),
+    # and partition keys are read from the paths below that directory.
+    segments = pattern.replace("\\", "/").split("/")
+    base_segments = segments[:next(i for i, segment in enumerate(segments) if re.search(r"[*?[]", segment))]
+    while base_segments and "=" in base_segments[-1]:
+        base_segments.pop()
+    base = "/".join(base_segments)
+    table_name, _ = os.path.splitext(os.path.basename(base))
+    table_name = re.sub(r"\W", "_", table_name) or "data"
+
+    sample_paths = [row[0] for row in duckdb_connection.execute("select file from glob(?) limit 1000", [pattern]).fetchall()]
+    if not sample_paths:
+        raise ValueError(f"No files match {file_path}")
+    partition_keys = _partition_keys([path.replace("\\", "/").removeprefix(base) for path in sample_paths])
+
+    create_statement = (
+        f"create view \"{table_name}\" as select * from {DATASET_READERS[extension]}('{pattern}', "
+        f"hive_partitioning = {'true' if partition_keys else 'false'}, union_by_name = true, filename = true);"
+    )
+    duckdb_connection.execute(create_statement)
+    return create_statement, table_name, partition_keys
+
+
+# Schemas of catalog metadata, reading them isn't a scan of any source
+METADATA_SCHEMAS = {"information_schema", "pg_catalog"}
+# Statements that only describe a relation without reading its data
+DESCRIBE_STATEMENT = re.compile(r"^\s*(describe|show|pragma)\b", re.IGNORECASE)
+
+
+def parsed_table_references(duckdb_connection: duckdb.DuckDBPyConnection, sql: str) -> list[dict] | None:
+    """
+    The table references (`BASE_TABLE` nodes) DuckDB's parser finds in a SELECT statement,
+    excluding references to its CTEs, or None for statements it can't serialise.
+    """
+    try:
+        tree = json.loads(duckdb_connection.execute("select json_serialize_sql(?)", [sql]).fetchone()[0])
+    except duckdb.Error:
+        return None
+    if tree.get("error"):
+        return None
+
+    ctes = set()
+    references = []
+
+    def walk(node):
+        if isinstance(node, list):
+            for child in node:
+                walk(child)
+            return
+        if not isinstance(node, dict):
+            return
+        for cte in (node.get("cte_map") or {}).get("map", []):
+            ctes.add(cte["key"].lower())
+        if node.get("type") == "BASE_TABLE":
+            references.append(node)
+        for child in node.values():
+            walk(child)
+
+    walk(tree["statements"])
+    return [
+        node for node in references
+        if node.get("schema_name") or node.get("catalog_name") or node["table_name"].lower() not in ctes
+    ]
+
+
+def _scanned_table_names(duckdb_connection: duckdb.DuckDBPyConnection, sql: str) -> set[str]:
+    if DESCRIBE_STATEMENT.match(sql):
+        return set()
+    references = parsed_table_references(duckdb_connection, sql)
+    if references is None:
+        # e.g. CREATE TABLE AS or COPY, whose SELECT the parser still finds the tables of
+        try:
+            return {name.split(".")[-1].lower() for name in duckdb.get_table_names(sql, qualified=False)}
+        except duckdb.Error:
+            return set()
+    return {
+        node["table_name"].lower() for node in references
+        if (node.get("schema_name") or "").lower() not in METADATA_SCHEMAS and node.get("catalog_name", "").lower() != "system"
+    }
+
+
+def track_source_scans(duckdb_connection: duckdb.DuckDBPyConnection, sql: str, bytes_read: int | None = None) -> list[str]:
+    """
+    Record a scan of every lazily loaded source `sql` reads, materialising any view that has
+    now been scanned often enough to be worth keeping as a table.
+
+    The tables a query reads come from DuckDB's parser, and queries that only read catalog
+    metadata or describe a table aren't scans. `bytes_read` is what the profiler measured
+    the query reading; it is split between the sources scanned in proportion to their size.
+
+    Returns the URIs of the lazily loaded sources the query read.
+
+    Promoted tables live in the main database, so they persist between sessions when
+    qabot is given a database file.
+    """
+    table_names = _scanned_table_names(duckdb_connection, sql)
+    if not table_names:
+        return []
+    sources = [
+        (uri, table_name, promote_after_scans, size_bytes)
+        for uri, table_name, promote_after_scans, size_bytes in duckdb_connection.execute(
+            "select uri, table_name, promote_after_scans, size_bytes from qabot_sources where not materialized"
+        ).fetchall()
+        if table_name.lower() in table_names
+    ]
+    total_size = sum(size_bytes or 0 for *_, size_bytes in sources)
+    scanned = []
+    for uri, table_name, promote_after_scans, size_bytes in sources:
+        scanned.append(uri)
+        share = (size_bytes or 0) / total_size if total_size else 1 / len(sources)
+        scan_count = duckdb_connection.execute(
+            """update qabot_sources set scan_count = scan_count + 1, bytes_read = bytes_read + ?
+            where uri = ? returning scan_count""",
+            [round((bytes_read or 0) * share), uri],
+        ).fetchone()[0]
+        if promote_after_scans is not None and scan_count >= promote_after_scans:
+            _materialize_view(duckdb_connection, uri, table_name)
+    return scanned
+
+
+def _materialize_view(duckdb_connection: duckdb.DuckDBPyConnection, uri: str, table_name: str):
+    cursor = duckdb_connection.cursor()
+    try:
+        # The table holds the file as it is now, which may be more than was there when it was loaded
+        fingerprint, size_bytes = source_fingerprint(uri)
+        cursor.begin()
+        cursor.execute(f'create table "{table_name}__materialized" as select * from "{table_name}";')
+        cursor.execute(f'drop view "{table_name}";')
+        cursor.execute(f'alter table "{table_name}__materialized" rename to "{table_name}";')
+        cursor.execute(
+            """update qabot_sources set materialized = true, fingerprint = ?, size_bytes = ?, tail_digest = ?
+            where uri = ?""",
+            [fingerprint, size_bytes, _tail_digest(uri, size_bytes) if _is_appendable(uri) else None, uri],
+        )
+        cursor.commit()
+    except duckdb.Error as e:
+        cursor.rollback()
+        print(f"Failed to materialise {table_name}: {e}")
+    finally:
+        cursor.close()
+
+
+def _create_cached_view(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        table_name: str,
+        reader_sql: str,
+        file_path: str,
+        ingest_cache: IngestCache | None,
+        reader_options: dict | None = None,
+) -> str | None:
+    """
+    Create a view of `table_name` over the cached Parquet conversion of a source.
+
+    Returns the create statement, or None if the source can't be cached.
+    """
+    if ingest_cache is None or not ingest_cache.is_cacheable(file_path):
+        return None
+    key = ingest_cache.key(file_path, variant=json.dumps(reader_options, sort_keys=True) if reader_options else None)
+    if key is None:
+        return None
+    parquet_path = ingest_cache.get(key)
+    if parquet_path is None:
+        parquet_path = ingest_cache.put(duckdb_connection, key, f"select * from {reader_sql}", file_path)
+    create_statement = f"create view \"{table_name}\" as select * from read_parquet('{parquet_path}');"
+    duckdb_connection.execute(create_statement)
+    return create_statement
 
 
 def _set_search_path(duckdb_connection: duckdb.DuckDBPyConnection):
@@ -105,11 +1048,21 @@ def _set_search_path(duckdb_connection: duckdb.DuckDBPyConnection):
     query = f"set search_path = '{','.join(db_names)}';"
     duckdb_connection.execute(query)
 
+
 def load_external_data_into_db(
     conn: duckdb.DuckDBPyConnection, file_path, allow_view=True
 ):
-    # Work out if the filepath is actually a url (e.g. s3://)
-    is_url = uri_validator(file_path)
+    create_statement, _, _ = _load_external_data(conn, file_path, allow_view)
+    return create_statement
+
+
+def _load_external_data(
+    conn: duckdb.DuckDBPyConnection,
+    file_path,
+    allow_view=True,
+    ingest_cache: IngestCache | None = None,
+    reader_options: dict | None = None,
+) -> Tuple[str, str, bool]:
     # Get the file name without extension from the file_path
     table_name, extension = os.path.splitext(os.path.basename(file_path))
     # If the table_name isn't a valid SQL identifier, we'll need to use something else
@@ -127,27 +1080,33 @@ def load_external_data_into_db(
     except (ParserException, ProgrammingError):
         table_name = "data"
 
+    # Without any options, let DuckDB pick the reader from the file
+    source_sql = (_reader_sql(file_path, reader_options) if reader_options else None) or f"'{file_path}'"
+    cached_statement = _create_cached_view(conn, table_name, source_sql, file_path, ingest_cache, reader_options)
+    if cached_statement is not None:
+        return cached_statement, table_name, True
+
     # try to create a view then fallback to a table if it fails
-    use_view = allow_view and is_url
+    use_view = allow_view
     try:
-        create_statement = f"create {'view' if use_view else 'table'} '{table_name}' as select * from '{file_path}';"
+        create_statement = f"create {'view' if use_view else 'table'} '{table_name}' as select * from {source_sql};"
         conn.sql(create_statement)
-    except duckdb.IOException:
-        # This can occur if the server doesn't send Content-Length headers
-        # We can work around this by downloading the data locally and then
-        # loading it from there. We assume CSV files for now
-        if is_url:
-            with tempfile.NamedTemporaryFile(
-                mode="w+b", suffix=".csv", delete=False
-            ) as f:
-                with httpx.stream("GET", file_path) as r:
-                    for chunk in r.iter_bytes():
-                        if chunk:
-                            f.write(chunk)
-                    f.flush()
-
-                create_statement = f"create table '{table_name}' as select * from read_csv_auto('{f.name}');"
-
+    except duckdb.Error:
+        # This can occur if the server doesn't send Content-Length headers, or if
+        # the httpfs extension isn't available. We can work around this by
+        # downloading the data locally and then loading it from there. The download
+        # is cached, so loading it again only costs a conditional request.
+        if not file_path.startswith(("http://", "https://")):
+            raise
+        use_view = False
+        downloaded_path = download_and_cache(file_path)
+        file_format, compressed = detect_format(downloaded_path)
+        reader = DOWNLOAD_READERS.get(file_format)
+        if reader is None:
+            raise ValueError(f"Unsupported file format '{file_format}' downloaded from {file_path}")
+        # The cached file is named after the URL, so its extension may not say how to read it
+        options = ", compression = 'gzip'" if compressed and reader != "read_parquet" else ""
+        create_statement = f"create table '{table_name}' as select * from {reader}('{downloaded_path}'{options});"
         conn.sql(create_statement)
 
-    return create_statement
+    return create_statement, table_name, use_view
@@ -1,13 +1,17 @@
 import logging
 
+import duckdb
+
 from qabot.functions.duckdb_query import run_sql_catch_error
 
 
-def describe_table_or_view(database, table: str , schema=None, catalog=None):
+def describe_table_or_view(database, table: str , schema=None, catalog=None, track_queries: bool = True):
     """
     Show the column names and types of a local database table or view.
 
     Note if the catalog is not default we don't compute the size of the table.
+    Without `track_queries` the preview isn't logged, see `run_sql_catch_error`. It never counts
+    as a scan of the table's source.
     """
     logging.debug(f"describe_table_or_view({table}, {schema}, {catalog})")
 
@@ -30,8 +34,19 @@ def describe_table_or_view(database, table: str , schema=None, catalog=None):
 
     fully_qualified_table = f"{catalog}.{schema}.{table}"
     logging.debug(fully_qualified_table)
-    # If the catalog is external, we avoid computing the size of the table
-    if catalog == "memory":
+
+    partition_keys = _partition_keys(database, table)
+    if partition_keys:
+        partition_note = (
+            f"\nHive partition columns: {', '.join(partition_keys)}. "
+            f"Filter on these columns so DuckDB only reads the matching partitions."
+        )
+    else:
+        partition_note = ""
+
+    # If the catalog is external, we avoid computing the size of the table.
+    # Counting a partitioned dataset would open every one of its files.
+    if catalog == "memory" and not partition_keys:
         table_count_rows_query = f"select count(*) from {fully_qualified_table};"
         table_size = table_count_rows_query + '\n' + str(database.sql(table_count_rows_query).fetchone()[0])
     else:
@@ -46,7 +61,18 @@ def describe_table_or_view(database, table: str , schema=None, catalog=None):
     joined_names = ", ".join(column_names)
     table_first_rows_query = f"select {joined_names} from {fully_qualified_table} limit 5;"
 
-    table_description = run_sql_catch_error(database, table_columns_and_types_query)
+    table_description = run_sql_catch_error(database, table_columns_and_types_query, track=track_queries)
+
+    table_preview = run_sql_catch_error(database, table_first_rows_query, track=track_queries, count_scans=False)[:4000]
+    return f"{table}\n{table_description}{partition_note}\n\n{table_size}\n{table_first_rows_query}\n{table_preview}"
+
 
-    table_preview = run_sql_catch_error(database, table_first_rows_query)[:4000]
-    return f"{table}\n{table_description}\n\n{table_size}\n{table_first_rows_query}\n{table_preview}"
+def _partition_keys(database, table: str) -> list[str]:
+    try:
+        row = database.execute(
+            "select partition_keys from qabot_sources where table_name = ? and partition_keys is not null limit 1;", [table]
+        ).fetchone()
+    except duckdb.Error:
+        # Not a database created by qabot
+        return []
+    return row[0] if row else []
@@ -1,7 +1,21 @@
+import os
+import re
+
 import duckdb
 
+from qabot.extensions import EXTENSION_TRIGGERS, ensure_extensions_for
+from qabot.functions.data_loader import last_query_profile, parsed_table_references, track_source_scans, uri_validator
+from qabot.postgres_cache import route_to_postgres_cache
+
 
-def run_sql_catch_error(conn, sql: str):
+def run_sql_catch_error(conn, sql: str, track: bool = True, count_scans: bool = True):
+    """
+    Run a query and render its results (or error) as text for the LLM.
+
+    Queries are logged to `qabot_queries` and count as scans of the sources they read,
+    unless `track` is false (e.g. speculative queries the LLM may never ask for). Without
+    `count_scans` the query is logged but isn't a scan (e.g. a table's preview rows).
+    """
     # Remove any backtics from the string
     sql = sql.replace("`", "")
 
@@ -12,10 +26,9 @@ def run_sql_catch_error(conn, sql: str):
         if conn is None:
             return "database connection not available"
 
-        output = conn.sql(sql)
-
-        # Store the query in the database
-        conn.execute("INSERT INTO qabot_queries (query) VALUES (?)", [sql])
+        ensure_extensions_for(conn, sql)
+        # The original query is the one that is tracked and logged
+        output = conn.sql(route_to_postgres_cache(conn, sql) if track else sql)
 
         if output is None:
             rendered_output = "No output"
@@ -33,6 +46,9 @@ def run_sql_catch_error(conn, sql: str):
                 rendered_output = ",".join(output.columns) + "\n" + rendered_data
             except AttributeError:
                 rendered_output = str(output)
+
+        if track:
+            _record_query(conn, sql, count_scans)
         if len(rendered_output) > 10_000:
             print("Cutting database output to 10_000 characters")
             return rendered_output[:10_000] + "\n\nDB OUTPUT TRUNCATED\n"
@@ -44,3 +60,126 @@ def run_sql_catch_error(conn, sql: str):
         return str(e)
     # except Exception as e:
     #     return str(e)
+
+
+def _record_query(conn, sql: str, count_scans: bool = True):
+    profile = last_query_profile(conn)
+    # Only once the results are fetched, as this may materialise the views the query read
+    scanned_sources = track_source_scans(conn, sql, profile.get("total_bytes_read")) if count_scans else []
+    reads_remote = bool(EXTENSION_TRIGGERS["httpfs"].search(sql)) or any(uri_validator(uri) for uri in scanned_sources)
+
+    # Store the query in the database
+    conn.execute(
+        "INSERT INTO qabot_queries (query, bytes_read, reads_remote, peak_memory_bytes, spill_bytes) VALUES (?, ?, ?, ?, ?)",
+        [
+            sql, profile.get("total_bytes_read"), reads_remote,
+            profile.get("system_peak_buffer_memory"), profile.get("system_peak_temp_dir_size"),
+        ],
+    )
+
+
+# COPY options for each file type results can be exported as
+EXPORT_FORMATS = {
+    ".parquet": "format parquet",
+    ".csv": "format csv, header true",
+    ".tsv": "format csv, header true, delimiter '\\t'",
+    ".json": "format json, array true",
+    ".jsonl": "format json",
+    ".ndjson": "format json",
+}
+
+
+def export_result(conn, sql: str, path: str) -> str:
+    """
+    Write the results of a query straight to a Parquet, CSV or JSON file with `COPY ... TO`.
+
+    The rows never pass through Python or the LLM, only the path, row count and size of the
+    file are returned. The format is chosen by the file extension, and a `.gz` or `.zst`
+    suffix compresses CSV and JSON files.
+    """
+    sql = sql.replace("`", "").strip().rstrip(";")
+    extension = os.path.splitext(path.removesuffix(".gz").removesuffix(".zst"))[1].lower()
+    if extension not in EXPORT_FORMATS:
+        return f"Error: can't export to {path}, use one of the extensions {', '.join(EXPORT_FORMATS)}"
+    if conn is None:
+        return "database connection not available"
+
+    escaped_path = path.replace("'", "''")
+    try:
+        ensure_extensions_for(conn, f"{sql} {path}")
+        row_count = conn.execute(
+            f"COPY ({route_to_postgres_cache(conn, sql)}) TO '{escaped_path}' ({EXPORT_FORMATS[extension]})"
+        ).fetchone()[0]
+        _record_query(conn, sql)
+    except duckdb.Error as e:
+        return str(e)
+
+    size = f", {os.path.getsize(path) / 1_000_000:,.1f} MB" if os.path.exists(path) else ""
+    return f"Exported {row_count:,} rows to {path}{size}"
+
+
+# Read only statements that can safely be answered from a sample
+EXPLORATORY_STATEMENT = re.compile(r"^\s*(select|with|from|describe|summarize|pivot|unpivot)\b", re.IGNORECASE)
+
+
+def _table_references(conn, sql: str) -> list[tuple[int, int, str, str]]:
+    """
+    The byte offsets, names and aliases (empty if none) of the unqualified table references
+    in a SELECT statement, as found by DuckDB's parser. References to CTEs are excluded, and
+    other statements have none.
+    """
+    references = []
+    encoded = sql.encode()
+    for node in parsed_table_references(conn, sql) or []:
+        if node.get("schema_name") or node.get("catalog_name"):
+            continue
+        start, name = node.get("query_location"), node["table_name"]
+        if start is not None and start < len(encoded):
+            if encoded[start:start + 1] == b'"':
+                end = encoded.find(b'"', start + 1) + 1
+            else:
+                end = start + len(name.encode())
+            # Only if the reference is where the parser says, e.g. not for table functions
+            if end > start and encoded[start:end].decode().strip('"').lower() == name.lower():
+                references.append((start, end, name, node.get("alias") or ""))
+    return sorted(references)
+
+
+def run_exploratory_sql(conn, sql: str):
+    """
+    Run an exploratory query, reading the sample of any large source it references
+    instead of the full data.
+
+    Results computed from a sample are labelled as approximate. Statements that create
+    or modify tables always run against the full data.
+    """
+    samples = {}
+    if conn is not None and EXPLORATORY_STATEMENT.match(sql):
+        try:
+            samples = dict(conn.execute(
+                "select table_name, sample_table from qabot_sources where sample_table is not null"
+            ).fetchall())
+        except duckdb.Error:
+            pass
+
+    sampled_tables = []
+    if samples:
+        samples = {table_name.lower(): sample_table for table_name, sample_table in samples.items()}
+        encoded = sql.encode()
+        # Replace from the end, so the offsets of earlier references stay valid
+        for start, end, table_name, alias in reversed(_table_references(conn, sql)):
+            if table_name.lower() in samples:
+                # Keep the table's name for the query's qualified column references, e.g. titanic.Name
+                replacement = f'"{samples[table_name.lower()]}"' if alias else f'"{samples[table_name.lower()]}" AS "{table_name}"'
+                encoded = encoded[:start] + replacement.encode() + encoded[end:]
+                sampled_tables.append(table_name)
+        sql = encoded.decode()
+        sampled_tables = list(dict.fromkeys(reversed(sampled_tables)))
+
+    output = run_sql_catch_error(conn, sql)
+    if not sampled_tables:
+        return output
+    return (
+        f"APPROXIMATE: computed from random samples of {', '.join(sampled_tables)}. Counts and sums are not scaled "
+        f"to the full data. The query in your answer will be re-run against the full data.\n{output}"
+    )
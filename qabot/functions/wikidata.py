@@ -1,4 +1,13 @@
-import httpx
+import asyncio
+import hashlib
+import json
+import re
+from datetime import datetime, timedelta
+
+import duckdb
+
+from qabot.functions.data_loader import CACHE_DATABASE
+from qabot.http_client import get_client
 
 
 class WikiDataQueryTool:
@@ -43,27 +52,169 @@ class WikiDataQueryTool:
     description = """Useful for when you need specific data from Wikidata.
     Input to this tool is a single correct SPARQL statement for Wikidata. Limit all requests to 10 or fewer rows. 
     
-    Output is the raw response in json. If the query is not correct, an error message will be returned. 
-    If an error is returned, you may rewrite the query and try again. If you are unsure about the response
-    you can try rewrite the query and try again. Prefer local data before using this tool.
+    Output is the name of a table holding the results, and a preview of them. If the query is not correct, an
+    error message will be returned. If an error is returned, you may rewrite the query and try again. If you are
+    unsure about the response you can try rewrite the query and try again. Prefer local data before using this tool.
     """
     base_url: str = "https://query.wikidata.org/sparql"
-    httpx_client: httpx.AsyncClient = None
 
-    def __init__(self, *args, **kwargs):
+    def __init__(
+            self,
+            duckdb_connection: duckdb.DuckDBPyConnection | None = None,
+            cache_ttl: timedelta = timedelta(days=1),
+            preview_rows: int = 10,
+            *args,
+            **kwargs,
+    ):
+        """
+        Responses are cached by (whitespace normalised) query for `cache_ttl` in the cache
+        database (see `attach_cache_database`), and each result is landed in a typed table
+        so it can be queried and joined with local data. Without a connection the tool only
+        returns a preview of the results.
+        """
         super().__init__(*args, **kwargs)
-        self.httpx_client = httpx.AsyncClient()
+        self.duckdb_connection = duckdb_connection
+        self.cache_ttl = cache_ttl
+        self.preview_rows = preview_rows
 
     def _run(self, query: str) -> str:
-        r = httpx.get(
-            self.base_url, params={"format": "json", "query": query}, timeout=60
-        )
-        data = r.text  # no point parsing the json
-        return data
+        response = self._cached_response(query)
+        if response is None:
+            r = get_client().get(
+                self.base_url, params={"format": "json", "query": query}, timeout=60
+            )
+            if r.status_code != 200:
+                # Wikidata explains malformed queries in the response body
+                return r.text
+            response = r.text
+            self._cache_response(query, response)
+        return self._land_results(query, response)
 
     async def _arun(self, query: str) -> str:
-        r = await self.httpx_client.get(
-            self.base_url, params={"format": "json", "query": query}, timeout=60
+        # Share the pooled, rate limited client rather than opening another
+        return await asyncio.to_thread(self._run, query)
+
+    def _cached_response(self, query: str) -> str | None:
+        if self.duckdb_connection is None:
+            return None
+        cache_table = _cache_table(self.duckdb_connection)
+        row = self.duckdb_connection.execute(
+            f"select response from {cache_table} where query_hash = ? and fetched_at >= ?",
+            [_query_hash(query), datetime.now() - self.cache_ttl],
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def _cache_response(self, query: str, response: str):
+        if self.duckdb_connection is None:
+            return
+        self.duckdb_connection.execute(
+            f"insert or replace into {_cache_table(self.duckdb_connection)} values (?, ?, ?, ?)",
+            [_query_hash(query), _normalise_query(query), response, datetime.now()],
         )
-        data = r.text
-        return data
+
+    def _land_results(self, query: str, response: str) -> str:
+        try:
+            data = json.loads(response)
+            columns = data["head"]["vars"]
+            bindings = data["results"]["bindings"]
+        except (ValueError, KeyError, TypeError):
+            return response
+
+        rows = [[binding.get(column, {}).get("value") for column in columns] for binding in bindings]
+        types = {column: _column_type(column, bindings) for column in columns}
+        if self.duckdb_connection is None:
+            return _render(columns, rows[:self.preview_rows], len(rows))
+
+        table_name = f"wikidata_{_query_hash(query)[:10]}"
+        cursor = self.duckdb_connection.cursor()
+        try:
+            # Land the raw values, then cast them to their SPARQL datatypes
+            cursor.execute(
+                f"create or replace temp table {table_name}_raw ("
+                + ", ".join(f'"{column}" VARCHAR' for column in columns) + ");"
+            )
+            if rows:
+                cursor.executemany(
+                    f"insert into {table_name}_raw values ({', '.join('?' for _ in columns)});", rows
+                )
+            for column, duckdb_type in types.items():
+                # e.g. BCE dates don't fit a TIMESTAMP, so keep the original values
+                if duckdb_type != "VARCHAR" and cursor.sql(
+                    f'select count(*) from {table_name}_raw where "{column}" is not null and try_cast("{column}" as {duckdb_type}) is null;'
+                ).fetchone()[0]:
+                    types[column] = "VARCHAR"
+            cursor.execute(
+                f"create or replace table {table_name} as select "
+                + ", ".join(f'try_cast("{column}" as {types[column]}) as "{column}"' for column in columns)
+                + f" from {table_name}_raw;"
+            )
+            cursor.execute(f"drop table {table_name}_raw;")
+            preview = cursor.sql(f"select * from {table_name} limit {self.preview_rows};").fetchall()
+        finally:
+            cursor.close()
+
+        rendered_columns = ", ".join(f"{column} {types[column]}" for column in columns)
+        return (
+            f"Stored {len(rows)} rows in table {table_name} ({rendered_columns}). "
+            f"Query it with SQL to aggregate or join with other tables.\n"
+            + _render(columns, preview, len(rows))
+        )
+
+
+# XML schema datatypes of SPARQL literals, and the DuckDB types they are stored as
+XSD = "http://www.w3.org/2001/XMLSchema#"
+XSD_TYPES = {
+    "BIGINT": {"integer", "int", "long", "short", "byte", "nonNegativeInteger", "positiveInteger", "negativeInteger", "nonPositiveInteger", "unsignedInt", "unsignedLong"},
+    "DOUBLE": {"decimal", "double", "float"},
+    "BOOLEAN": {"boolean"},
+    "DATE": {"date"},
+    "TIMESTAMPTZ": {"dateTime"},
+}
+
+
+def _column_type(column: str, bindings: list[dict]) -> str:
+    """
+    The DuckDB type able to hold every value of a SPARQL result variable.
+    """
+    datatypes = {
+        binding[column].get("datatype", "").removeprefix(XSD) if binding[column].get("type") in ("literal", "typed-literal") else None
+        for binding in bindings
+        if column in binding
+    }
+    for duckdb_type, xsd_types in XSD_TYPES.items():
+        if datatypes and datatypes <= xsd_types:
+            return duckdb_type
+    if datatypes and datatypes <= XSD_TYPES["BIGINT"] | XSD_TYPES["DOUBLE"]:
+        return "DOUBLE"
+    return "VARCHAR"
+
+
+def _render(columns: list[str], rows: list, total_rows: int) -> str:
+    rendered = "\n".join([",".join(columns)] + [",".join(str(value) for value in row) for row in rows])
+    if total_rows > len(rows):
+        rendered += f"\n... {total_rows - len(rows)} more rows"
+    return rendered
+
+
+def _normalise_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip()
+
+
+def _query_hash(query: str) -> str:
+    return hashlib.blake2b(_normalise_query(query).encode(), digest_size=16).hexdigest()
+
+
+def _cache_table(duckdb_connection: duckdb.DuckDBPyConnection) -> str:
+    cache_database = CACHE_DATABASE if _is_attached(duckdb_connection, CACHE_DATABASE) else None
+    cache_table = f"{cache_database}.main.qabot_wikidata_cache" if cache_database else "qabot_wikidata_cache"
+    duckdb_connection.execute(
+        f"create table if not exists {cache_table}"
+        "(query_hash VARCHAR PRIMARY KEY, query VARCHAR, response VARCHAR, fetched_at TIMESTAMP);"
+    )
+    return cache_table
+
+
+def _is_attached(duckdb_connection: duckdb.DuckDBPyConnection, database_name: str) -> bool:
+    return duckdb_connection.execute(
+        "select count(*) from duckdb_databases() where database_name = ?", [database_name]
+    ).fetchone()[0] > 0
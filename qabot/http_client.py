@@ -0,0 +1,177 @@
+import atexit
+import threading
+import time
+from dataclasses import dataclass
+
+import httpx
+
+try:
+    import h2  # noqa: F401 - installed with httpx[http2]
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+@dataclass
+class HostLimits:
+    """
+    How hard a single host may be hit: concurrent requests, and optionally requests per second.
+    """
+    max_concurrent: int = 8
+    requests_per_second: float | None = None
+
+
+# Wikidata's query service allows 5 concurrent queries per client, and throttles bursts
+DEFAULT_HOST_LIMITS = {
+    "query.wikidata.org": HostLimits(max_concurrent=5, requests_per_second=1.0),
+}
+
+
+class _HostThrottle:
+    def __init__(self, limits: HostLimits):
+        self._semaphore = threading.BoundedSemaphore(limits.max_concurrent)
+        self._interval = 1 / limits.requests_per_second if limits.requests_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def acquire(self):
+        self._semaphore.acquire()
+        if self._interval:
+            # Space requests out evenly rather than allowing bursts
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start)
+                self._next_start = start + self._interval
+            if start > now:
+                time.sleep(start - now)
+
+    def release(self):
+        self._semaphore.release()
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """
+    A response body that gives back its host's concurrency slot once it is closed.
+    """
+
+    def __init__(self, stream: httpx.SyncByteStream, release):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+
+class ThrottledTransport(httpx.BaseTransport):
+    """
+    Applies per host concurrency and rate limits to requests sent through another transport.
+
+    A request holds its host's slot until its response has been read or closed, so
+    streamed downloads count against the limit for as long as they are running.
+    """
+
+    def __init__(self, transport: httpx.BaseTransport, host_limits: dict[str, HostLimits], default_limits: HostLimits):
+        self._transport = transport
+        self._host_limits = host_limits
+        self._default_limits = default_limits
+        self._throttles: dict[str, _HostThrottle] = {}
+        self._lock = threading.Lock()
+
+    def _throttle(self, host: str) -> _HostThrottle:
+        with self._lock:
+            if host not in self._throttles:
+                self._throttles[host] = _HostThrottle(self._host_limits.get(host, self._default_limits))
+            return self._throttles[host]
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        throttle = self._throttle(request.url.host)
+        throttle.acquire()
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException:
+            throttle.release()
+            raise
+        response.stream = _ReleasingStream(response.stream, throttle.release)
+        return response
+
+    def close(self):
+        self._transport.close()
+
+
+_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+_client_options = {
+    "max_connections": 20,
+    "timeout": 60.0,
+    "host_limits": dict(DEFAULT_HOST_LIMITS),
+}
+
+
+def configure_http_client(
+        max_connections: int = 20,
+        timeout: float = 60.0,
+        host_limits: dict[str, dict] | None = None,
+):
+    """
+    Configure the process wide HTTP client, see `get_client`.
+
+    `host_limits` maps a host name to the options of a `HostLimits`, and is merged over
+    the defaults (which limit Wikidata).
+    """
+    with _client_lock:
+        _client_options["max_connections"] = max_connections
+        _client_options["timeout"] = timeout
+        _client_options["host_limits"] = {
+            **DEFAULT_HOST_LIMITS,
+            **{host: HostLimits(**limits) for host, limits in (host_limits or {}).items()},
+        }
+    # Any client created with the old options is replaced on next use
+    close_http_client()
+
+
+def get_client() -> httpx.Client:
+    """
+    The HTTP client shared by everything in the process that talks to remote servers.
+
+    Connections are pooled and kept alive between requests, HTTP/2 is used when the `h2`
+    package is installed, and each host is subject to the configured `HostLimits`.
+    The client is closed when the process exits.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            limits = httpx.Limits(
+                max_connections=_client_options["max_connections"],
+                max_keepalive_connections=_client_options["max_connections"],
+            )
+            transport = ThrottledTransport(
+                httpx.HTTPTransport(http2=HTTP2_AVAILABLE, limits=limits, retries=2),
+                _client_options["host_limits"],
+                HostLimits(),
+            )
+            _client = httpx.Client(
+                transport=transport,
+                timeout=httpx.Timeout(_client_options["timeout"], connect=10.0),
+                follow_redirects=True,
+            )
+        return _client
+
+
+def close_http_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+atexit.register(close_http_client)
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+from datetime import datetime
+
+import duckdb
+import httpx
+
+from qabot.download_utils import evict_lru, get_cache_dir, write_json_atomic
+from qabot.http_client import get_client
+
+# Sources that are worth converting to Parquet - parquet files are already cheap to scan
+CACHEABLE_EXTENSIONS = (
+    ".csv", ".tsv", ".txt", ".json", ".jsonl", ".ndjson", ".xlsx",
+    ".csv.gz", ".tsv.gz", ".json.gz", ".jsonl.gz", ".ndjson.gz",
+)
+
+
+def _file_digest(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class IngestCache:
+    """
+    A content addressed cache of sources converted to Parquet.
+
+    Each source is keyed by a hash of its content (or its URL and HTTP ETag for remote
+    sources). Hashing a large local file is still much cheaper than parsing it, and the
+    hash is remembered against the file's path, size and mtime so unchanged files are
+    only hashed once. The least recently used entries are evicted once the cache
+    exceeds `max_size_bytes`, except those this process has used and those any view in
+    the database reads, as evicting them would break the views.
+    """
+
+    def __init__(
+            self,
+            cache_dir: str | None = None,
+            max_size_bytes: int = 10 * 1024 ** 3,
+            refresh: bool = False,
+    ):
+        self.cache_dir = cache_dir or os.path.join(get_cache_dir("qabot"), "ingest")
+        self.max_size_bytes = max_size_bytes
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        # Keys of the entries this process's views may read
+        self._in_use: set[str] = set()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._hash_index_path = os.path.join(self.cache_dir, "hashes.json")
+
+    @staticmethod
+    def is_cacheable(file_path: str) -> bool:
+        return file_path.lower().endswith(CACHEABLE_EXTENSIONS)
+
+    def key(self, file_path: str, variant: str | None = None) -> str | None:
+        """
+        Compute the cache key for a source, or None if the source can't be fingerprinted.
+
+        `variant` distinguishes conversions of the same source with different reader options.
+        """
+        extension = next(e for e in CACHEABLE_EXTENSIONS if file_path.lower().endswith(e))
+        if file_path.startswith(("http://", "https://")):
+            try:
+                response = get_client().head(file_path, timeout=10)
+                response.raise_for_status()
+            except httpx.HTTPError:
+                return None
+            etag = response.headers.get("etag")
+            if etag is None:
+                return None
+            content_id = f"{file_path}|{etag}"
+        elif os.path.isfile(file_path):
+            content_id = self._local_content_hash(file_path)
+        else:
+            return None
+        if variant is not None:
+            content_id = f"{content_id}|{variant}"
+        return hashlib.blake2b(f"{content_id}|{extension}".encode(), digest_size=20).hexdigest()
+
+    def _local_content_hash(self, file_path: str) -> str:
+        stat = os.stat(file_path)
+        index_key = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        with self._lock:
+            index = self._read_hash_index()
+        if index_key in index:
+            return index[index_key]
+
+        digest = _file_digest(file_path)
+        with self._lock:
+            index = self._read_hash_index()
+            index[index_key] = digest
+            write_json_atomic(self._hash_index_path, index)
+        return digest
+
+    def _read_hash_index(self) -> dict:
+        try:
+            with open(self._hash_index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def parquet_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def get(self, key: str) -> str | None:
+        """
+        Return the path of the cached Parquet for `key`, marking it as recently used.
+        """
+        path = self.parquet_path(key)
+        if self.refresh or not os.path.exists(path):
+            return None
+        os.utime(path)
+        with self._lock:
+            self._in_use.add(key)
+        return path
+
+    def put(self, conn: duckdb.DuckDBPyConnection, key: str, select_sql: str, source: str) -> str:
+        """
+        Write the result of `select_sql` to the cache as Parquet and return its path.
+        """
+        path = self.parquet_path(key)
+        with self._lock:
+            self._in_use.add(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            conn.execute(f"COPY ({select_sql}) TO '{tmp_path}' (FORMAT parquet);")
+            schema = conn.sql(f"DESCRIBE select * from read_parquet('{tmp_path}');").fetchall()
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        write_json_atomic(
+            os.path.join(self.cache_dir, f"{key}.json"),
+            {
+                "source": source,
+                "created": datetime.now().isoformat(),
+                "columns": [{"name": row[0], "type": row[1]} for row in schema],
+            },
+        )
+        self.evict(conn)
+        return path
+
+    def metadata(self, key: str) -> dict:
+        """
+        The source, creation time, schema and conversion peak memory recorded for `key`.
+        """
+        try:
+            with open(os.path.join(self.cache_dir, f"{key}.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def evict(self, conn: duckdb.DuckDBPyConnection | None = None):
+        """
+        Remove the least recently used entries until the cache fits within its size limit.
+
+        Entries used by this process, or read by a view in `conn`'s database (including
+        views a persistent database kept from earlier sessions), are kept.
+        """
+        keep = {"hashes"}
+        if conn is not None:
+            keep.update(self.referenced_keys(conn))
+        with self._lock:
+            evict_lru(self.cache_dir, self.max_size_bytes, keep=tuple(keep | self._in_use))
+
+    def referenced_keys(self, conn: duckdb.DuckDBPyConnection) -> set[str]:
+        """
+        The keys of the entries read by the views in the database.
+        """
+        pattern = re.compile(rf"{re.escape(self.cache_dir.rstrip(os.sep))}[/\\\\]([0-9a-f]+)\.parquet")
+        keys = set()
+        for (sql,) in conn.execute("select sql from duckdb_views() where not internal").fetchall():
+            keys.update(pattern.findall(sql or ""))
+        return keys
@@ -0,0 +1,182 @@
+import re
+from dataclasses import dataclass
+
+import duckdb
+
+from qabot.config import AgentModelConfig
+
+# The model tier each kind of step is sent to by default, see `classify_step`
+DEFAULT_STEP_TIERS = {
+    # Working out how to approach a new question
+    "plan": "default",
+    # Choosing the next table to look at after listing or describing tables
+    "explore": "fast",
+    # Deciding what to do with a successful query's result, usually answering
+    "summarise": "fast",
+    # Formatting the final answer
+    "answer": "fast",
+    # Fixing a query (or other call) that failed
+    "recover": "strong",
+    # Still no answer after half the iterations
+    "stuck": "strong",
+    "other": "default",
+}
+
+EXPLORATION_FUNCTIONS = {"show_tables", "describe_table", "load_data"}
+QUERY_FUNCTIONS = {"execute_sql"}
+# DuckDB errors are returned as e.g. "Binder Error: ..." by `run_sql_catch_error`
+ERROR_OUTPUT = re.compile(r"^(?:[A-Z][A-Za-z ]*)?Error\b")
+
+
+@dataclass
+class RoutedStep:
+    step: str
+    tier: str
+    model: str
+    iteration: int
+
+
+def is_error_output(content: str | None) -> bool:
+    if not content:
+        return False
+    if content.startswith("APPROXIMATE:"):
+        # Results of sampled exploration are prefixed by a note, see `run_exploratory_sql`
+        content = content.partition("\n")[2]
+    return bool(ERROR_OUTPUT.match(content.lstrip()))
+
+
+def message_field(message, name):
+    # Messages are a mix of dicts we build and message objects returned by the API
+    return message.get(name) if isinstance(message, dict) else getattr(message, name, None)
+
+
+def _last_tool_outcome(messages) -> tuple[str | None, bool]:
+    """
+    The name of the function the last tool message is the result of, and whether it failed.
+    """
+    tool_message = messages[-1]
+    call_id = message_field(tool_message, "tool_call_id")
+    for message in reversed(messages[:-1]):
+        for tool_call in message_field(message, "tool_calls") or []:
+            if message_field(tool_call, "id") == call_id:
+                return message_field(message_field(tool_call, "function"), "name"), is_error_output(message_field(tool_message, "content"))
+    return None, is_error_output(message_field(tool_message, "content"))
+
+
+def classify_step(messages, iteration: int, max_iterations: int, forced_function_call=None) -> str:
+    """
+    Classify the next LLM step from the conversation so far.
+    """
+    if forced_function_call is not None and forced_function_call.get("name") == "answer":
+        return "answer"
+    last_role = message_field(messages[-1], "role")
+    if last_role == "user":
+        return "plan"
+    if last_role != "tool":
+        return "other"
+
+    function_name, failed = _last_tool_outcome(messages)
+    if failed:
+        return "recover"
+    if iteration >= max_iterations // 2:
+        return "stuck"
+    if function_name in EXPLORATION_FUNCTIONS:
+        return "explore"
+    if function_name in QUERY_FUNCTIONS:
+        return "summarise"
+    return "other"
+
+
+class ModelRouter:
+    """
+    Picks the model for each agent step, and records how each model tier performs.
+
+    Routine steps (exploring tables, formatting an answer) go to the fast model, planning
+    to the default model, and steps recovering from a failed query escalate to the strong
+    (planning) model. `step_tiers` overrides the tier of any kind of step, see
+    `DEFAULT_STEP_TIERS`.
+
+    The latency and success of every step is kept in `qabot_model_steps` when a database
+    is given, so the policy can be tuned from real sessions.
+    """
+
+    def __init__(
+            self,
+            models: AgentModelConfig,
+            duckdb_connection: duckdb.DuckDBPyConnection | None = None,
+            max_iterations: int = 20,
+    ):
+        self.tier_models = {
+            "fast": models.fast_model_name or models.default_model_name,
+            "default": models.default_model_name,
+            "strong": models.escalation_model_name or models.planning_model_name,
+        }
+        self.step_tiers = {**DEFAULT_STEP_TIERS, **models.step_tiers}
+        unknown_tiers = set(self.step_tiers.values()) - set(self.tier_models)
+        if unknown_tiers:
+            raise ValueError(f"Unknown model tiers {sorted(unknown_tiers)}, expected one of {sorted(self.tier_models)}")
+        self.max_iterations = max_iterations
+        self.db = duckdb_connection
+        self.steps: list[dict] = []
+        if self.db is not None:
+            self.db.sql(
+                """create table if not exists qabot_model_steps(
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    step VARCHAR,
+                    tier VARCHAR,
+                    model VARCHAR,
+                    iteration INTEGER,
+                    latency_ms DOUBLE,
+                    success BOOLEAN,
+                    prompt_tokens INTEGER,
+                    completion_tokens INTEGER
+                );"""
+            )
+
+    def route(self, messages, iteration: int, forced_function_call=None) -> RoutedStep:
+        step = classify_step(messages, iteration, self.max_iterations, forced_function_call)
+        tier = self.step_tiers[step]
+        return RoutedStep(step=step, tier=tier, model=self.tier_models[tier], iteration=iteration)
+
+    def record(self, routed: RoutedStep, latency: float, success: bool, usage=None):
+        record = {
+            "step": routed.step,
+            "tier": routed.tier,
+            "model": routed.model,
+            "iteration": routed.iteration,
+            "latency_ms": latency * 1000,
+            "success": success,
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None),
+        }
+        self.steps.append(record)
+        if self.db is not None:
+            try:
+                self.db.execute(
+                    f"insert into qabot_model_steps ({', '.join(record)}) values ({', '.join('?' * len(record))})",
+                    list(record.values()),
+                )
+            except duckdb.Error:
+                # Tracing must never break a session
+                pass
+
+    def summary(self) -> dict[str, dict]:
+        """
+        Steps, success rate and mean latency of each tier used in this session.
+        """
+        tiers = {}
+        for record in self.steps:
+            tier = tiers.setdefault(record["tier"], {"model": record["model"], "steps": 0, "successes": 0, "latency_ms": 0.0})
+            tier["steps"] += 1
+            tier["successes"] += record["success"]
+            tier["latency_ms"] += record["latency_ms"]
+        return {
+            name: {
+                "model": tier["model"],
+                "steps": tier["steps"],
+                "success_rate": tier["successes"] / tier["steps"],
+                "mean_latency_ms": tier["latency_ms"] / tier["steps"],
+            }
+            for name, tier in tiers.items()
+        }
+
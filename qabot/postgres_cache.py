@@ -0,0 +1,202 @@
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import duckdb
+
+# The name postgres sources are attached as, see `_import_source`
+POSTGRES_DATABASE = "postgres_db"
+# Local copies of each postgres schema's tables live in a schema of this name plus the postgres schema
+CACHE_SCHEMA_PREFIX = "qabot_pg_cache__"
+
+
+@dataclass
+class CachedTableConfig:
+    """
+    How to keep the local copy of a postgres table up to date.
+
+    With a `watermark` column (e.g. `updated_at` or an increasing id) only rows past the
+    highest watermark already copied are fetched on refresh; rows with the same `primary_key`
+    are replaced. Without one the whole table is copied again. `filter` is a SQL condition
+    to only copy a slice of the table. Rows deleted in postgres are only removed from the
+    copy by a full copy.
+    """
+    watermark: str | None = None
+    primary_key: str | None = None
+    filter: str | None = None
+
+
+@dataclass
+class _PostgresCacheConfig:
+    tables: dict[str, CachedTableConfig]
+    cache_after_scans: int
+    max_staleness: timedelta
+
+
+_config: _PostgresCacheConfig | None = None
+
+
+def configure_postgres_cache(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        tables: dict[str, dict] | None = None,
+        cache_after_scans: int = 3,
+        max_staleness: timedelta = timedelta(minutes=5),
+):
+    """
+    Copy hot tables of the attached postgres database into local DuckDB storage, and route
+    queries to the copies while they are no older than `max_staleness`.
+
+    Tables named in `tables` ("schema.table" or "table" for the public schema, mapped to the
+    options of a `CachedTableConfig`) are copied the first time they are queried; other
+    tables once they have been queried `cache_after_scans` times.
+    """
+    global _config
+    _config = _PostgresCacheConfig(
+        tables={_qualified_name(name): CachedTableConfig(**options) for name, options in (tables or {}).items()},
+        cache_after_scans=cache_after_scans,
+        max_staleness=max_staleness,
+    )
+    duckdb_connection.sql(
+        """create table if not exists qabot_pg_cache_tables(
+            source VARCHAR PRIMARY KEY,
+            local_table VARCHAR,
+            watermark VARCHAR,
+            refreshed_at TIMESTAMP,
+            scan_count INTEGER DEFAULT 0
+        );"""
+    )
+
+
+def route_to_postgres_cache(duckdb_connection: duckdb.DuckDBPyConnection, sql: str) -> str:
+    """
+    Rewrite the postgres tables `sql` reads from to their local copies, copying or refreshing them as needed.
+
+    Only tables read in a FROM or JOIN clause are routed. The copy keeps the table's name, so
+    column references qualified by the table name still resolve.
+    """
+    if _config is None or not _postgres_attached(duckdb_connection):
+        return sql
+
+    local_names = {
+        row[0].lower()
+        for row in duckdb_connection.execute(
+            "select table_name from duckdb_tables() where database_name = current_database() "
+            "union all select view_name from duckdb_views() where database_name = current_database() and not internal"
+        ).fetchall()
+    }
+    postgres_tables = duckdb_connection.execute(
+        "select schema_name, table_name from duckdb_tables() where database_name = ?", [POSTGRES_DATABASE]
+    ).fetchall()
+    for schema, table in postgres_tables:
+        pattern = _reference_pattern(schema, table, bare_name=schema == "public" and table.lower() not in local_names)
+        if not pattern.search(sql):
+            continue
+        local_table = _local_copy(duckdb_connection, schema, table)
+        if local_table is not None:
+            sql = pattern.sub(lambda match: f"{match.group(1)}{local_table}", sql)
+    return sql
+
+
+def _postgres_attached(duckdb_connection: duckdb.DuckDBPyConnection) -> bool:
+    return duckdb_connection.execute(
+        "select count(*) from duckdb_databases() where database_name = ?", [POSTGRES_DATABASE]
+    ).fetchone()[0] > 0
+
+
+def _qualified_name(name: str) -> str:
+    return name if "." in name else f"public.{name}"
+
+
+def _reference_pattern(schema: str, table: str, bare_name: bool) -> re.Pattern:
+    def identifier(name: str) -> str:
+        return rf'(?:{re.escape(name)}|"{re.escape(name)}")'
+
+    references = [
+        rf"{identifier(POSTGRES_DATABASE)}\.{identifier(schema)}\.{identifier(table)}",
+        rf"{identifier(schema)}\.{identifier(table)}",
+    ]
+    if schema == "public":
+        references.append(rf"{identifier(POSTGRES_DATABASE)}\.{identifier(table)}")
+    if bare_name:
+        references.append(identifier(table))
+    return re.compile(rf'(\b(?:from|join)\s+)(?:{"|".join(references)})(?![\w."])', re.IGNORECASE)
+
+
+def _local_copy(duckdb_connection: duckdb.DuckDBPyConnection, schema: str, table: str) -> str | None:
+    """
+    The local copy of a postgres table, if it is (now) cached and fresh enough to read from.
+    """
+    source = f"{schema}.{table}"
+    table_config = _config.tables.get(source)
+    local_table = f'"{CACHE_SCHEMA_PREFIX}{schema}"."{table}"'
+    scan_count, refreshed_at = duckdb_connection.execute(
+        """insert into qabot_pg_cache_tables (source, local_table, scan_count) values (?, ?, 1)
+        on conflict (source) do update set scan_count = scan_count + 1
+        returning scan_count, refreshed_at""",
+        [source, local_table],
+    ).fetchone()
+
+    if refreshed_at is None and table_config is None and scan_count < _config.cache_after_scans:
+        return None
+    if refreshed_at is not None and datetime.now() - refreshed_at <= _config.max_staleness:
+        return local_table
+
+    try:
+        _refresh_copy(duckdb_connection, schema, table, local_table, table_config or CachedTableConfig(), full=refreshed_at is None)
+    except duckdb.Error as e:
+        # A copy older than the staleness bound isn't used, so the query reads postgres directly
+        print(f"Failed to cache {source} locally: {e}")
+        return None
+    return local_table
+
+
+def _refresh_copy(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        schema: str,
+        table: str,
+        local_table: str,
+        table_config: CachedTableConfig,
+        full: bool,
+):
+    remote_table = f'{POSTGRES_DATABASE}."{schema}"."{table}"'
+    conditions = [f"({table_config.filter})"] if table_config.filter else []
+    parameters = []
+    cursor = duckdb_connection.cursor()
+    try:
+        cursor.begin()
+        if full or table_config.watermark is None:
+            cursor.execute(f'create schema if not exists "{CACHE_SCHEMA_PREFIX}{schema}";')
+            where = f" where {' and '.join(conditions)}" if conditions else ""
+            cursor.execute(f"create or replace table {local_table} as select * from {remote_table}{where};")
+        else:
+            watermark = cursor.sql(f'select max("{table_config.watermark}") from {local_table};').fetchone()[0]
+            if watermark is not None:
+                # A constant comparison is pushed down to postgres, so only new rows are transferred
+                conditions.append(f'"{table_config.watermark}" > ?')
+                parameters.append(watermark)
+            where = f" where {' and '.join(conditions)}" if conditions else ""
+            new_rows = f"select * from {remote_table}{where}"
+            if table_config.primary_key is None:
+                cursor.execute(f"insert into {local_table} {new_rows};", parameters)
+            else:
+                cursor.execute(f"create temp table qabot_pg_cache_delta as {new_rows};", parameters)
+                cursor.execute(
+                    f'delete from {local_table} where "{table_config.primary_key}" in '
+                    f'(select "{table_config.primary_key}" from qabot_pg_cache_delta);'
+                )
+                cursor.execute(f"insert into {local_table} select * from qabot_pg_cache_delta;")
+                cursor.execute("drop table qabot_pg_cache_delta;")
+
+        watermark = None
+        if table_config.watermark is not None:
+            watermark = cursor.sql(f'select max("{table_config.watermark}")::varchar from {local_table};').fetchone()[0]
+        cursor.execute(
+            "update qabot_pg_cache_tables set watermark = ?, refreshed_at = current_localtimestamp() where source = ?",
+            [watermark, f"{schema}.{table}"],
+        )
+        cursor.commit()
+    except duckdb.Error:
+        cursor.rollback()
+        raise
+    finally:
+        cursor.close()
@@ -0,0 +1,208 @@
+import json
+import re
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+
+import duckdb
+
+from qabot.functions.describe_duckdb_table import describe_table_or_view
+from qabot.functions.duckdb_query import EXPLORATORY_STATEMENT
+from qabot.model_router import message_field
+
+# Tool calls that don't change the catalog, so speculative results stay valid across them
+READ_ONLY_FUNCTIONS = {"show_tables", "describe_table", "export_result", "research", "wikidata", "clarify", "answer"}
+
+
+@dataclass
+class _Speculation:
+    catalog: str
+    schema: str
+    table: str
+    future: Future
+    used: bool = False
+
+
+class SpeculativeExecutor:
+    """
+    Predicts the `describe_table` calls the LLM is about to make and runs them in the
+    background on spare cursors while the LLM request is in flight.
+
+    Tables named in the user's question are described after each question, and tables
+    sharing an `*_id` column with a table that was just described (i.e. likely joins)
+    are described after that. Speculative describes aren't logged or counted as scans of
+    their sources, so wasted work never promotes a view to a table.
+
+    At most `max_workers` describes run at once, and at most `max_per_question` are
+    started per question. Results are dropped at the start of each question and once a
+    tool call may have changed the catalog (e.g. loading data or running DDL).
+    """
+
+    def __init__(
+            self,
+            duckdb_connection: duckdb.DuckDBPyConnection,
+            max_workers: int = 2,
+            max_per_question: int = 6,
+    ):
+        self.db = duckdb_connection
+        self.max_per_question = max_per_question
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="qabot-prefetch")
+        self._speculations: dict[tuple[str, str, str], _Speculation] = {}
+        self._started_this_question = 0
+        self.stats = {"speculated": 0, "hits": 0, "wasted": 0, "capped": 0, "seconds_saved": 0.0, "seconds_wasted": 0.0}
+
+    def speculate(self, messages):
+        """
+        Start describing the tables the next LLM step is likely to ask about.
+        """
+        last_message = messages[-1]
+        role = message_field(last_message, "role")
+        if role == "user":
+            self._started_this_question = 0
+            tables = self._tables_mentioned_in(message_field(last_message, "content") or "")
+        elif role == "tool":
+            function_name, arguments = _tool_call_for(messages)
+            if function_name not in READ_ONLY_FUNCTIONS and not (
+                    function_name == "execute_sql" and EXPLORATORY_STATEMENT.match(arguments.get("query", ""))
+            ):
+                self.invalidate()
+                return
+            if function_name == "describe_table" and "table" in arguments:
+                tables = self._join_partners(arguments["table"])
+            elif function_name == "show_tables":
+                tables = self._tables_mentioned_in(_last_user_message(messages))
+            else:
+                return
+        else:
+            return
+
+        for catalog, schema, table in tables:
+            key = (catalog, schema, table.lower())
+            if key in self._speculations:
+                continue
+            if self._started_this_question >= self.max_per_question:
+                self.stats["capped"] += 1
+                continue
+            self._started_this_question += 1
+            self.stats["speculated"] += 1
+            self._speculations[key] = _Speculation(
+                catalog, schema, table, self._pool.submit(self._describe, catalog, schema, table)
+            )
+
+    def describe_table(self, table: str, schema: str = None, catalog: str = None) -> str | None:
+        """
+        The result of a speculative describe of this table, waiting for it if it is still
+        running, or None if it wasn't predicted.
+        """
+        for (spec_catalog, spec_schema, spec_table), speculation in self._speculations.items():
+            if spec_table != table.lower() or (schema and schema != spec_schema) or (catalog and catalog != spec_catalog):
+                continue
+            if speculation.future.cancelled():
+                return None
+            start = time.perf_counter()
+            try:
+                result, seconds = speculation.future.result()
+            except Exception:
+                return None
+            if not speculation.used:
+                speculation.used = True
+                self.stats["hits"] += 1
+                # The time the describe would have taken, less any time spent waiting for it
+                self.stats["seconds_saved"] += max(seconds - (time.perf_counter() - start), 0.0)
+            return result
+        return None
+
+    def invalidate(self):
+        """
+        Drop all speculative results, counting those that were never used as wasted.
+        """
+        for speculation in self._speculations.values():
+            if speculation.used:
+                continue
+            self.stats["wasted"] += 1
+            # Describes still running are left to finish, and not counted
+            if not speculation.future.cancel() and speculation.future.done() and speculation.future.exception() is None:
+                self.stats["seconds_wasted"] += speculation.future.result()[1]
+        self._speculations = {}
+
+    def close(self):
+        self.invalidate()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _describe(self, catalog: str, schema: str, table: str) -> tuple[str, float]:
+        start = time.perf_counter()
+        cursor = self.db.cursor()
+        try:
+            result = describe_table_or_view(cursor, table, schema=schema, catalog=catalog, track_queries=False)
+        finally:
+            cursor.close()
+        return result, time.perf_counter() - start
+
+    def _tables(self) -> list[tuple[str, str, str]]:
+        with self.db.cursor() as cursor:
+            return cursor.execute(
+                "select table_catalog, table_schema, table_name from system.information_schema.tables "
+                "where table_schema != 'information_schema' and table_name not like 'qabot\\_%' escape '\\'"
+            ).fetchall()
+
+    def _tables_mentioned_in(self, text: str) -> list[tuple[str, str, str]]:
+        mentioned = []
+        for catalog, schema, table in self._tables():
+            # "raw_passengers" is mentioned by "raw passenger(s)", and "order" by "orders"
+            words = r"[\s_]".join(re.escape(word) for word in table.removesuffix("s").split("_"))
+            if re.search(rf"\b{words}s?\b", text, re.IGNORECASE):
+                mentioned.append((catalog, schema, table))
+        return mentioned
+
+    def _join_partners(self, table: str) -> list[tuple[str, str, str]]:
+        with self.db.cursor() as cursor:
+            key_columns = [
+                row[0] for row in cursor.execute(
+                    "select distinct column_name from system.information_schema.columns "
+                    "where table_name = ? and lower(column_name) like '%\\_id' escape '\\'",
+                    [table],
+                ).fetchall()
+            ]
+            if not key_columns:
+                return []
+            placeholders = ", ".join("?" * len(key_columns))
+            return cursor.execute(
+                f"select distinct table_catalog, table_schema, table_name from system.information_schema.columns "
+                f"where table_name != ? and table_name not like 'qabot\\_%' escape '\\' and table_schema != 'information_schema' "
+                f"and column_name in ({placeholders})",
+                [table, *key_columns],
+            ).fetchall()
+
+    def summary(self) -> str:
+        stats = self.stats
+        resolved = stats["hits"] + stats["wasted"]
+        hit_rate = stats["hits"] / resolved if resolved else 0.0
+        return (
+            f"Speculative describes: {stats['speculated']} started, {stats['hits']} used ({hit_rate:.0%} hit rate), "
+            f"{stats['wasted']} wasted ({stats['seconds_wasted']:,.2f}s of work), {stats['capped']} skipped by the cap, "
+            f"{stats['seconds_saved']:,.2f}s saved"
+        )
+
+
+def _tool_call_for(messages) -> tuple[str | None, dict]:
+    """
+    The function name and arguments of the call the last (tool) message is the result of.
+    """
+    call_id = message_field(messages[-1], "tool_call_id")
+    for message in reversed(messages[:-1]):
+        for tool_call in message_field(message, "tool_calls") or []:
+            if message_field(tool_call, "id") == call_id:
+                function = message_field(tool_call, "function")
+                try:
+                    arguments = json.loads(message_field(function, "arguments") or "{}")
+                except json.JSONDecodeError:
+                    arguments = {}
+                return message_field(function, "name"), arguments if isinstance(arguments, dict) else {}
+    return None, {}
+
+
+def _last_user_message(messages) -> str:
+    for message in reversed(messages):
+        if message_field(message, "role") == "user":
+            return message_field(message, "content") or ""
+    return ""
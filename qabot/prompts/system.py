@@ -16,6 +16,8 @@ and views for storing intermediate results.
 
 Unless the user specifies in their question a specific number of examples to obtain, limit 
 select queries to 20 results.
+When the user wants the data itself (e.g. "a CSV of all rock listeners") write it to a file 
+with `export_result` rather than selecting all the rows.
 
 Pay attention to use only the column names that you can see in the schema description. Pay attention
 to which column is in which table.
@@ -0,0 +1,83 @@
+import os
+from datetime import datetime
+
+import duckdb
+
+from qabot.download_utils import evict_lru, get_cache_dir
+from qabot.extensions import ensure_extension, on_extension_loaded
+
+
+def configure_remote_caching(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        http_metadata_cache: bool = True,
+        object_cache: bool = True,
+        external_file_cache: bool = True,
+        block_cache: bool = False,
+        block_cache_dir: str | None = None,
+        block_cache_max_bytes: int = 10 * 1024 ** 3,
+):
+    """
+    Configure caching of remote (httpfs/S3) reads so repeated queries don't download the same bytes.
+
+    DuckDB's in-memory caches hold HTTP metadata, Parquet footers and recently read byte
+    ranges for the life of the process. The optional on-disk block cache persists remote
+    byte ranges between sessions using the `cache_httpfs` community extension, which is
+    loaded alongside httpfs the first time a remote source is read. It is trimmed back to
+    `block_cache_max_bytes` by evicting the least recently used blocks.
+    """
+    settings = {
+        "enable_http_metadata_cache": http_metadata_cache,
+        "enable_object_cache": object_cache,
+        "enable_external_file_cache": external_file_cache,
+    }
+    for name, value in settings.items():
+        try:
+            duckdb_connection.execute(f"SET {name} = {'true' if value else 'false'};")
+        except duckdb.Error:
+            # Not every setting exists in older versions of DuckDB
+            pass
+
+    # Record HTTP requests so a session can report how much was actually downloaded
+    try:
+        duckdb_connection.execute("CALL enable_logging('HTTP');")
+    except duckdb.Error:
+        pass
+
+    if block_cache:
+        block_cache_dir = block_cache_dir or os.path.join(get_cache_dir("qabot"), "blocks")
+        os.makedirs(block_cache_dir, exist_ok=True)
+        evict_lru(block_cache_dir, block_cache_max_bytes)
+
+        def load_block_cache(connection: duckdb.DuckDBPyConnection):
+            if not ensure_extension(connection, "cache_httpfs", repository="community"):
+                print("Remote reads will not be cached on disk")
+                return
+            connection.execute("SET GLOBAL cache_httpfs_type = 'on_disk';")
+            connection.execute(f"SET GLOBAL cache_httpfs_cache_directory = '{block_cache_dir}';")
+
+        on_extension_loaded("httpfs", load_block_cache)
+
+
+def remote_cache_stats(duckdb_connection: duckdb.DuckDBPyConnection, since: datetime | None = None) -> dict[str, int]:
+    """
+    Compare the bytes this session downloaded with the bytes its remote queries scanned.
+
+    Bytes scanned but not downloaded were served from one of the caches.
+    """
+    stats = {"http_requests": 0, "bytes_fetched": 0, "bytes_scanned": 0, "bytes_from_cache": 0}
+    try:
+        stats["http_requests"], stats["bytes_fetched"] = duckdb_connection.sql(
+            """select count(*), coalesce(sum(try_cast(response.headers['Content-Length'] as bigint)), 0)
+            from duckdb_logs_parsed('HTTP')
+            where request.type = 'GET' and request.url not like '%.duckdb_extension%';"""
+        ).fetchone()
+    except duckdb.Error:
+        pass
+
+    since_clause = "and timestamp >= ?" if since is not None else ""
+    stats["bytes_scanned"] = duckdb_connection.execute(
+        f"select coalesce(sum(bytes_read), 0) from qabot_queries where reads_remote {since_clause};",
+        [since] if since is not None else [],
+    ).fetchone()[0]
+    stats["bytes_from_cache"] = max(0, stats["bytes_scanned"] - stats["bytes_fetched"])
+    return stats
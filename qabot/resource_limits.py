@@ -0,0 +1,84 @@
+import math
+import os
+
+import duckdb
+
+from qabot.download_utils import get_cache_dir
+
+# Leave room for the Python process and DuckDB allocations outside the buffer manager
+CGROUP_MEMORY_FRACTION = 0.75
+
+
+def cgroup_memory_limit() -> int | None:
+    """
+    The memory limit of the container (cgroup v2 or v1) in bytes, or None if it isn't limited.
+    """
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        value = _read_cgroup_file(path)
+        if value is None or value == "max":
+            continue
+        limit = int(value)
+        # cgroup v1 reports "unlimited" as a huge page aligned number
+        if limit < 1 << 60:
+            return limit
+    return None
+
+
+def cgroup_cpu_limit() -> int | None:
+    """
+    The number of CPUs the container's CPU quota (cgroup v2 or v1) allows, or None if it isn't limited.
+    """
+    value = _read_cgroup_file("/sys/fs/cgroup/cpu.max")
+    if value is not None:
+        quota, _, period = value.partition(" ")
+        if quota != "max" and period:
+            return max(1, math.floor(int(quota) / int(period)))
+        return None
+    quota = _read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota is not None and period is not None and int(quota) > 0:
+        return max(1, math.floor(int(quota) / int(period)))
+    return None
+
+
+def _read_cgroup_file(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (OSError, ValueError):
+        return None
+
+
+def configure_resources(
+        duckdb_connection: duckdb.DuckDBPyConnection,
+        memory_limit: str | None = None,
+        threads: int | None = None,
+        temp_directory: str | None = None,
+        max_temp_directory_size: str | None = None,
+        preserve_insertion_order: bool | None = None,
+):
+    """
+    Bound DuckDB's memory and CPU use, and let it spill to disk rather than run out of memory.
+
+    Unset limits default to the container's cgroup limits - DuckDB's own defaults are based on
+    the host, so a container can be OOM killed before DuckDB thinks it is short of memory.
+    Spilled data goes to a directory in qabot's cache unless `temp_directory` is given.
+    Not preserving insertion order lets large imports and exports use less memory.
+    """
+    if memory_limit is None and (cgroup_memory := cgroup_memory_limit()) is not None:
+        memory_limit = f"{int(cgroup_memory * CGROUP_MEMORY_FRACTION) // (1024 * 1024)}MB"
+    if threads is None:
+        threads = cgroup_cpu_limit()
+    if temp_directory is None:
+        temp_directory = os.path.join(get_cache_dir("qabot"), "spill")
+
+    settings = {
+        "memory_limit": f"'{memory_limit}'" if memory_limit is not None else None,
+        "threads": str(threads) if threads is not None else None,
+        "temp_directory": f"'{temp_directory}'",
+        "max_temp_directory_size": f"'{max_temp_directory_size}'" if max_temp_directory_size is not None else None,
+        "preserve_insertion_order": ("true" if preserve_insertion_order else "false") if preserve_insertion_order is not None else None,
+    }
+    for name, value in settings.items():
+        if value is not None:
+            duckdb_connection.execute(f"SET {name} = {value};")
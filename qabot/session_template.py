@@ -0,0 +1,144 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import duckdb
+from openai.types.chat import (
+    ChatCompletionAssistantMessageParam,
+    ChatCompletionMessageToolCallParam,
+    ChatCompletionSystemMessageParam,
+    ChatCompletionToolMessageParam,
+)
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+from qabot.functions import get_function_specifications
+from qabot.functions.duckdb_query import run_sql_catch_error
+from qabot.prompts.system import system_prompt
+
+# Ordered, so the same catalog always renders the same bytes. qabot's own bookkeeping
+# tables (qabot_queries, qabot_sources, ...) are left out, the LLM has no use for them.
+SHOW_TABLES_SQL = (
+    "select table_catalog, table_schema, table_name from system.information_schema.tables "
+    "where table_schema != 'information_schema' and table_name not like 'qabot\\_%' escape '\\' order by all;"
+)
+# Templates for this many database states and agent options are kept
+MAX_TEMPLATES = 64
+
+_templates: OrderedDict[tuple, "SessionTemplate"] = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def catalog_fingerprint(duckdb_connection: duckdb.DuckDBPyConnection | None) -> str:
+    """
+    A digest of the tables and views in every attached database, which changes whenever one
+    is created, dropped or renamed. Reads only catalog metadata, not information_schema.
+    qabot's own tables are ignored, as they aren't shown to the LLM.
+    """
+    if duckdb_connection is None:
+        return ""
+    rows = duckdb_connection.execute(
+        "select database_name, schema_name, table_name from duckdb_tables() where table_name not like 'qabot\\_%' escape '\\' "
+        "union all select database_name, schema_name, view_name from duckdb_views() where not internal "
+        "order by all"
+    ).fetchall()
+    return hashlib.blake2b(repr(rows).encode(), digest_size=16).hexdigest()
+
+
+@dataclass(frozen=True)
+class SessionTemplate:
+    """
+    The start of every agent's conversation: the system prompt, the forced `show_tables`
+    exchange and the tool specifications.
+
+    Building it runs SQL, so a template is computed once per catalog state (see
+    `catalog_fingerprint`) and agent options, and each new agent copies it. The messages
+    are identical for every agent sharing a template, so providers' prompt caches hit on
+    the prefix. Agents only append to their copy; the shared messages must not be mutated.
+    """
+    catalog_fingerprint: str
+    messages: tuple
+    function_specifications: tuple
+
+    @classmethod
+    def get(
+            cls,
+            duckdb_connection: duckdb.DuckDBPyConnection | None,
+            allow_wikidata: bool = False,
+            allow_clarify: bool = False,
+            allow_terminate: bool = False,
+            prompt_context: str | None = None,
+            exploration_sampling: bool = False,
+    ) -> "SessionTemplate":
+        """
+        The template for the connection's current catalog, building it if the catalog has
+        changed since it was last built.
+        """
+        fingerprint = catalog_fingerprint(duckdb_connection)
+        key = (fingerprint, allow_wikidata, allow_clarify, allow_terminate, prompt_context, exploration_sampling)
+        with _templates_lock:
+            if key in _templates:
+                _templates.move_to_end(key)
+                return _templates[key]
+
+        template = cls._build(duckdb_connection, fingerprint, *key[1:])
+        with _templates_lock:
+            _templates[key] = template
+            while len(_templates) > MAX_TEMPLATES:
+                _templates.popitem(last=False)
+        return template
+
+    @classmethod
+    def _build(
+            cls,
+            duckdb_connection,
+            fingerprint: str,
+            allow_wikidata: bool,
+            allow_clarify: bool,
+            allow_terminate: bool,
+            prompt_context: str | None,
+            exploration_sampling: bool,
+    ) -> "SessionTemplate":
+        messages = [
+            ChatCompletionSystemMessageParam(
+                **{"role": "system", "content": system_prompt}
+            ),
+
+            # Force the assistant to get the current tables
+            ChatCompletionAssistantMessageParam(
+                role="assistant",
+                content='',
+                tool_calls=[
+                    ChatCompletionMessageToolCallParam(
+                        type="function",
+                        id="show_tables",
+                        function=Function(name="show_tables", arguments="{}"),
+                    )
+                ],
+            ),
+            ChatCompletionToolMessageParam(
+                **{
+                    "role": "tool",
+                    "tool_call_id": "show_tables",
+                    "content": run_sql_catch_error(duckdb_connection, SHOW_TABLES_SQL),
+                }
+            ),
+        ]
+        if prompt_context is not None:
+            messages.append({"role": "user", "content": prompt_context})
+        if exploration_sampling:
+            messages.append({
+                "role": "system",
+                "content": "Queries against large tables read a random sample and are labelled APPROXIMATE. "
+                           "Always include the SQL that computes the answer in the answer's `query` field, "
+                           "it will be re-run against the full data.",
+            })
+
+        function_specifications = get_function_specifications(
+            allow_wikidata, allow_research=True, allow_clarify=allow_clarify, allow_terminate=allow_terminate
+        )
+        return cls(
+            catalog_fingerprint=fingerprint,
+            messages=tuple(messages),
+            function_specifications=tuple(function_specifications),
+        )
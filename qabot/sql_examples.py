@@ -0,0 +1,118 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+import duckdb
+
+from qabot.answer_cache import MinHash, normalise_question
+from qabot.functions.data_loader import CACHE_DATABASE
+
+# Queries as they are logged, see `run_sql_catch_error`
+_NORMALISED_SQL = "regexp_replace(rtrim(trim(replace({}, '`', '')), ';'), '\\s+', ' ', 'g')"
+
+
+@dataclass
+class SqlExample:
+    question: str
+    query: str
+    tables: list[str]
+    similarity: float
+
+
+class SqlExampleIndex:
+    """
+    An index of past questions and the SQL that answered them, used as few-shot examples
+    for similar new questions.
+
+    Examples are retrieved by MinHash similarity of the questions (see `MinHash`) and
+    only if every table their SQL read still exists, so examples for other schemas are never
+    shown. The index is kept in the cache database if it is attached, so it builds up over
+    sessions; the oldest examples beyond `max_examples` are dropped.
+    """
+
+    def __init__(
+            self,
+            duckdb_connection: duckdb.DuckDBPyConnection,
+            k: int = 3,
+            min_similarity: float = 0.3,
+            max_examples: int = 5000,
+    ):
+        self.db = duckdb_connection
+        self.k = k
+        self.min_similarity = min_similarity
+        self.max_examples = max_examples
+        self.minhash = MinHash()
+
+        attached = duckdb_connection.execute(
+            "select count(*) from duckdb_databases() where database_name = ?", [CACHE_DATABASE]
+        ).fetchone()[0] > 0
+        self.table = f"{CACHE_DATABASE}.main.qabot_sql_examples" if attached else "qabot_sql_examples"
+        duckdb_connection.execute(
+            f"""create table if not exists {self.table}(
+                question VARCHAR,
+                query VARCHAR PRIMARY KEY,
+                tables VARCHAR[],
+                signature UBIGINT[],
+                created_at TIMESTAMP
+            );"""
+        )
+
+    def add(self, question: str, query: str):
+        """
+        Index the SQL that successfully answered a question. Queries that never ran
+        successfully (see `ran_successfully`) aren't indexed.
+        """
+        if not self.ran_successfully(query):
+            return
+        try:
+            tables = sorted({name.split(".")[-1].lower() for name in duckdb.get_table_names(query.replace("`", ""))})
+        except duckdb.Error:
+            return
+        self.db.execute(
+            f"insert or replace into {self.table} values (?, ?, ?, ?, ?)",
+            [question, query, tables, self.minhash.signature(normalise_question(question)), datetime.now()],
+        )
+        self.db.execute(
+            f"""delete from {self.table} where query in (
+                select query from {self.table} order by created_at desc offset ?
+            )""",
+            [self.max_examples],
+        )
+
+    def ran_successfully(self, query: str) -> bool:
+        """
+        Whether the query is in `qabot_queries`, which only logs queries that succeeded.
+        Whitespace, backticks and a trailing semicolon are ignored.
+        """
+        try:
+            return self.db.execute(
+                f"select count(*) from qabot_queries where {_NORMALISED_SQL.format('query')} = {_NORMALISED_SQL.format('?')}",
+                [query],
+            ).fetchone()[0] > 0
+        except duckdb.Error:
+            return False
+
+    def retrieve(self, question: str) -> list[SqlExample]:
+        signature = self.minhash.signature(normalise_question(question))
+        existing = {
+            row[0].lower() for row in self.db.execute(
+                "select table_name from duckdb_tables() union all "
+                "select view_name from duckdb_views() where not internal"
+            ).fetchall()
+        }
+        examples = []
+        for example_question, query, tables, example_signature in self.db.execute(
+                f"select question, query, tables, signature from {self.table}"
+        ).fetchall():
+            similarity = MinHash.similarity(signature, example_signature)
+            if similarity >= self.min_similarity and set(tables) <= existing:
+                examples.append(SqlExample(example_question, query, tables, similarity))
+        examples.sort(key=lambda example: example.similarity, reverse=True)
+        return examples[:self.k]
+
+    @staticmethod
+    def prompt(examples: list[SqlExample]) -> str:
+        rendered = "\n\n".join(f"Question: {example.question}\nSQL: {example.query}" for example in examples)
+        return (
+            "Similar questions about these tables were answered before with the SQL below. "
+            "Use them as a starting point if they fit, checking any columns you are unsure of.\n\n" + rendered
+        )